@@ -0,0 +1,106 @@
+import os
+import hmac
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import unquote, parse_qsl
+
+# Сколько секунд initData считается действительной после auth_date
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", "86400"))
+# Сколько уже проверенных initData держим в LRU
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+# Сколько секунд действует токен для открытия потока лидерборда
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", "60"))
+
+
+def derive_secret_key(bot_token: str) -> bytes:
+    """Секрет для проверки подписи WebApp initData (HMAC от токена бота)"""
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
+def validate_init_data(init_data: str, secret_key: bytes) -> Optional[Tuple[dict, int]]:
+    """Проверяет подпись initData; возвращает (user, auth_date) или None"""
+    try:
+        parsed_data = dict(parse_qsl(init_data))
+        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed_data.items()) if k != "hash")
+        h = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256)
+        if hmac.compare_digest(h.hexdigest(), parsed_data["hash"]):
+            user = json.loads(unquote(parsed_data.get("user", "{}")))
+            return user, int(parsed_data.get("auth_date", 0))
+    except Exception:
+        return None
+    return None
+
+
+class InitDataVerifier:
+    """Проверка X-Init-Data с LRU-кэшем уже проверенных заголовков.
+
+    Клиент шлёт один и тот же initData весь сеанс, поэтому повторная проверка —
+    это поиск по sha256 заголовка. Запись живёт до auth_date + max_age.
+    """
+
+    def __init__(self, bot_token: str, max_age: int = INIT_DATA_MAX_AGE, cache_size: int = INIT_DATA_CACHE_SIZE):
+        self.secret_key = derive_secret_key(bot_token or "")
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+
+    def verify(self, init_data: str) -> Optional[dict]:
+        now = time.time()
+        digest = hashlib.sha256(init_data.encode()).digest()
+
+        cached = self._cache.get(digest)
+        if cached is not None:
+            user, expires_at = cached
+            if expires_at > now:
+                self._cache.move_to_end(digest)
+                return user
+            del self._cache[digest]
+
+        result = validate_init_data(init_data, self.secret_key)
+        if result is None:
+            return None
+        user, auth_date = result
+        expires_at = auth_date + self.max_age
+        if not user or expires_at <= now:
+            # Устаревший auth_date — initData могли перехватить и переиграть
+            return None
+
+        self._cache[digest] = (user, expires_at)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return user
+
+
+class StreamTokens:
+    """Короткоживущие токены для EventSource: тот не умеет заголовки, и initData
+    пришлось бы класть в query, то есть в логи доступа.
+
+    Токен — "user_id.expires.подпись", подпись — HMAC на секрете от токена бота.
+    Проверяется только при открытии потока; для переподключения клиент берёт новый.
+    """
+
+    def __init__(self, bot_token: str, ttl: int = STREAM_TOKEN_TTL):
+        self.secret_key = hmac.new(b"StreamToken", (bot_token or "").encode(), hashlib.sha256).digest()
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret_key, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id: int) -> str:
+        payload = f"{int(user_id)}.{int(time.time()) + self.ttl}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str) -> Optional[int]:
+        """user_id из действующего токена или None"""
+        try:
+            user_id, expires_at, signature = token.split(".")
+            if not hmac.compare_digest(self._sign(f"{user_id}.{expires_at}"), signature):
+                return None
+            if int(expires_at) <= time.time():
+                return None
+            return int(user_id)
+        except ValueError:
+            return None
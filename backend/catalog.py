@@ -0,0 +1,296 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from watchfiles import awatch
+except ImportError:  # watchfiles ставится вместе с uvicorn[standard], но он необязателен
+    awatch = None
+
+from metrics import CATALOG_REBUILD
+
+log = logging.getLogger(__name__)
+
+# Как часто (в секундах) сверять mtime файлов курса, если watchfiles нет или он упал
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
+
+
+@dataclass
+class Lesson:
+    id: str
+    title: str
+    path: str
+    section_id: str
+
+
+@dataclass
+class Section:
+    id: str
+    title: str
+    lessons: List[Lesson]
+
+
+@dataclass
+class Course:
+    id: str
+    path: str
+    title: str
+    description: str
+    rank_required: int
+    sections: List[Section]
+    lessons: Dict[str, Lesson] = field(default_factory=dict)
+    signature: tuple = ()
+
+    @property
+    def total_lessons(self) -> int:
+        """Уникальные уроки: урок с одним id в двух секциях — один бит прогресса"""
+        return len(self.lessons)
+
+
+def load_course_metadata(course_path: str) -> dict:
+    """Загружает метаданные курса из course.json"""
+    metadata_file = os.path.join(course_path, "course.json")
+    if os.path.exists(metadata_file):
+        try:
+            with open(metadata_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            log.error("Failed to load course.json", extra={"path": metadata_file, "error": str(e)})
+
+    # Fallback для старых статей
+    course_id = os.path.basename(course_path)
+    return {
+        "title": f"Курс {course_id}",
+        "description": "Описание курса",
+        "rank_required": 1,
+        "sections": [
+            {
+                "id": "main",
+                "title": "Основной раздел",
+                "lessons": []
+            }
+        ]
+    }
+
+
+def read_lesson_title(md_file: str, lesson_id: str) -> str:
+    """Читает заголовок урока из первой строки файла"""
+    try:
+        with open(md_file, 'r', encoding='utf-8') as f:
+            first_line = f.readline().strip()
+            return first_line.lstrip('#').strip() if first_line.startswith('#') else lesson_id
+    except Exception as e:
+        log.error("Failed to read lesson title", extra={"path": md_file, "error": str(e)})
+        return lesson_id
+
+
+def list_markdown(section_path: str) -> List[os.DirEntry]:
+    try:
+        with os.scandir(section_path) as it:
+            return sorted(
+                (e for e in it if e.name.endswith(".md") and e.is_file()),
+                key=lambda e: e.name,
+            )
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _stat_key(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def course_signature(course_path: str, section_ids: List[str]) -> tuple:
+    """Отпечаток курса: mtime/размер каталога, course.json, папок секций и .md файлов"""
+    parts = [_stat_key(course_path), _stat_key(os.path.join(course_path, "course.json"))]
+    for section_id in section_ids:
+        section_path = os.path.join(course_path, section_id)
+        parts.append((section_id, _stat_key(section_path)))
+        for entry in list_markdown(section_path):
+            st = entry.stat()
+            parts.append((entry.name, st.st_mtime_ns, st.st_size))
+    return tuple(parts)
+
+
+def build_course(course_id: str, course_path: str) -> Course:
+    """Собирает индекс одного курса: метаданные, секции и уроки"""
+    metadata = load_course_metadata(course_path)
+    sections = []
+    lessons_by_id: Dict[str, Lesson] = {}
+
+    for section in metadata.get("sections", []):
+        section_path = os.path.join(course_path, section["id"])
+        lessons = []
+        for entry in list_markdown(section_path):
+            lesson_id = os.path.splitext(entry.name)[0]
+            lesson = Lesson(
+                id=lesson_id,
+                title=read_lesson_title(entry.path, lesson_id),
+                path=entry.path,
+                section_id=section["id"],
+            )
+            lessons.append(lesson)
+            # Как и раньше, при совпадении id выигрывает первая секция
+            lessons_by_id.setdefault(lesson_id, lesson)
+        sections.append(Section(id=section["id"], title=section["title"], lessons=lessons))
+
+    return Course(
+        id=course_id,
+        path=course_path,
+        title=metadata.get("title", course_id),
+        description=metadata.get("description", ""),
+        rank_required=metadata.get("rank_required", 1),
+        sections=sections,
+        lessons=lessons_by_id,
+        signature=course_signature(course_path, [s.id for s in sections]),
+    )
+
+
+class CourseCatalog:
+    """Индекс курсов в памяти.
+
+    Строится один раз при старте; дальше пересобирается только изменившийся курс —
+    по событию watcher'а или когда при периодической сверке поменялся его отпечаток.
+    И то и другое делает фоновая задача watch() в отдельном потоке: обработчики запросов
+    только читают готовый индекс и не ходят на диск.
+    """
+
+    def __init__(self, root: str, check_interval: float = CATALOG_CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self.version = 0
+        self._courses: Dict[str, Course] = {}
+        self._root_key = None
+        self._dirty: set = set()
+        self._root_dirty = True
+        self._lock = threading.Lock()
+
+    # --- построение ---
+
+    def _course_dirs(self) -> List[str]:
+        try:
+            with os.scandir(self.root) as it:
+                return sorted(e.name for e in it if e.is_dir())
+        except FileNotFoundError:
+            log.error("Content directory does not exist", extra={"path": self.root})
+            return []
+
+    def _rebuild_course(self, courses: Dict[str, "Course"], course_id: str):
+        with CATALOG_REBUILD.labels("course").time():
+            course_path = os.path.join(self.root, course_id)
+            if os.path.isdir(course_path):
+                courses[course_id] = build_course(course_id, course_path)
+            else:
+                courses.pop(course_id, None)
+        log.info("Course reindexed", extra={"course_id": course_id})
+
+    def build(self, snapshot=None):
+        """Полная пересборка индекса; курсы, совпавшие со снимком (snapshot.py), берутся из него"""
+        with self._lock, CATALOG_REBUILD.labels("full").time():
+            self._root_key = _stat_key(self.root)
+            courses = {}
+            for course_id in self._course_dirs():
+                course_path = os.path.join(self.root, course_id)
+                course = snapshot.course(course_id, course_path) if snapshot is not None else None
+                courses[course_id] = course or build_course(course_id, course_path)
+            self._courses = courses
+            self._dirty.clear()
+            self._root_dirty = False
+            self.version += 1
+
+    def refresh(self, check: bool = False):
+        """Пересобирает курсы, помеченные watcher'ом; с check — ещё и сверяет mtime всех курсов"""
+        if not (check or self._dirty or self._root_dirty):
+            return
+
+        with self._lock:
+            if check or self._root_dirty:
+                root_key = _stat_key(self.root)
+                if root_key != self._root_key or self._root_dirty:
+                    # Курсы добавились или удалились
+                    self._root_key = root_key
+                    current = set(self._course_dirs())
+                    for course_id in current.symmetric_difference(self._courses):
+                        self._dirty.add(course_id)
+                    self._root_dirty = False
+
+            if check:
+                for course_id, course in self._courses.items():
+                    section_ids = [s.id for s in course.sections]
+                    if course_signature(course.path, section_ids) != course.signature:
+                        self._dirty.add(course_id)
+
+            dirty, self._dirty = self._dirty, set()
+            if dirty:
+                # Пересобираем копию и подменяем целиком: читатели в event loop не видят полусобранный индекс
+                courses = dict(self._courses)
+                for course_id in sorted(dirty):
+                    self._rebuild_course(courses, course_id)
+                self._courses = courses
+                self.version += 1
+
+    def invalidate(self, course_id: Optional[str] = None):
+        """Помечает курс (или корень каталога) как изменившийся"""
+        if course_id is None:
+            self._root_dirty = True
+        else:
+            self._dirty.add(course_id)
+
+    # --- чтение ---
+
+    def courses(self) -> List[Course]:
+        return list(self._courses.values())
+
+    def get_course(self, course_id: str) -> Optional[Course]:
+        return self._courses.get(course_id)
+
+    def get_lesson(self, course_id: str, lesson_id: str) -> Tuple[Optional[Course], Optional[Lesson]]:
+        course = self.get_course(course_id)
+        if course is None:
+            return None, None
+        return course, course.lessons.get(lesson_id)
+
+    # --- watcher ---
+
+    def _on_paths_changed(self, paths):
+        root = os.path.abspath(self.root)
+        for path in paths:
+            rel = os.path.relpath(os.path.abspath(path), root)
+            if rel.startswith(".."):
+                continue
+            head = rel.split(os.sep, 1)
+            if len(head) == 1:
+                # Изменение прямо в корне: новый/удалённый курс или легаси-статья
+                self.invalidate(None)
+                if head[0] in self._courses:
+                    self.invalidate(head[0])
+            else:
+                self.invalidate(head[0])
+
+    async def watch(self):
+        """Фоновое обновление индекса: по событиям watchfiles, а без него — сверкой раз в check_interval.
+
+        Пересборка (stat и чтение файлов) идёт в отдельном потоке, не в event loop.
+        """
+        if awatch is not None and os.path.isdir(self.root):
+            try:
+                async for changes in awatch(self.root):
+                    self._on_paths_changed(path for _, path in changes)
+                    await asyncio.to_thread(self.refresh)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Content watcher stopped, falling back to polling")
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await asyncio.to_thread(self.refresh, True)
+            except Exception:
+                log.exception("Failed to refresh course catalog")
@@ -0,0 +1,201 @@
+import os
+import time
+import threading
+from collections import deque
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from starlette.concurrency import run_in_threadpool
+
+from metrics import DB_POOL_ACQUIRE, DB_POOL_TIMEOUTS, observe_query
+
+# --- Настройки пула ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Сколько секунд запрос ждёт свободное соединение, прежде чем получить 503
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Соединение, пролежавшее в пуле дольше этого, проверяется через SELECT 1
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений psycopg2 с таймаутом ожидания и health-check'ом"""
+
+    def __init__(self, dsn: str, min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT, check_interval: float = DB_POOL_HEALTHCHECK_INTERVAL):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = deque()  # (conn, время возврата в пул)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        # Статистика
+        self._waiting = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+
+    def open(self):
+        for _ in range(self.min_size):
+            conn = self._connect()
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+                self._size -= 1
+            self._cond.notify_all()
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn, idle_since = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        DB_POOL_TIMEOUTS.inc()
+                        raise PoolTimeout(f"no free connection after {self.timeout}s")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+        # Создание и проверка соединения — вне блокировки
+        try:
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        DB_POOL_ACQUIRE.observe(waited)
+        with self._cond:
+            self._acquired += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        if not discard and not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                if not conn.closed:
+                    conn.close()
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "acquired_total": self._acquired,
+                "timeouts_total": self._timeouts,
+                "wait_seconds_total": round(self._wait_total, 6),
+                "wait_seconds_max": round(self._wait_max, 6),
+            }
+
+
+class Database:
+    """Обёртка над пулом: все запросы выполняются в threadpool и не блокируют event loop"""
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+
+    def _run_sync(self, fn, *args):
+        conn = self.pool.getconn()
+        discard = False
+        try:
+            with conn.cursor() as cur:
+                result = fn(cur, *args)
+            conn.commit()
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.pool.putconn(conn, discard=discard)
+
+    async def run(self, fn, *args):
+        """Выполняет fn(cursor, *args) на соединении из пула в отдельном потоке"""
+        started = time.perf_counter()
+        try:
+            return await run_in_threadpool(self._run_sync, fn, *args)
+        finally:
+            observe_query(time.perf_counter() - started)
+
+    async def fetchone(self, query: str, params=None) -> dict:
+        def _fetch(cur):
+            cur.execute(query, params)
+            return cur.fetchone()
+        return await self.run(_fetch)
+
+    async def fetchall(self, query: str, params=None) -> list:
+        def _fetch(cur):
+            cur.execute(query, params)
+            return cur.fetchall()
+        return await self.run(_fetch)
+
+    async def execute(self, query: str, params=None) -> int:
+        def _execute(cur):
+            cur.execute(query, params)
+            return cur.rowcount
+        return await self.run(_execute)
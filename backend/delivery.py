@@ -0,0 +1,157 @@
+import os
+import gzip
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # без brotli отдаём gzip
+    brotli = None
+
+# Сколько версий тел уроков/статей держим в памяти
+CONTENT_CACHE_SIZE = int(os.getenv("CONTENT_CACHE_SIZE", "512"))
+# Тела меньше этого не сжимаем — заголовки дороже выигрыша
+MIN_COMPRESS_SIZE = 256
+
+
+@dataclass
+class EncodedBody:
+    """Тело ответа, заранее сжатое во все поддерживаемые кодировки"""
+    identity: bytes
+    gzip: Optional[bytes]
+    br: Optional[bytes]
+    etag: str
+    last_modified: str
+    mtime: float
+
+
+def encode_body(body: bytes, mtime: float) -> EncodedBody:
+    compress = len(body) >= MIN_COMPRESS_SIZE
+    return EncodedBody(
+        identity=body,
+        gzip=gzip.compress(body, compresslevel=9, mtime=0) if compress else None,
+        br=brotli.compress(body, quality=11) if compress and brotli is not None else None,
+        # Слабый ETag: одинаков для всех кодировок одного тела
+        etag='W/"' + hashlib.sha256(body).hexdigest()[:32] + '"',
+        last_modified=formatdate(mtime, usegmt=True),
+        mtime=mtime,
+    )
+
+
+def file_version(path: str) -> Optional[Tuple[int, int]]:
+    """Версия файла для кэша: (mtime_ns, size)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def version_mtime(version: tuple) -> float:
+    """Самый свежий mtime в версии: её начало — file_version файла, дальше могут идти
+    file_version зависимостей (медиа урока) и прочие части ключа"""
+    mtimes = [version[0]] + [part[0] for part in version[2:] if isinstance(part, tuple) and part]
+    return max(mtimes) / 1e9
+
+
+class EncodedBodyCache:
+    """LRU закодированных тел по ключу; запись пересобирается, когда меняется версия файла.
+
+    peek() дёшев и безопасен в event loop; get() на промахе читает, рендерит и сжимает
+    тело (сотни миллисекунд на brotli 11), поэтому вызывается через run_in_threadpool.
+    Last-Modified — самый свежий mtime файла и его медиа; если тело поменялось, а mtime
+    нет (удалили картинку, урок переехал в другую секцию), он сдвигается на момент сборки,
+    чтобы ревалидация по одному If-Modified-Since не получила 304 на старое тело.
+    """
+
+    def __init__(self, max_size: int = CONTENT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[tuple, EncodedBody]]" = OrderedDict()
+        # get() идёт из потоков пула, peek() — из event loop
+        self._lock = threading.Lock()
+
+    def peek(self, key: str, version: tuple) -> Optional[EncodedBody]:
+        """Готовое тело этой версии или None — без сборки"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get(self, key: str, version: tuple, build: Callable[[], bytes]) -> EncodedBody:
+        encoded = self.peek(key, version)
+        if encoded is not None:
+            return encoded
+        body = build()
+        mtime = version_mtime(version)
+        with self._lock:
+            previous = self._entries.get(key)
+        if previous is not None and previous[1].mtime >= mtime:
+            # Last-Modified не идёт назад и растёт с каждым новым телом
+            same = previous[1].identity == body
+            mtime = previous[1].mtime if same else max(time.time(), previous[1].mtime + 1)
+        encoded = encode_body(body, mtime)
+        with self._lock:
+            self._entries[key] = (version, encoded)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _not_modified(request: Request, encoded: EncodedBody) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        # Сравнение ETag для GET — слабое: W/"x" и "x" совпадают
+        weak = encoded.etag[2:]
+        return "*" in tags or any(t == encoded.etag or t == weak or t[2:] == weak for t in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(encoded.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _accepts(accept_encoding: str, coding: str) -> bool:
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == coding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def encoded_response(request: Request, encoded: EncodedBody, media_type: str = "application/json") -> Response:
+    """Отдаёт 304 по ETag/Last-Modified или заранее сжатое тело по Accept-Encoding"""
+    headers = {
+        "ETag": encoded.etag,
+        "Last-Modified": encoded.last_modified,
+        # Контент закрыт по рангу: кэшировать можно только у клиента и только с ревалидацией
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if _not_modified(request, encoded):
+        return Response(status_code=304, headers=headers)
+
+    accept_encoding = request.headers.get("accept-encoding", "")
+    body = encoded.identity
+    if encoded.br is not None and _accepts(accept_encoding, "br"):
+        body, headers["Content-Encoding"] = encoded.br, "br"
+    elif encoded.gzip is not None and _accepts(accept_encoding, "gzip"):
+        body, headers["Content-Encoding"] = encoded.gzip, "gzip"
+    return Response(content=body, media_type=media_type, headers=headers)
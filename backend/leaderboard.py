@@ -0,0 +1,445 @@
+import os
+import time
+import asyncio
+import bisect
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# Сколько секунд снимок лидерборда считается свежим
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", "10"))
+# Ещё столько секунд после TTL отдаём устаревший снимок, обновляя его в фоне
+LEADERBOARD_STALE_TTL = float(os.getenv("LEADERBOARD_STALE_TTL", "60"))
+# Пока идут уведомления score_delta, снимок двигается ими; перечитываем его из БД только так редко
+LEADERBOARD_LIVE_TTL = float(os.getenv("LEADERBOARD_LIVE_TTL", "300"))
+
+# Канал, в который коллектор шлёт прирост очков после каждой записанной пачки
+SCORE_CHANNEL = "score_delta"
+
+# Размер окна в днях для периодов лидерборда ('all' считается по channel_subscribers)
+WINDOW_DAYS = {'7d': 7, '30d': 30}
+# Во сколько раз очки больше ключа сортировки (для 'all' сортируем по message_count)
+SCORE_SCALE = {'all': 2}
+
+PROFILE_COLUMNS = "cs.first_name, cs.last_name, cs.username, cs.photo_url"
+
+# Рейтинг одной группы за один период: (group_id, period)
+Board = Tuple[int, str]
+
+
+def utc_midnight() -> datetime:
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def scores_cte(group_id: int, period: str) -> Tuple[str, dict]:
+    """CTE `scores(user_id, sort_key, total_score)` по активным подписчикам группы за период.
+
+    Сортировка и сравнения идут по sort_key, чтобы для 'all' работал индекс
+    idx_subscribers_group_score (group_id, is_active, message_count DESC, telegram_id).
+    Параметр group_id нужен и запросам поверх CTE — для JOIN с channel_subscribers.
+    """
+    if period == 'all':
+        return """
+            scores AS NOT MATERIALIZED (
+                SELECT telegram_id AS user_id, message_count AS sort_key, message_count * 2 AS total_score
+                FROM channel_subscribers
+                WHERE group_id = %(group_id)s AND is_active = TRUE AND message_count > 0
+            )
+        """, {'group_id': group_id}
+
+    # Закрытые дни берём из суточного rollup'а, текущий (неполный) день — из messages.
+    # Начало дня передаётся константой: партиции messages отсекаются ещё при планировании
+    day_start = utc_midnight()
+    return """
+        scores AS (
+            SELECT w.user_id, w.total_score AS sort_key, w.total_score
+            FROM (
+                SELECT user_id, SUM(points) AS total_score
+                FROM (
+                    SELECT user_id, points
+                    FROM user_daily_scores
+                    WHERE group_id = %(group_id)s
+                      AND day >= %(today)s::date - %(closed_days)s
+                      AND day < %(today)s
+                    UNION ALL
+                    SELECT user_id, points
+                    FROM messages
+                    WHERE group_id = %(group_id)s
+                      AND message_date >= %(day_start)s
+                ) window_scores
+                GROUP BY user_id
+            ) w
+            JOIN channel_subscribers cs ON cs.group_id = %(group_id)s AND cs.telegram_id = w.user_id
+            WHERE cs.is_active = TRUE
+        )
+    """, {'group_id': group_id, 'closed_days': WINDOW_DAYS[period] - 1, 'today': day_start.date(), 'day_start': day_start}
+
+
+def fetch_page(cur, group_id: int, period: str, limit: int, after_rank: int = 0,
+               after_score: Optional[int] = None, after_user_id: Optional[int] = None) -> list:
+    """Страница лидерборда: `limit` строк после позиции `after_rank`.
+
+    Если передан курсор (after_score, after_user_id) — последней строки предыдущей
+    страницы, — выборка идёт по keyset без OFFSET; иначе используется OFFSET after_rank.
+    """
+    cte, params = scores_cte(group_id, period)
+    params = dict(params, limit=limit, after_rank=after_rank)
+
+    if after_score is not None and after_user_id is not None:
+        position = """
+            WHERE s.sort_key < %(after_key)s
+               OR (s.sort_key = %(after_key)s AND s.user_id > %(after_user_id)s)
+        """
+        offset = ""
+        params.update(after_key=after_score // SCORE_SCALE.get(period, 1), after_user_id=after_user_id)
+    else:
+        position = ""
+        offset = "OFFSET %(after_rank)s"
+
+    cur.execute(f"""
+        WITH {cte}
+        SELECT
+            s.user_id,
+            s.total_score,
+            {PROFILE_COLUMNS},
+            %(after_rank)s + ROW_NUMBER() OVER (ORDER BY s.sort_key DESC, s.user_id) AS rank
+        FROM (
+            SELECT s.user_id, s.sort_key, s.total_score
+            FROM scores s
+            {position}
+            ORDER BY s.sort_key DESC, s.user_id
+            LIMIT %(limit)s {offset}
+        ) s
+        JOIN channel_subscribers cs ON cs.group_id = %(group_id)s AND cs.telegram_id = s.user_id
+        ORDER BY rank;
+    """, params)
+    return cur.fetchall()
+
+
+def fetch_user_rank(cur, group_id: int, period: str, user_id: int) -> Optional[dict]:
+    """Место и очки пользователя: считаем только тех, кто выше него"""
+    cte, params = scores_cte(group_id, period)
+    params = dict(params, user_id=user_id)
+    cur.execute(f"""
+        WITH {cte},
+        me AS (SELECT user_id, sort_key, total_score FROM scores WHERE user_id = %(user_id)s)
+        SELECT
+            me.user_id,
+            me.total_score,
+            {PROFILE_COLUMNS},
+            (
+                SELECT COUNT(*) FROM scores s
+                WHERE s.sort_key > me.sort_key
+                   OR (s.sort_key = me.sort_key AND s.user_id < me.user_id)
+            ) + 1 AS rank
+        FROM me
+        JOIN channel_subscribers cs ON cs.group_id = %(group_id)s AND cs.telegram_id = me.user_id;
+    """, params)
+    return cur.fetchone()
+
+
+def fetch_neighbours(cur, group_id: int, period: str, user_id: int, sort_key: int, limit: int, above: bool) -> list:
+    """До limit участников сразу выше (above) или ниже пользователя, ближайшие первыми.
+
+    Равные очки и строго большие/меньшие — отдельными подзапросами: каждый идёт
+    диапазоном по индексу (group_id, is_active, message_count DESC, telegram_id) от
+    позиции пользователя, а не сортирует всех.
+    """
+    cte, params = scores_cte(group_id, period)
+    params = dict(params, user_id=user_id, sort_key=sort_key, limit=limit)
+    if above:
+        tie, beyond, key_order, id_order = "s.user_id < %(user_id)s", "s.sort_key > %(sort_key)s", "ASC", "DESC"
+    else:
+        tie, beyond, key_order, id_order = "s.user_id > %(user_id)s", "s.sort_key < %(sort_key)s", "DESC", "ASC"
+    cur.execute(f"""
+        WITH {cte}
+        SELECT n.user_id, n.total_score, {PROFILE_COLUMNS}
+        FROM (
+            (SELECT s.user_id, s.sort_key, s.total_score FROM scores s
+             WHERE s.sort_key = %(sort_key)s AND {tie}
+             ORDER BY s.user_id {id_order}
+             LIMIT %(limit)s)
+            UNION ALL
+            (SELECT s.user_id, s.sort_key, s.total_score FROM scores s
+             WHERE {beyond}
+             ORDER BY s.sort_key {key_order}, s.user_id {id_order}
+             LIMIT %(limit)s)
+        ) n
+        JOIN channel_subscribers cs ON cs.group_id = %(group_id)s AND cs.telegram_id = n.user_id
+        ORDER BY n.sort_key {key_order}, n.user_id {id_order}
+        LIMIT %(limit)s;
+    """, params)
+    return [
+        (r['user_id'], r['total_score'], r['first_name'], r['last_name'], r['username'], r['photo_url'])
+        for r in cur.fetchall()
+    ]
+
+
+def fetch_around(cur, group_id: int, period: str, user_id: int,
+                 radius: int) -> Tuple[List[Tuple[int, tuple]], bool, bool]:
+    """Как Snapshot.around, но из БД — когда кэш лидерборда выключен"""
+    me = fetch_user_rank(cur, group_id, period, user_id)
+    if me is None:
+        return [], False, False
+    rank, score = me['rank'], me['total_score']
+    sort_key = score // SCORE_SCALE.get(period, 1)
+    above = fetch_neighbours(cur, group_id, period, user_id, sort_key, radius + 1, above=True)
+    below = fetch_neighbours(cur, group_id, period, user_id, sort_key, radius + 1, above=False)
+    me_row = (user_id, score, me['first_name'], me['last_name'], me['username'], me['photo_url'])
+    rows = [(rank - i - 1, row) for i, row in reversed(list(enumerate(above[:radius])))]
+    rows.append((rank, me_row))
+    rows.extend((rank + i + 1, row) for i, row in enumerate(below[:radius]))
+    return rows, len(above) > radius, len(below) > radius
+
+
+def fetch_profiles(cur, group_id: int, user_ids: List[int]) -> Dict[int, tuple]:
+    """(first_name, last_name, username, photo_url) активных подписчиков группы — для новых строк рейтинга"""
+    cur.execute("""
+        SELECT telegram_id, first_name, last_name, username, photo_url
+        FROM channel_subscribers
+        WHERE group_id = %s AND telegram_id = ANY(%s) AND is_active = TRUE;
+    """, (group_id, list(user_ids)))
+    return {r['telegram_id']: (r['first_name'], r['last_name'], r['username'], r['photo_url']) for r in cur.fetchall()}
+
+
+def fetch_all(cur, group_id: int, period: str) -> list:
+    """Все участники группы за период по порядку мест — для снимка в кэше"""
+    cte, params = scores_cte(group_id, period)
+    cur.execute(f"""
+        WITH {cte}
+        SELECT s.user_id, s.total_score, {PROFILE_COLUMNS}
+        FROM scores s
+        JOIN channel_subscribers cs ON cs.group_id = %(group_id)s AND cs.telegram_id = s.user_id
+        ORDER BY s.sort_key DESC, s.user_id;
+    """, params)
+    return [
+        (r['user_id'], r['total_score'], r['first_name'], r['last_name'], r['username'], r['photo_url'])
+        for r in cur.fetchall()
+    ]
+
+
+def fetch_snapshot(cur, group_id: int, period: str) -> Tuple[list, str]:
+    """fetch_all и снимок транзакций, на котором он прочитан (для сверки с score_delta)"""
+    # Оба запроса должны видеть одни и те же транзакции
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+    cur.execute("SELECT pg_current_snapshot()::text AS snapshot;")
+    txid_snapshot = cur.fetchone()['snapshot']
+    return fetch_all(cur, group_id, period), txid_snapshot
+
+
+# --- Прирост очков от коллектора ---
+
+@dataclass
+class ScoreDelta:
+    xid: int
+    group_id: int
+    day: date
+    user_id: int
+    points: int
+    messages: int
+
+
+def parse_score_deltas(payload: str) -> List[ScoreDelta]:
+    """Payload NOTIFY score_delta: "xid;group_id;YYYY-MM-DD;user_id:points:messages,..." """
+    xid, group_id, day, items = payload.split(";", 3)
+    xid, group_id, day = int(xid), int(group_id), date.fromisoformat(day)
+    deltas = []
+    for item in items.split(","):
+        user_id, points, messages = item.split(":")
+        deltas.append(ScoreDelta(xid, group_id, day, int(user_id), int(points), int(messages)))
+    return deltas
+
+
+def delta_score(period: str, window_end: date, delta: ScoreDelta) -> int:
+    """Сколько delta добавляет к очкам периода (0 — не попадает в окно)"""
+    if period == 'all':
+        return delta.messages * SCORE_SCALE['all']
+    if window_end - timedelta(days=WINDOW_DAYS[period] - 1) <= delta.day <= window_end:
+        return delta.points
+    return 0
+
+
+def txid_visible(txid_snapshot: str, xid: int) -> bool:
+    """Видна ли закоммиченная транзакция xid в снимке pg_current_snapshot() ("xmin:xmax:xip,...")"""
+    xmin, xmax, xip = txid_snapshot.split(":")
+    if xid < int(xmin):
+        return True
+    if xid >= int(xmax):
+        return False
+    return str(xid) not in xip.split(",")
+
+
+# --- Общий кэш лидерборда ---
+
+@dataclass
+class Snapshot:
+    """Рейтинг периода: строки (user_id, score, first_name, last_name, username, photo_url) по местам"""
+    rows: List[tuple]
+    built_at: float = field(default_factory=time.monotonic)
+    # День UTC, по который считалось окно периода, и снимок транзакций, на котором читали
+    day: Optional[date] = None
+    txid_snapshot: Optional[str] = None
+    positions: Dict[int, int] = field(init=False)
+
+    def __post_init__(self):
+        self.positions = {row[0]: i for i, row in enumerate(self.rows)}
+
+    def page(self, limit: int, after_rank: int = 0, after_score: Optional[int] = None,
+             after_user_id: Optional[int] = None) -> List[Tuple[int, tuple]]:
+        """Срез (rank, row); курсор (after_score, after_user_id) точнее after_rank, если снимок обновился"""
+        start = after_rank
+        if after_score is not None and after_user_id is not None:
+            start = bisect.bisect_right(self.rows, (-after_score, after_user_id), key=lambda r: (-r[1], r[0]))
+        return [(start + i + 1, row) for i, row in enumerate(self.rows[start:start + limit])]
+
+    def rank_of(self, user_id: int) -> Optional[Tuple[int, tuple]]:
+        i = self.positions.get(user_id)
+        return None if i is None else (i + 1, self.rows[i])
+
+    def around(self, user_id: int, radius: int) -> Tuple[List[Tuple[int, tuple]], bool, bool]:
+        """(rank, row) пользователя и radius соседей с каждой стороны; есть ли ещё выше и ниже"""
+        i = self.positions.get(user_id)
+        if i is None:
+            return [], False, False
+        start, end = max(0, i - radius), min(len(self.rows), i + radius + 1)
+        return [(start + j + 1, row) for j, row in enumerate(self.rows[start:end])], start > 0, end < len(self.rows)
+
+    def add_score(self, user_id: int, score: int, profile: Optional[tuple] = None) -> bool:
+        """Прибавляет очки и передвигает строку; новому участнику нужен profile. False — не применилось"""
+        old = self.positions.get(user_id)
+        if old is None:
+            if profile is None:
+                return False
+            row = (user_id, score) + tuple(profile)
+            first, last = len(self.rows), len(self.rows)
+        else:
+            row = self.rows.pop(old)
+            row = (user_id, row[1] + score) + row[2:]
+            first, last = old, old
+        new = bisect.bisect_left(self.rows, (-row[1], user_id), key=lambda r: (-r[1], r[0]))
+        self.rows.insert(new, row)
+        # Места сдвигаются только между старой и новой позицией (у новичка — до конца списка)
+        if old is None:
+            last = len(self.rows) - 1
+        for i in range(min(first, new), max(last, new) + 1):
+            self.positions[self.rows[i][0]] = i
+        return True
+
+
+class LeaderboardCache:
+    """Снимки лидерборда по рейтингам (группа, период) с TTL и stale-while-revalidate.
+
+    Одновременно на рейтинг выполняется не больше одного запроса к БД (single-flight):
+    остальные ждут его результат. Пока снимок в пределах stale-окна, его отдают сразу,
+    а обновление идёт в фоне. Рейтинги разных групп не ждут друг друга.
+
+    apply() двигает снимки группы приростами из score_delta; пока is_live(), снимок
+    считается свежим live_ttl. Приросты, пришедшие во время перечитывания, докладываются
+    в новый снимок, если его запрос их ещё не видел.
+    """
+
+    def __init__(self, loader: Callable[[int, str], Awaitable[Tuple[List[tuple], str]]],
+                 ttl: float = LEADERBOARD_CACHE_TTL, stale_ttl: float = LEADERBOARD_STALE_TTL,
+                 live_ttl: float = LEADERBOARD_LIVE_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.live_ttl = live_ttl
+        # Доходят ли сейчас уведомления score_delta (LISTEN-соединение живо)
+        self.is_live: Callable[[], bool] = lambda: False
+        # Вызывается с рейтингом (group_id, period) после каждого перечитывания снимка
+        self.on_load: Optional[Callable[[Board], None]] = None
+        self._snapshots: Dict[Board, Snapshot] = {}
+        self._inflight: Dict[Board, asyncio.Task] = {}
+        # рейтинг -> приросты, применённые, пока его снимок перечитывался
+        self._pending: Dict[Board, List[Tuple[List[ScoreDelta], Dict[int, tuple]]]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _refresh(self, board: Board) -> asyncio.Task:
+        task = self._inflight.get(board)
+        if task is None:
+            self._pending[board] = []
+            task = asyncio.create_task(self._load(board))
+            self._inflight[board] = task
+        return task
+
+    async def _load(self, board: Board) -> Snapshot:
+        try:
+            day = utc_midnight().date()
+            rows, txid_snapshot = await self.loader(*board)
+            snapshot = Snapshot(rows, day=day, txid_snapshot=txid_snapshot)
+            for deltas, profiles in self._pending.get(board, ()):
+                self._apply_to(snapshot, board[1], deltas, profiles)
+            self._snapshots[board] = snapshot
+        finally:
+            self._inflight.pop(board, None)
+            self._pending.pop(board, None)
+        if self.on_load is not None:
+            self.on_load(board)
+        return snapshot
+
+    async def get(self, group_id: int, period: str) -> Snapshot:
+        board = (group_id, period)
+        snapshot = self._snapshots.get(board)
+        ttl = self.live_ttl if self.is_live() else self.ttl
+        age = time.monotonic() - snapshot.built_at if snapshot else None
+        if snapshot is not None and period != 'all' and snapshot.day != utc_midnight().date():
+            # Окно периода сдвинулось на день: вычесть ушедший день приростами нельзя
+            age = max(age, ttl)
+        if snapshot is not None and age < ttl:
+            return snapshot
+        if snapshot is not None and age < ttl + self.stale_ttl:
+            task = self._refresh(board)
+            # Ошибку фонового обновления заберёт следующий ожидающий; здесь её только гасим
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return snapshot
+        # shield: отмена одного клиента не должна отменять общий запрос
+        return await asyncio.shield(self._refresh(board))
+
+    def current(self, board: Board) -> Optional[Snapshot]:
+        """Снимок рейтинга, если он есть, без похода в БД"""
+        return self._snapshots.get(board)
+
+    def missing_users(self, group_id: int, user_ids: Iterable[int]) -> Set[int]:
+        """Кому из user_ids нужен профиль для apply(): их нет в каком-то из снимков группы"""
+        user_ids = set(user_ids)
+        if any(board[0] == group_id for board in self._pending):
+            # Перечитанный снимок может не содержать никого из них
+            return user_ids
+        missing = set()
+        for board, snapshot in self._snapshots.items():
+            if board[0] == group_id:
+                missing |= user_ids - snapshot.positions.keys()
+        return missing
+
+    @staticmethod
+    def _apply_to(snapshot: Snapshot, period: str, deltas: List[ScoreDelta], profiles: Dict[int, tuple]) -> bool:
+        applied = False
+        for delta in deltas:
+            # Транзакция уже учтена запросом, которым читали снимок
+            if snapshot.txid_snapshot is not None and txid_visible(snapshot.txid_snapshot, delta.xid):
+                continue
+            score = delta_score(period, snapshot.day, delta)
+            if score and snapshot.add_score(delta.user_id, score, profiles.get(delta.user_id)):
+                applied = True
+        return applied
+
+    def apply(self, group_id: int, deltas: List[ScoreDelta], profiles: Dict[int, tuple]) -> Set[Board]:
+        """Применяет приросты группы к её снимкам; возвращает рейтинги, которые изменились"""
+        changed = set()
+        for board, snapshot in self._snapshots.items():
+            if board[0] == group_id and self._apply_to(snapshot, board[1], deltas, profiles):
+                changed.add(board)
+        for board, pending in self._pending.items():
+            if board[0] == group_id:
+                pending.append((deltas, profiles))
+        return changed
+
+    def invalidate(self, board: Optional[Board] = None):
+        if board is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(board, None)
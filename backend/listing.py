@@ -0,0 +1,116 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from catalog import Course, CourseCatalog
+
+
+def _json(value) -> bytes:
+    # Так же, как model_dump_json: компактно и без \u-экранирования кириллицы
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _flag(value: bool) -> bytes:
+    return b"true" if value else b"false"
+
+
+@dataclass
+class ListedCourse:
+    """Элемент /api/courses: всё, кроме прогресса, уже сериализовано"""
+    course: Course
+    head: bytes
+    middle: bytes
+
+    def render(self, progress: int, completed_lessons: int) -> bytes:
+        return b"%s%d%s%d}" % (self.head, progress, self.middle, completed_lessons)
+
+
+@dataclass
+class CourseTemplate:
+    """Ответ /api/courses/{id}: статичные куски вокруг отметок уроков и прогресса"""
+    course: Course
+    # parts[i] стоит перед отметкой урока lesson_ids[i]; последний кусок — перед progress
+    parts: List[bytes]
+    lesson_ids: List[str]
+
+    def render(self, completed: List[bool], progress: int) -> bytes:
+        out = bytearray()
+        for part, flag in zip(self.parts, completed):
+            out += part
+            out += _flag(flag)
+        out += self.parts[-1]
+        out += b"%d}" % progress
+        return bytes(out)
+
+
+def list_item(course: Course) -> ListedCourse:
+    # Порядок полей — как в модели CourseInfo
+    return ListedCourse(
+        course=course,
+        head=b'{"id":%s,"title":%s,"description":%s,"rank_required":%d,"progress":' % (
+            _json(course.id), _json(course.title), _json(course.description), course.rank_required),
+        middle=b',"total_lessons":%d,"completed_lessons":' % course.total_lessons,
+    )
+
+
+def course_template(course: Course) -> CourseTemplate:
+    # Порядок полей — как в моделях CourseDetail, SectionInfo и LessonInfo
+    parts = []
+    lesson_ids = []
+    chunk = bytearray(b'{"id":%s,"title":%s,"description":%s,"rank_required":%d,"sections":[' % (
+        _json(course.id), _json(course.title), _json(course.description), course.rank_required))
+    for i, section in enumerate(course.sections):
+        chunk += b'%s{"id":%s,"title":%s,"lessons":[' % (b"," if i else b"", _json(section.id), _json(section.title))
+        for j, lesson in enumerate(section.lessons):
+            chunk += b'%s{"id":%s,"title":%s,"completed":' % (b"," if j else b"", _json(lesson.id), _json(lesson.title))
+            parts.append(bytes(chunk))
+            lesson_ids.append(lesson.id)
+            chunk = bytearray(b"}")
+        chunk += b"]}"
+    chunk += b'],"progress":'
+    parts.append(bytes(chunk))
+    return CourseTemplate(course=course, parts=parts, lesson_ids=lesson_ids)
+
+
+class CourseListingCache:
+    """Статичная часть ответов по курсам, уже в байтах.
+
+    Список курсов зависит только от уровня ранга (их четыре), детали курса — ни от
+    чего, кроме самого курса. Всё пересобирается, когда меняется catalog.version;
+    прогресс пользователя подставляется в готовые куски при ответе.
+    """
+
+    def __init__(self, catalog: CourseCatalog):
+        self.catalog = catalog
+        self._version = -1
+        self._items: List[ListedCourse] = []
+        self._levels: Dict[int, List[ListedCourse]] = {}
+        self._details: Dict[str, CourseTemplate] = {}
+
+    def _sync(self):
+        courses = self.catalog.courses()
+        if self.catalog.version == self._version:
+            return
+        self._items = [list_item(course) for course in courses]
+        self._levels = {}
+        self._details = {}
+        self._version = self.catalog.version
+
+    def courses(self, rank_level: int) -> List[ListedCourse]:
+        """Курсы, открытые на уровне rank_level, в порядке каталога"""
+        self._sync()
+        listed = self._levels.get(rank_level)
+        if listed is None:
+            listed = [item for item in self._items if item.course.rank_required <= rank_level]
+            self._levels[rank_level] = listed
+        return listed
+
+    def detail(self, course_id: str) -> Optional[CourseTemplate]:
+        self._sync()
+        template = self._details.get(course_id)
+        if template is None:
+            course = self.catalog.get_course(course_id)
+            if course is None:
+                return None
+            template = self._details[course_id] = course_template(course)
+        return template
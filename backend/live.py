@@ -0,0 +1,187 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from leaderboard import Board, LeaderboardCache, ScoreDelta, Snapshot, parse_score_deltas
+
+log = logging.getLogger(__name__)
+
+# Как часто (в секундах) слать в открытый поток комментарий-пинг, чтобы прокси не рвали соединение
+LEADERBOARD_STREAM_PING = float(os.getenv("LEADERBOARD_STREAM_PING", "15"))
+
+# Форматирование событий: (rank, row) → JSON. Модели ответов живут в main
+TopFormatter = Callable[[str, List[Tuple[int, tuple]]], str]
+MeFormatter = Callable[[str, Optional[Tuple[int, tuple]]], str]
+
+
+class Subscription:
+    """Открытый поток одного клиента.
+
+    Хранит только последнее состояние каждого типа события: медленный клиент
+    получит свежий топ, а не очередь всех промежуточных.
+    """
+
+    def __init__(self, group_id: int, period: str, user_id: int, top: int):
+        self.group_id = group_id
+        self.period = period
+        self.user_id = user_id
+        self.top = top
+        # (rank, score) пользователя, отправленные последними
+        self.sent_me: Optional[Tuple[int, int]] = None
+        self._events: Dict[str, str] = {}
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    @property
+    def board(self) -> Board:
+        return self.group_id, self.period
+
+    def push(self, event: str, data: str):
+        self._events[event] = data
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def next(self, timeout: float) -> List[Tuple[str, str]]:
+        """Накопившиеся события; пустой список — за timeout ничего не произошло"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._ready.clear()
+        events, self._events = list(self._events.items()), {}
+        return events
+
+
+class LiveLeaderboard:
+    """Раздаёт изменения лидерборда открытым потокам (SSE).
+
+    Уведомления score_delta приходят по одному LISTEN-соединению воркера и
+    применяются к снимкам LeaderboardCache; затем каждому потоку уходит новый топ,
+    если он изменился, и его собственное место, если оно сдвинулось. Потоки и топы
+    разделены по рейтингам (группа, период). Запросы к БД — только за профилями тех,
+    кто впервые попал в рейтинг, одним запросом на группу в пачке.
+    """
+
+    def __init__(self, cache: LeaderboardCache,
+                 fetch_profiles: Callable[[int, List[int]], Awaitable[Dict[int, tuple]]],
+                 format_top: TopFormatter, format_me: MeFormatter):
+        self.cache = cache
+        self.fetch_profiles = fetch_profiles
+        self.format_top = format_top
+        self.format_me = format_me
+        self._subscriptions: Dict[Board, Set[Subscription]] = {}
+        # (group_id, period, top) -> ((user_id, score) топа, событие), отправленные последними
+        self._tops: Dict[Tuple[int, str, int], Tuple[tuple, str]] = {}
+        self._queue: "asyncio.Queue[List[ScoreDelta]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # Перечитанный снимок мог разойтись с тем, что видели клиенты
+        cache.on_load = lambda board: self._fan_out({board})
+
+    # --- уведомления ---
+
+    def on_notify(self, payload: str):
+        """Обработчик NOTIFY score_delta (вызывается в event loop)"""
+        try:
+            self._queue.put_nowait(parse_score_deltas(payload))
+        except ValueError:
+            log.error("Malformed score delta", extra={"payload": payload[:200]})
+
+    def on_reconnect(self):
+        """Приросты за время обрыва потеряны: перечитываем снимки и рассылаем их заново"""
+        self.cache.invalidate()
+        for board, subscriptions in self._subscriptions.items():
+            if subscriptions:
+                asyncio.create_task(self._resync(board))
+
+    async def _resync(self, board: Board):
+        try:
+            # Разошлёт изменения через on_load
+            await self.cache.get(*board)
+        except Exception:
+            log.exception("Failed to reload leaderboard", extra={"group_id": board[0], "period": board[1]})
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.close()
+
+    async def _run(self):
+        while True:
+            deltas = await self._queue.get()
+            # Всё, что накопилось, пока обрабатывали прошлую пачку, — одним проходом
+            while not self._queue.empty():
+                deltas.extend(self._queue.get_nowait())
+            by_group: Dict[int, List[ScoreDelta]] = {}
+            for delta in deltas:
+                by_group.setdefault(delta.group_id, []).append(delta)
+            for group_id, group_deltas in by_group.items():
+                try:
+                    missing = self.cache.missing_users(group_id, (d.user_id for d in group_deltas))
+                    profiles = await self.fetch_profiles(group_id, sorted(missing)) if missing else {}
+                    self._fan_out(self.cache.apply(group_id, group_deltas, profiles))
+                except Exception:
+                    log.exception("Failed to apply score deltas",
+                                  extra={"group_id": group_id, "deltas": len(group_deltas)})
+
+    # --- потоки ---
+
+    def subscribe(self, group_id: int, period: str, user_id: int, top: int, snapshot: Snapshot) -> Subscription:
+        """Новый поток; первым событием сразу уходят текущий топ и место пользователя"""
+        subscription = Subscription(group_id, period, user_id, top)
+        self._subscriptions.setdefault(subscription.board, set()).add(subscription)
+        subscription.push("top", self._top_event(subscription.board, top, snapshot)[1])
+        mine = snapshot.rank_of(user_id)
+        subscription.sent_me = (mine[0], mine[1][1]) if mine else None
+        subscription.push("me", self.format_me(period, mine))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.board)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+
+    @property
+    def connections(self) -> int:
+        return sum(len(s) for s in self._subscriptions.values())
+
+    def _push_me(self, subscription: Subscription, snapshot: Snapshot):
+        mine = snapshot.rank_of(subscription.user_id)
+        state = (mine[0], mine[1][1]) if mine else None
+        if state != subscription.sent_me:
+            subscription.sent_me = state
+            subscription.push("me", self.format_me(subscription.period, mine))
+
+    def _top_event(self, board: Board, top: int, snapshot: Snapshot) -> Tuple[bool, str]:
+        """(изменился ли топ с прошлой рассылки, событие) — одно событие на всех с тем же top"""
+        page = snapshot.page(top)
+        key = tuple((row[0], row[1]) for _, row in page)
+        previous = self._tops.get(board + (top,))
+        if previous is not None and previous[0] == key:
+            return False, previous[1]
+        event = self.format_top(board[1], page)
+        self._tops[board + (top,)] = (key, event)
+        return True, event
+
+    def _fan_out(self, boards: Set[Board]):
+        for board in boards:
+            snapshot = self.cache.current(board)
+            subscriptions = self._subscriptions.get(board)
+            if snapshot is None or not subscriptions:
+                continue
+            tops: Dict[int, Tuple[bool, str]] = {}
+            for subscription in subscriptions:
+                if subscription.top not in tops:
+                    tops[subscription.top] = self._top_event(board, subscription.top, snapshot)
+                changed, event = tops[subscription.top]
+                if changed:
+                    subscription.push("top", event)
+                self._push_me(subscription, snapshot)
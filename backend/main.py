@@ -1,22 +1,50 @@
 import os
-import hmac
-import hashlib
-import json
+import asyncio
 import glob
-from urllib.parse import unquote, parse_qsl
-from fastapi import FastAPI, Depends, HTTPException, Header
-from pydantic import BaseModel
-import psycopg2
+import logging
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, TypeAdapter
 from typing import List, Optional, Literal
 from fastapi.middleware.cors import CORSMiddleware
-from psycopg2.extras import RealDictCursor
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import leaderboard
+from auth import InitDataVerifier, StreamTokens
+from catalog import Course, CourseCatalog
+from db import ConnectionPool, Database, PoolTimeout
+from delivery import EncodedBody, EncodedBodyCache, encoded_response, file_version
+from listing import CourseListingCache
+from live import LEADERBOARD_STREAM_PING, LiveLeaderboard
+from logs import setup_logging
+from media import MediaLibrary, media_response
+from metrics import MetricsMiddleware, register_pool, render_latest
+from notify import NotificationListener
+from progress import ProgressStore, count_completed
+from render import RENDER_CACHE_DIR, LessonRenderer
+from search import SearchIndex
+from snapshot import build_snapshot, load_snapshot
+from users import PROFILE_QUERY, SUBSCRIBER_CHANNEL, UserCache, UserContext
 
 # --- Настройки ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
-CONTENT_DIR = "/app/content" 
+CONTENT_DIR = os.getenv("CONTENT_DIR", "/app/content")
+# Снимок контента (python snapshot.py CONTENT_DIR CONTENT_SNAPSHOT --render) для быстрого старта
+# Лежит рядом с кэшем рендера, а не в CONTENT_DIR: там примонтирован репозиторий контента
+CONTENT_SNAPSHOT = os.getenv("CONTENT_SNAPSHOT", os.path.join(RENDER_CACHE_DIR, "content.snapshot"))
+# Если снимка нет или он устарел — записать свежий после старта, чтобы следующий старт был быстрым
+CONTENT_SNAPSHOT_AUTOWRITE = os.getenv("CONTENT_SNAPSHOT_AUTOWRITE", "1") == "1"
+# Группы (сообщества), которые обслуживает деплой, через запятую; первая — когда клиент не передал group.
+# GROUP_ID — старая настройка на одну группу
+GROUP_IDS = [int(x) for x in (os.getenv("GROUP_IDS") or os.getenv("GROUP_ID") or "").split(",") if x.strip()]
+if not GROUP_IDS:
+    raise RuntimeError("GROUP_IDS (or GROUP_ID) is not set")
+
+setup_logging()
+log = logging.getLogger("backend")
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
 
 # --- Настройка CORS ---
 origins = [
@@ -89,6 +117,47 @@ class LessonContent(BaseModel):
     course_id: str
     section_id: str
 
+class LessonCompletionRequest(BaseModel):
+    completed: bool = True
+
+class LessonCompletion(BaseModel):
+    course_id: str
+    lesson_id: str
+    completed: bool
+    progress: int
+    completed_lessons: int
+    total_lessons: int
+
+class TocItem(BaseModel):
+    level: int
+    id: str
+    title: str
+
+class LessonHtml(BaseModel):
+    id: str
+    title: str
+    html: str
+    toc: List[TocItem]
+    word_count: int
+    reading_time_minutes: int
+    course_id: str
+    section_id: str
+
+# МОДЕЛИ ПОИСКА
+class SearchResult(BaseModel):
+    course_id: str
+    course_title: str
+    lesson_id: str
+    lesson_title: str
+    section_id: str
+    snippet: str
+    score: float
+
+class SearchResponse(BaseModel):
+    query: str
+    total: int
+    results: List[SearchResult]
+
 # СТАРЫЕ МОДЕЛИ (для обратной совместимости)
 class ArticleInfo(BaseModel): 
     id: str
@@ -121,6 +190,35 @@ class CurrentUserRankInfo(BaseModel):
 class LeaderboardResponse(BaseModel):
     top_users: List[LeaderboardUserRow]
     current_user: Optional[CurrentUserRankInfo] = None
+    has_more: bool = False
+
+class LeaderboardAroundResponse(BaseModel):
+    # Соседи сверху, сам пользователь и соседи снизу — по порядку мест
+    users: List[LeaderboardUserRow]
+    current_user: Optional[CurrentUserRankInfo] = None
+    has_more_above: bool = False
+    has_more_below: bool = False
+
+# События потока /api/leaderboard/stream
+class LeaderboardTopEvent(BaseModel):
+    period: str
+    top_users: List[LeaderboardUserRow]
+
+class LeaderboardMeEvent(BaseModel):
+    period: str
+    current_user: Optional[CurrentUserRankInfo] = None
+
+class StreamTokenResponse(BaseModel):
+    # ?token= для /api/leaderboard/stream; действует expires_in секунд
+    token: str
+    expires_in: int
+
+# МОДЕЛЬ BOOTSTRAP (в ответе только запрошенные поля)
+class BootstrapResponse(BaseModel):
+    me: Optional[UserData] = None
+    ranks: Optional[List[RankInfo]] = None
+    courses: Optional[List[CourseInfo]] = None
+    leaderboard: Optional[LeaderboardResponse] = None
 
 # --- Логика Рангов ---
 RANKS = [
@@ -145,331 +243,381 @@ def get_rank_level(points: int) -> int:
     return 1
 
 # --- Утилиты ---
-def get_db_connection():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    try: 
-        yield conn
-    finally: 
-        conn.close()
-
-def validate_init_data(init_data: str, bot_token: str) -> Optional[dict]:
-    try:
-        parsed_data = dict(parse_qsl(init_data))
-        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed_data.items()) if k != "hash")
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        h = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256)
-        if h.hexdigest() == parsed_data["hash"]: 
-            return json.loads(unquote(parsed_data.get("user", "{}")))
-    except Exception: 
-        return None
+init_data_verifier = InitDataVerifier(BOT_TOKEN)
+stream_tokens = StreamTokens(BOT_TOKEN)
 
 async def get_current_user(x_init_data: str = Header(None)):
     if not x_init_data: 
         raise HTTPException(status_code=401, detail="X-Init-Data header is missing")
-    user_data = validate_init_data(x_init_data, BOT_TOKEN)
+    user_data = init_data_verifier.verify(x_init_data)
     if not user_data: 
         raise HTTPException(status_code=401, detail="Invalid InitData")
     return user_data
 
-# --- НОВЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С КУРСАМИ ---
-
-def load_course_metadata(course_path: str) -> dict:
-    """Загружает метаданные курса из course.json"""
-    metadata_file = os.path.join(course_path, "course.json")
-    if os.path.exists(metadata_file):
-        try:
-            with open(metadata_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"ERROR: Failed to load course.json from {metadata_file}: {e}")
-    
-    # Fallback для старых статей
-    course_id = os.path.basename(course_path)
-    return {
-        "title": f"Курс {course_id}",
-        "description": "Описание курса",
-        "rank_required": 1,
-        "sections": [
-            {
-                "id": "main",
-                "title": "Основной раздел", 
-                "lessons": []
-            }
-        ]
-    }
+async def get_stream_user(token: str = Query(None), x_init_data: str = Header(None)):
+    """Как get_current_user, но EventSource, который не умеет заголовки, передаёт в query
+    короткоживущий токен из POST /api/leaderboard/stream-token, а не initData"""
+    if token is None:
+        return await get_current_user(x_init_data)
+    user_id = stream_tokens.verify(token)
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid stream token")
+    return {"id": user_id}
+
+async def get_group(group: Optional[int] = Query(None, description="id группы; по умолчанию — первая из GROUP_IDS")) -> int:
+    """Группа (сообщество), чей рейтинг и очки нужны запросу"""
+    if group is None:
+        return GROUP_IDS[0]
+    if group not in GROUP_IDS:
+        raise HTTPException(status_code=404, detail="Группа не найдена")
+    return group
+
+# --- ПУЛ СОЕДИНЕНИЙ ---
+
+db_pool = ConnectionPool(DATABASE_URL)
+database = Database(db_pool)
+register_pool(db_pool)
+
+def get_db() -> Database:
+    return database
+
+progress_store = ProgressStore(database)
+
+@app.on_event("startup")
+async def open_db_pool():
+    await run_in_threadpool(db_pool.open)
+    await progress_store.setup()
+    progress_store.start()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    # Сначала дописываем накопленные отметки прогресса, потом закрываем пул
+    await progress_store.stop()
+    await run_in_threadpool(db_pool.close)
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": "База данных перегружена, попробуйте позже"})
+
+@app.get("/api/health/db")
+async def get_db_pool_stats():
+    """Размер пула и время ожидания соединения"""
+    return db_pool.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    content, media_type = render_latest()
+    return Response(content=content, media_type=media_type)
+
+# --- УВЕДОМЛЕНИЯ ОТ КОЛЛЕКТОРА ---
+
+notifications = NotificationListener(DATABASE_URL)
+
+@app.on_event("startup")
+async def start_notifications():
+    await notifications.start()
+
+@app.on_event("shutdown")
+async def stop_notifications():
+    await notifications.stop()
+
+# --- КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ---
+
+user_cache = UserCache()
+notifications.subscribe(SUBSCRIBER_CHANNEL, user_cache.on_notify)
+# Пока LISTEN-соединение лежало, уведомления терялись — кэшу больше нельзя верить
+notifications.on_reconnect(user_cache.invalidate)
+
+async def get_user_context(user: dict = Depends(get_current_user), group_id: int = Depends(get_group),
+                           db: Database = Depends(get_db)) -> UserContext:
+    """Очки, уровень ранга и строка подписчика в группе — один раз на запрос, с кэшем по (group_id, telegram_id)"""
+    user_id = user.get("id")
+    profile = user_cache.get(group_id, user_id)
+    if profile is UserCache.MISSING:
+        profile = await db.fetchone(PROFILE_QUERY, (group_id, user_id))
+        user_cache.put(group_id, user_id, profile)
+    
+    points = (profile['message_count'] * 2) if profile and profile['message_count'] is not None else 0
+    return UserContext(
+        id=user_id,
+        group_id=group_id,
+        init_data=user,
+        profile=profile,
+        points=points,
+        rank_level=get_rank_level(points),
+    )
 
-def scan_course_lessons(course_path: str, sections: list) -> list:
-    """Сканирует уроки в курсе и обновляет секции"""
-    updated_sections = []
-    
-    for section in sections:
-        section_path = os.path.join(course_path, section["id"])
-        lessons = []
-        
-        if os.path.exists(section_path):
-            # Ищем .md файлы в папке секции
-            for md_file in glob.glob(os.path.join(section_path, "*.md")):
-                lesson_id = os.path.splitext(os.path.basename(md_file))[0]
-                
-                # Читаем заголовок из первой строки
-                try:
-                    with open(md_file, 'r', encoding='utf-8') as f:
-                        first_line = f.readline().strip()
-                        title = first_line.lstrip('#').strip() if first_line.startswith('#') else lesson_id
-                except Exception as e:
-                    print(f"ERROR: Failed to read {md_file}: {e}")
-                    title = lesson_id
-                
-                lessons.append({
-                    "id": lesson_id,
-                    "title": title
-                })
-        
-        updated_sections.append({
-            "id": section["id"],
-            "title": section["title"],
-            "lessons": lessons
+# --- КАТАЛОГ КУРСОВ ---
+
+catalog = CourseCatalog(CONTENT_DIR)
+# Готовые (сериализованные и сжатые) тела уроков и статей по версии файла
+content_cache = EncodedBodyCache()
+
+async def cached_body(key: str, version: tuple, build) -> EncodedBody:
+    """Тело из content_cache; промах (чтение, рендер, сжатие) собирается в пуле потоков, не в event loop"""
+    encoded = content_cache.peek(key, version)
+    if encoded is None:
+        encoded = await run_in_threadpool(content_cache.get, key, version, build)
+    return encoded
+# Готовые байты списка курсов (по уровню ранга) и деталей курса без прогресса
+course_listing = CourseListingCache(catalog)
+lesson_renderer = LessonRenderer()
+search_index = SearchIndex()
+content_snapshot = None
+# Картинки и файлы из папок курсов: в тексте уроков ссылки на них заменяются хэшированными URL
+media_library = MediaLibrary(CONTENT_DIR)
+lesson_renderer.rewrite = media_library.rewrite
+
+def prerender_lessons():
+    """Рендерит все уроки заранее, чтобы первое открытие не ждало markdown"""
+    for course in catalog.courses():
+        for lesson in course.lessons.values():
+            try:
+                lesson_renderer.render_file(lesson.path)
+            except Exception:
+                log.exception("Failed to prerender lesson", extra={"path": lesson.path})
+
+def write_content_snapshot():
+    try:
+        lessons = build_snapshot(catalog.courses(), CONTENT_SNAPSHOT, lesson_renderer)
+        log.info("Content snapshot written", extra={"path": CONTENT_SNAPSHOT, "lessons": lessons})
+    except Exception:
+        log.exception("Failed to write content snapshot", extra={"path": CONTENT_SNAPSHOT})
+
+def warm_up_content(write_snapshot: bool):
+    # Хэши медиа считаем заранее: рендер урока (и его ссылок) их только находит
+    media_library.scan()
+    prerender_lessons()
+    if write_snapshot:
+        write_content_snapshot()
+
+def sync_search_index():
+    courses = catalog.courses()
+    search_index.sync(courses, catalog.version)
+
+@app.on_event("startup")
+async def build_catalog():
+    global content_snapshot
+    content_snapshot = load_snapshot(CONTENT_SNAPSHOT)
+    lesson_renderer.snapshot = search_index.snapshot = content_snapshot
+    catalog.build(content_snapshot)
+    stale = content_snapshot is None or content_snapshot.misses > 0
+    if content_snapshot is not None:
+        log.info("Content snapshot loaded", extra={
+            "path": CONTENT_SNAPSHOT, "built_at": content_snapshot.built_at,
+            "courses_reused": content_snapshot.hits, "courses_rebuilt": content_snapshot.misses,
         })
-    
-    return updated_sections
+    app.state.catalog_watcher = asyncio.create_task(catalog.watch())
+    asyncio.create_task(run_in_threadpool(warm_up_content, stale and CONTENT_SNAPSHOT_AUTOWRITE))
+    asyncio.create_task(run_in_threadpool(sync_search_index))
+
+@app.on_event("shutdown")
+async def stop_catalog_watcher():
+    app.state.catalog_watcher.cancel()
 
 # --- НОВЫЕ ЭНДПОИНТЫ ДЛЯ КУРСОВ ---
 
-@app.get("/api/courses", response_model=List[CourseInfo])
-async def get_courses(user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
-    """Получить список всех доступных курсов"""
-    user_id = user.get("id")
-    print(f"DEBUG: Getting courses for user {user_id}")
-    
-    # Получаем данные пользователя
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
-    user_rank_level = get_rank_level(points)
-    
-    print(f"DEBUG: User points: {points}, rank level: {user_rank_level}")
-    print(f"DEBUG: Content directory: {CONTENT_DIR}")
+async def course_progress(course: Course, bitmap: int):
+    """(пройдено уроков, процент) по bitmap пользователя"""
+    ordinals = await progress_store.ordinals(course.id, list(course.lessons))
+    completed = count_completed(bitmap, [ordinals[lesson_id] for lesson_id in course.lessons])
+    total = course.total_lessons
+    return completed, (completed * 100 // total) if total else 0
+
+async def build_course_list(ctx: UserContext) -> bytes:
+    """JSON-список курсов, доступных пользователю по уровню ранга (List[CourseInfo])"""
+    # Прогресс по всем курсам — одним запросом
+    bitmaps = await progress_store.user_bitmaps(ctx.id)
     
     courses = []
+    for item in course_listing.courses(ctx.rank_level):
+        completed_lessons, progress = await course_progress(item.course, bitmaps.get(item.course.id, 0))
+        courses.append(item.render(progress, completed_lessons))
     
-    # Проверяем существование папки content
-    if not os.path.exists(CONTENT_DIR):
-        print(f"ERROR: Content directory {CONTENT_DIR} does not exist")
-        return courses
-    
-    # Ищем папки курсов
-    try:
-        items = os.listdir(CONTENT_DIR)
-        print(f"DEBUG: Items in content directory: {items}")
-        
-        for item in items:
-            course_path = os.path.join(CONTENT_DIR, item)
-            print(f"DEBUG: Checking item: {item}, path: {course_path}")
-            
-            if os.path.isdir(course_path):
-                print(f"DEBUG: Found directory: {item}")
-                
-                # Загружаем метаданные курса
-                metadata = load_course_metadata(course_path)
-                print(f"DEBUG: Loaded metadata for {item}: {metadata}")
-                
-                # Проверяем доступ
-                course_rank_required = metadata.get("rank_required", 1)
-                print(f"DEBUG: Course {item} requires rank {course_rank_required}, user has level {user_rank_level}")
-                
-                if course_rank_required <= user_rank_level:
-                    # Подсчитываем уроки
-                    sections = scan_course_lessons(course_path, metadata.get("sections", []))
-                    total_lessons = sum(len(section["lessons"]) for section in sections)
-                    
-                    print(f"DEBUG: Course {item} has {total_lessons} lessons")
-                    
-                    courses.append(CourseInfo(
-                        id=item,
-                        title=metadata.get("title", item),
-                        description=metadata.get("description", ""),
-                        rank_required=metadata.get("rank_required", 1),
-                        progress=0,  # TODO: Добавить реальный прогресс
-                        total_lessons=total_lessons,
-                        completed_lessons=0  # TODO: Добавить реальный прогресс
-                    ))
-                else:
-                    print(f"DEBUG: Course {item} not accessible - rank {course_rank_required} > user level {user_rank_level}")
-    except Exception as e:
-        print(f"ERROR: Failed to scan courses: {e}")
-    
-    print(f"DEBUG: Returning {len(courses)} courses")
-    return courses
+    log.debug("Courses listed", extra={"user_id": ctx.id, "rank_level": ctx.rank_level, "count": len(courses)})
+    return b"[" + b",".join(courses) + b"]"
+
+@app.get("/api/courses", response_model=List[CourseInfo])
+async def get_courses(ctx: UserContext = Depends(get_user_context)):
+    """Получить список всех доступных курсов"""
+    return Response(content=await build_course_list(ctx), media_type="application/json")
 
 @app.get("/api/courses/{course_id}", response_model=CourseDetail)
-async def get_course_detail(course_id: str, user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
+async def get_course_detail(course_id: str, ctx: UserContext = Depends(get_user_context)):
     """Получить детальную информацию о курсе"""
-    user_id = user.get("id")
-    course_path = os.path.join(CONTENT_DIR, course_id)
-    
-    print(f"DEBUG: Getting course detail for {course_id}, path: {course_path}")
-    
-    if not os.path.exists(course_path):
-        print(f"ERROR: Course path {course_path} does not exist")
+    template = course_listing.detail(course_id)
+    if template is None:
         raise HTTPException(status_code=404, detail="Курс не найден")
+    course = template.course
     
-    # Проверяем доступ пользователя
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
-    user_rank_level = get_rank_level(points)
-    
-    # Загружаем метаданные
-    metadata = load_course_metadata(course_path)
-    
-    if metadata.get("rank_required", 1) > user_rank_level:
+    if course.rank_required > ctx.rank_level:
         raise HTTPException(status_code=403, detail="Недостаточно прав для доступа к курсу")
     
-    # Сканируем уроки
-    sections = scan_course_lessons(course_path, metadata.get("sections", []))
+    bitmap = await progress_store.course_bitmap(ctx.id, course.id)
+    ordinals = await progress_store.ordinals(course.id, list(course.lessons))
+    _, progress = await course_progress(course, bitmap)
     
-    return CourseDetail(
-        id=course_id,
-        title=metadata.get("title", course_id),
-        description=metadata.get("description", ""),
-        rank_required=metadata.get("rank_required", 1),
-        sections=sections,
-        progress=0  # TODO: Добавить реальный прогресс
-    )
+    completed = [bool((bitmap >> ordinals[lesson_id]) & 1) for lesson_id in template.lesson_ids]
+    return Response(content=template.render(completed, progress), media_type="application/json")
 
-@app.get("/api/courses/{course_id}/lessons/{lesson_id}", response_model=LessonContent)
-async def get_lesson_content(course_id: str, lesson_id: str, user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
-    """Получить содержимое конкретного урока"""
-    user_id = user.get("id")
-    course_path = os.path.join(CONTENT_DIR, course_id)
-    
-    print(f"DEBUG: Getting lesson {lesson_id} from course {course_id}")
-    
-    if not os.path.exists(course_path):
+def resolve_lesson(course_id: str, lesson_id: str, ctx: UserContext):
+    """Находит урок в каталоге, проверяет доступ и возвращает версию его файла"""
+    course, lesson = catalog.get_lesson(course_id, lesson_id)
+    if course is None:
         raise HTTPException(status_code=404, detail="Курс не найден")
     
-    # Проверяем доступ
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
-    user_rank_level = get_rank_level(points)
-    
-    metadata = load_course_metadata(course_path)
-    if metadata.get("rank_required", 1) > user_rank_level:
+    if course.rank_required > ctx.rank_level:
         raise HTTPException(status_code=403, detail="Недостаточно прав")
     
-    # Ищем файл урока
-    lesson_file = None
-    section_id = None
-    
-    for section in metadata.get("sections", []):
-        section_path = os.path.join(course_path, section["id"])
-        potential_file = os.path.join(section_path, f"{lesson_id}.md")
-        
-        if os.path.exists(potential_file):
-            lesson_file = potential_file
-            section_id = section["id"]
-            break
-    
-    if not lesson_file:
+    if lesson is None:
         raise HTTPException(status_code=404, detail="Урок не найден")
     
-    # Читаем содержимое
-    try:
-        with open(lesson_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Извлекаем заголовок из первой строки
-            lines = content.split('\n')
-            title = lines[0].lstrip('#').strip() if lines and lines[0].startswith('#') else lesson_id
-    except Exception as e:
-        print(f"ERROR: Failed to read lesson file {lesson_file}: {e}")
+    version = file_version(lesson.path)
+    if version is None:
+        log.error("Lesson file is missing", extra={"path": lesson.path})
         raise HTTPException(status_code=500, detail="Ошибка чтения файла урока")
+    return course, lesson, version
+
+async def lesson_body_version(lesson, version: tuple) -> tuple:
+    """Ключ кэша тела урока: версия файла и медиа из его ссылок (ссылки читаются в пуле потоков)"""
+    return version + await run_in_threadpool(media_library.version, lesson.path)
+
+@app.get("/api/courses/{course_id}/lessons/{lesson_id}", response_model=LessonContent)
+async def get_lesson_content(course_id: str, lesson_id: str, request: Request, ctx: UserContext = Depends(get_user_context)):
+    """Получить содержимое конкретного урока"""
+    course, lesson, version = resolve_lesson(course_id, lesson_id, ctx)
+    version = await lesson_body_version(lesson, version)
     
-    return LessonContent(
-        id=lesson_id,
-        title=title,
-        content=content,
-        course_id=course_id,
-        section_id=section_id
+    def render() -> bytes:
+        # Читаем содержимое (только при первой выдаче этой версии урока)
+        try:
+            content = lesson_renderer.source(lesson.path)
+        except Exception:
+            log.exception("Failed to read lesson file", extra={"path": lesson.path})
+            raise HTTPException(status_code=500, detail="Ошибка чтения файла урока")
+        return LessonContent(
+            id=lesson.id,
+            title=lesson.title,
+            content=content,
+            course_id=course.id,
+            section_id=lesson.section_id
+        ).model_dump_json().encode()
+    
+    encoded = await cached_body(f"lesson:{course.id}/{lesson.id}", version + (lesson.section_id,), render)
+    return encoded_response(request, encoded)
+
+@app.post("/api/courses/{course_id}/lessons/{lesson_id}/complete", response_model=LessonCompletion)
+async def mark_lesson_completed(course_id: str, lesson_id: str, body: LessonCompletionRequest = LessonCompletionRequest(), ctx: UserContext = Depends(get_user_context)):
+    """Отметить урок пройденным (или снять отметку: {"completed": false})"""
+    course, lesson, _ = resolve_lesson(course_id, lesson_id, ctx)
+    
+    ordinals = await progress_store.ordinals(course.id, list(course.lessons))
+    # Запись в БД уйдёт пачкой; чтения уже видят отметку
+    progress_store.mark(ctx.id, course.id, ordinals[lesson.id], body.completed)
+    
+    bitmap = await progress_store.course_bitmap(ctx.id, course.id)
+    completed_lessons, progress = await course_progress(course, bitmap)
+    return LessonCompletion(
+        course_id=course.id,
+        lesson_id=lesson.id,
+        completed=body.completed,
+        progress=progress,
+        completed_lessons=completed_lessons,
+        total_lessons=course.total_lessons
+    )
+
+@app.get("/api/courses/{course_id}/lessons/{lesson_id}/html", response_model=LessonHtml)
+async def get_lesson_html(course_id: str, lesson_id: str, request: Request, ctx: UserContext = Depends(get_user_context)):
+    """Урок, отрендеренный на сервере: санитизированный HTML, оглавление и время чтения"""
+    course, lesson, version = resolve_lesson(course_id, lesson_id, ctx)
+    version = await lesson_body_version(lesson, version)
+    
+    def render() -> bytes:
+        try:
+            rendered = lesson_renderer.render_file(lesson.path)
+        except Exception:
+            log.exception("Failed to render lesson file", extra={"path": lesson.path})
+            raise HTTPException(status_code=500, detail="Ошибка чтения файла урока")
+        return LessonHtml(
+            id=lesson.id,
+            title=lesson.title,
+            html=rendered.html,
+            toc=[TocItem(level=t.level, id=t.id, title=t.title) for t in rendered.toc],
+            word_count=rendered.word_count,
+            reading_time_minutes=rendered.reading_time_minutes,
+            course_id=course.id,
+            section_id=lesson.section_id
+        ).model_dump_json().encode()
+    
+    # Промах — markdown, nh3 и оба сжатия — идёт в пуле потоков
+    encoded = await cached_body(f"lesson-html:{course.id}/{lesson.id}", version + (lesson.section_id,), render)
+    return encoded_response(request, encoded)
+
+@app.api_route("/media/{digest}/{name}", methods=["GET", "HEAD"], include_in_schema=False)
+async def get_media(digest: str, name: str, request: Request):
+    """Картинка или файл из папки курса по хэшу содержимого (ссылки — в тексте уроков)"""
+    asset = await run_in_threadpool(media_library.lookup, digest)
+    if asset is None or asset.name != name:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return media_response(request, asset)
+
+@app.get("/api/search", response_model=SearchResponse)
+async def search_lessons(
+    q: str = Query(..., min_length=2, max_length=200),
+    limit: int = Query(20, ge=1, le=50),
+    ctx: UserContext = Depends(get_user_context)
+):
+    """Поиск по заголовкам и текстам уроков доступных пользователю курсов"""
+    if search_index.catalog_version != catalog.version:
+        # Каталог изменился — доиндексируем изменившиеся курсы
+        await run_in_threadpool(sync_search_index)
+    
+    total, hits = search_index.search(q, ctx.rank_level, limit)
+    return SearchResponse(
+        query=q,
+        total=total,
+        results=[SearchResult(**vars(hit)) for hit in hits]
     )
 
 # --- СТАРЫЕ ЭНДПОИНТЫ (для обратной совместимости) ---
 
 @app.get("/api/content", response_model=List[ArticleInfo])
-async def get_content_list_legacy(user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
+async def get_content_list_legacy(ctx: UserContext = Depends(get_user_context)):
     """Старый эндпоинт для обратной совместимости"""
-    user_id = user.get("id")
-    print(f"DEBUG: User ID: {user_id}")
-    
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
-    user_rank_level = get_rank_level(points)
-    
-    print(f"DEBUG: User points: {points}, rank level: {user_rank_level}")
-    
     # Ищем старые .md файлы в корне
     available_articles = []
     search_path = os.path.join(CONTENT_DIR, "*.md")
-    print(f"DEBUG: Searching in: {search_path}")
     
     found_files = glob.glob(search_path)
-    print(f"DEBUG: Found files: {found_files}")
     
     for filepath in found_files:
         filename = os.path.basename(filepath)
-        print(f"DEBUG: Processing file: {filename}")
         try:
             parts = filename.split('__')
             if len(parts) >= 2:
                 rank_required = int(parts[0])
                 article_id = parts[1].replace('.md', '')
-                print(f"DEBUG: File requires rank {rank_required}, article_id: {article_id}")
                 
-                if rank_required <= user_rank_level:
+                if rank_required <= ctx.rank_level:
                     with open(filepath, 'r', encoding='utf-8') as f:
                         title = f.readline().strip().lstrip('#').strip()
-                    print(f"DEBUG: Article accessible: {article_id} - {title}")
                     available_articles.append(ArticleInfo(
                         id=article_id, 
                         title=title, 
                         rank_required=rank_required
                     ))
-                else:
-                    print(f"DEBUG: Article NOT accessible: rank {rank_required} > user level {user_rank_level}")
-        except (ValueError, IndexError) as e:
-            print(f"DEBUG: Error processing {filename}: {e}")
+        except (ValueError, IndexError):
+            log.debug("Skipping legacy article with unexpected name", extra={"file": filename})
             continue
     
     available_articles.sort(key=lambda x: x.rank_required)
-    print(f"DEBUG: Final articles list: {[a.id for a in available_articles]}")
+    log.debug("Legacy articles listed", extra={"user_id": ctx.id, "count": len(available_articles)})
     return available_articles
 
 @app.get("/api/content/{article_id}", response_model=ArticleContent)
-async def get_article_legacy(article_id: str, user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
+async def get_article_legacy(article_id: str, request: Request, ctx: UserContext = Depends(get_user_context)):
     """Старый эндпоинт для обратной совместимости"""
-    user_id = user.get("id")
-    
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
-    user_rank_level = get_rank_level(points)
-    
     # Ищем файл статьи
     search_pattern = os.path.join(CONTENT_DIR, f"*__{article_id}.md")
     found_files = glob.glob(search_pattern)
@@ -485,70 +633,86 @@ async def get_article_legacy(article_id: str, user: dict = Depends(get_current_u
     except (ValueError, IndexError): 
         raise HTTPException(status_code=500, detail="Invalid file name")
     
-    if user_rank_level < target_rank_required: 
+    if ctx.rank_level < target_rank_required: 
         raise HTTPException(status_code=403, detail="Недостаточно прав")
     
-    with open(found_path, 'r', encoding='utf-8') as f: 
-        content = f.read()
+    version = file_version(found_path)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Статья не найдена")
     
-    return ArticleContent(id=article_id, content=content)
+    def render() -> bytes:
+        with open(found_path, 'r', encoding='utf-8') as f: 
+            content = f.read()
+        return ArticleContent(id=article_id, content=content).model_dump_json().encode()
+    
+    encoded = await cached_body(f"article:{found_path}", version, render)
+    return encoded_response(request, encoded)
 
 # --- ОСТАЛЬНЫЕ ЭНДПОИНТЫ (лидерборд, профиль, ранги) ---
 
-@app.get("/api/leaderboard", response_model=LeaderboardResponse)
-async def get_leaderboard_by_period(
-    period: Literal['7d', '30d', 'all'] = '7d',
-    user: dict = Depends(get_current_user), 
-    db=Depends(get_db_connection)
-):
-    current_user_id = user.get("id")
-    
-    interval_map = {'7d': "INTERVAL '7 days'", '30d': "INTERVAL '30 days'"}
-    date_filter_sql = f"WHERE m.message_date >= NOW() - {interval_map[period]}" if period in interval_map else ""
-
-    query = f"""
-        WITH user_scores AS (
-            SELECT
-                user_id,
-                SUM(points) AS total_score
-            FROM messages m
-            {date_filter_sql}
-            GROUP BY user_id
-        ),
-        ranked_users AS (
-            SELECT
-                s.user_id,
-                s.total_score,
-                cs.first_name,
-                cs.last_name,
-                cs.username,
-                cs.photo_url,
-                RANK() OVER (ORDER BY s.total_score DESC, s.user_id) as rank
-            FROM user_scores s
-            JOIN channel_subscribers cs ON cs.telegram_id = s.user_id
-            WHERE cs.is_active = TRUE
-        )
-        SELECT * FROM ranked_users;
-    """
-    
-    if period == 'all':
-        query = """
-            SELECT
-                telegram_id as user_id,
-                first_name,
-                last_name,
-                username,
-                photo_url,
-                (message_count * 2) as total_score,
-                RANK() OVER (ORDER BY message_count DESC, telegram_id) as rank
-            FROM channel_subscribers
-            WHERE is_active = TRUE AND message_count > 0;
-        """
-
-    cur = db.cursor()
-    cur.execute(query)
-    all_users = cur.fetchall()
-    cur.close()
+async def load_leaderboard_snapshot(group_id: int, period: str):
+    return await database.run(leaderboard.fetch_snapshot, group_id, period)
+
+leaderboard_cache = leaderboard.LeaderboardCache(load_leaderboard_snapshot)
+# Пока коллектор шлёт приросты очков, снимки двигаются ими и почти не перечитываются
+leaderboard_cache.is_live = lambda: notifications.connected
+
+async def fetch_leaderboard_profiles(group_id: int, user_ids: List[int]) -> dict:
+    return await database.run(leaderboard.fetch_profiles, group_id, user_ids)
+
+def leaderboard_user_row(rank: int, row: tuple) -> LeaderboardUserRow:
+    """Строка снимка (user_id, score, first_name, last_name, username, photo_url) → модель ответа"""
+    return LeaderboardUserRow(rank=rank, user_id=row[0], score=row[1], first_name=row[2],
+                              last_name=row[3], username=row[4], photo_url=row[5])
+
+def leaderboard_top_event(period: str, page: list) -> str:
+    return LeaderboardTopEvent(period=period, top_users=[leaderboard_user_row(rank, row) for rank, row in page]).model_dump_json()
+
+def leaderboard_me_event(period: str, mine: Optional[tuple]) -> str:
+    current_user = CurrentUserRankInfo(**leaderboard_user_row(*mine).model_dump()) if mine else None
+    return LeaderboardMeEvent(period=period, current_user=current_user).model_dump_json()
+
+live_leaderboard = LiveLeaderboard(leaderboard_cache, fetch_leaderboard_profiles,
+                                   leaderboard_top_event, leaderboard_me_event)
+notifications.subscribe(leaderboard.SCORE_CHANNEL, live_leaderboard.on_notify)
+notifications.on_reconnect(live_leaderboard.on_reconnect)
+
+@app.on_event("startup")
+async def start_live_leaderboard():
+    live_leaderboard.start()
+
+@app.on_event("shutdown")
+async def stop_live_leaderboard():
+    await live_leaderboard.stop()
+
+def leaderboard_row(rank: int, row: tuple) -> dict:
+    user_id, total_score, first_name, last_name, username, photo_url = row
+    return {
+        'rank': rank,
+        'user_id': user_id,
+        'total_score': total_score,
+        'first_name': first_name,
+        'last_name': last_name,
+        'username': username,
+        'photo_url': photo_url,
+    }
+
+async def build_leaderboard(group_id: int, current_user_id: int, period: str, limit: int = 20, after_rank: int = 0,
+                            after_score: Optional[int] = None, after_user_id: Optional[int] = None) -> LeaderboardResponse:
+    """Страница лидерборда группы за период и место пользователя"""
+    if leaderboard_cache.enabled:
+        # Общий для всех снимок: место пользователя берём из его карты мест
+        snapshot = await leaderboard_cache.get(group_id, period)
+        page = [leaderboard_row(rank, row) for rank, row in snapshot.page(limit + 1, after_rank, after_score, after_user_id)]
+        mine = snapshot.rank_of(current_user_id)
+        me = leaderboard_row(*mine) if mine else None
+    else:
+        def _fetch(cur):
+            page = leaderboard.fetch_page(cur, group_id, period, limit + 1, after_rank, after_score, after_user_id)
+            me = leaderboard.fetch_user_rank(cur, group_id, period, current_user_id)
+            return page, me
+
+        page, me = await database.run(_fetch)
 
     top_users = [
         LeaderboardUserRow(
@@ -559,34 +723,107 @@ async def get_leaderboard_by_period(
             username=u['username'],
             photo_url=u['photo_url'],
             score=u['total_score']
-        ) for u in all_users[:20]
+        ) for u in page[:limit]
     ]
 
     current_user_data = None
-    for u in all_users:
-        if u['user_id'] == current_user_id:
-            current_user_data = CurrentUserRankInfo(
-                rank=u['rank'], 
-                user_id=u['user_id'],
-                first_name=u['first_name'],
-                last_name=u['last_name'],
-                username=u['username'],
-                photo_url=u['photo_url'],
-                score=u['total_score']
-            )
-            break
-
-    return LeaderboardResponse(top_users=top_users, current_user=current_user_data)
+    if me:
+        current_user_data = CurrentUserRankInfo(
+            rank=me['rank'], 
+            user_id=me['user_id'],
+            first_name=me['first_name'],
+            last_name=me['last_name'],
+            username=me['username'],
+            photo_url=me['photo_url'],
+            score=me['total_score']
+        )
 
-@app.get("/api/me", response_model=UserData)
-async def get_me(user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
+    return LeaderboardResponse(top_users=top_users, current_user=current_user_data, has_more=len(page) > limit)
+
+@app.get("/api/leaderboard", response_model=LeaderboardResponse)
+async def get_leaderboard_by_period(
+    period: Literal['7d', '30d', 'all'] = '7d',
+    limit: int = Query(20, ge=1, le=100),
+    after_rank: int = Query(0, ge=0),
+    after_score: Optional[int] = None,
+    after_user_id: Optional[int] = None,
+    group_id: int = Depends(get_group),
+    user: dict = Depends(get_current_user)
+):
+    """Топ группы за период и место текущего пользователя.
+
+    Следующая страница: after_rank/after_score/after_user_id последней строки предыдущей.
+    """
+    return await build_leaderboard(group_id, user.get("id"), period, limit, after_rank, after_score, after_user_id)
+
+@app.get("/api/leaderboard/around-me", response_model=LeaderboardAroundResponse)
+async def get_leaderboard_around_me(
+    period: Literal['7d', '30d', 'all'] = '7d',
+    radius: int = Query(5, ge=1, le=50),
+    group_id: int = Depends(get_group),
+    user: dict = Depends(get_current_user)
+):
+    """radius участников выше и ниже текущего пользователя; пустой список, если у него ещё нет очков"""
     user_id = user.get("id")
-    cur = db.cursor()
-    cur.execute("SELECT first_name, last_name, username, message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
+    if leaderboard_cache.enabled:
+        # Позиция — из карты мест снимка, соседи — срез упорядоченного списка
+        snapshot = await leaderboard_cache.get(group_id, period)
+        rows, has_above, has_below = snapshot.around(user_id, radius)
+    else:
+        rows, has_above, has_below = await database.run(leaderboard.fetch_around, group_id, period, user_id, radius)
+
+    mine = next(((rank, row) for rank, row in rows if row[0] == user_id), None)
+    return LeaderboardAroundResponse(
+        users=[leaderboard_user_row(rank, row) for rank, row in rows],
+        current_user=CurrentUserRankInfo(**leaderboard_user_row(*mine).model_dump()) if mine else None,
+        has_more_above=has_above,
+        has_more_below=has_below,
+    )
+
+@app.post("/api/leaderboard/stream-token", response_model=StreamTokenResponse)
+async def issue_stream_token(user: dict = Depends(get_current_user)):
+    """Токен для открытия потока лидерборда: initData в URL попала бы в логи доступа"""
+    return StreamTokenResponse(token=stream_tokens.issue(user["id"]), expires_in=stream_tokens.ttl)
+
+@app.get("/api/leaderboard/stream")
+async def stream_leaderboard(
+    period: Literal['7d', '30d', 'all'] = '7d',
+    top: int = Query(10, ge=1, le=100),
+    group_id: int = Depends(get_group),
+    user: dict = Depends(get_stream_user)
+):
+    """Server-Sent Events: `top` — топ-N при каждом его изменении, `me` — место пользователя, когда оно сдвинулось.
+
+    Первыми приходят текущие top и me; дальше только изменения.
+    """
+    if not leaderboard_cache.enabled:
+        raise HTTPException(status_code=503, detail="Лидерборд в реальном времени выключен")
+    snapshot = await leaderboard_cache.get(group_id, period)
+    subscription = live_leaderboard.subscribe(group_id, period, user.get("id"), top, snapshot)
+
+    async def events():
+        try:
+            # Переподключение EventSource после обрыва — через 5 секунд
+            yield "retry: 5000\n\n"
+            while not subscription.closed:
+                batch = await subscription.next(LEADERBOARD_STREAM_PING)
+                if not batch:
+                    yield ": ping\n\n"
+                for event, data in batch:
+                    yield f"event: {event}\ndata: {data}\n\n"
+        finally:
+            live_leaderboard.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # nginx и похожие прокси не должны копить поток в буфере
+        "X-Accel-Buffering": "no",
+    })
+
+def build_me(ctx: UserContext) -> UserData:
+    """Профиль, очки и прогресс до следующего ранга"""
+    user_id = ctx.id
+    points = ctx.points
     current_rank_name = get_rank(points)
     current_rank_info = next((r for r in RANKS if r.name == current_rank_name), RANKS[0])
     current_rank_index = RANKS.index(current_rank_info)
@@ -601,9 +838,9 @@ async def get_me(user: dict = Depends(get_current_user), db=Depends(get_db_conne
         if points_needed_for_next_rank > 0:
             progress_percentage = int((points_earned_in_current_rank / points_needed_for_next_rank) * 100)
     
-    first_name = db_user['first_name'] if db_user else user.get("first_name")
-    last_name = db_user['last_name'] if db_user else user.get("last_name")
-    username = db_user['username'] if db_user else user.get("username")
+    first_name = ctx.field("first_name")
+    last_name = ctx.field("last_name")
+    username = ctx.field("username")
 
     return UserData(
         id=user_id, 
@@ -617,14 +854,13 @@ async def get_me(user: dict = Depends(get_current_user), db=Depends(get_db_conne
         progress_percentage=progress_percentage
     )
 
-@app.get("/api/ranks", response_model=List[RankInfo])
-async def get_all_ranks(user: dict = Depends(get_current_user), db=Depends(get_db_connection)):
-    user_id = user.get("id")
-    cur = db.cursor()
-    cur.execute("SELECT message_count FROM channel_subscribers WHERE telegram_id = %s", (user_id,))
-    db_user = cur.fetchone()
-    cur.close()
-    points = (db_user['message_count'] * 2) if db_user and db_user['message_count'] is not None else 0
+@app.get("/api/me", response_model=UserData)
+async def get_me(ctx: UserContext = Depends(get_user_context)):
+    return build_me(ctx)
+
+def build_ranks(ctx: UserContext) -> List[RankInfo]:
+    """Все ранги с отметкой, открыт ли каждый для пользователя"""
+    points = ctx.points
     ranks_list = []
     for i, rank in enumerate(RANKS): 
         ranks_list.append(RankInfo(
@@ -634,3 +870,39 @@ async def get_all_ranks(user: dict = Depends(get_current_user), db=Depends(get_d
             is_unlocked=(points >= rank.min_points)
         ))
     return ranks_list
+
+@app.get("/api/ranks", response_model=List[RankInfo])
+async def get_all_ranks(ctx: UserContext = Depends(get_user_context)):
+    return build_ranks(ctx)
+
+# --- BOOTSTRAP: всё для стартового экрана одним запросом ---
+
+BOOTSTRAP_FIELDS = ("me", "ranks", "courses", "leaderboard")
+ranks_adapter = TypeAdapter(List[RankInfo])
+
+@app.get("/api/bootstrap", response_model=BootstrapResponse)
+async def get_bootstrap(
+    fields: Optional[str] = Query(None, description="Через запятую: me, ranks, courses, leaderboard"),
+    period: Literal['7d', '30d', 'all'] = '7d',
+    ctx: UserContext = Depends(get_user_context)
+):
+    """/api/me, /api/ranks, /api/courses и /api/leaderboard одним ответом на одном контексте пользователя"""
+    # ?fields=me,me — один раз: иначе двойная работа и повторный ключ в JSON
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip())) if fields else list(BOOTSTRAP_FIELDS)
+    unknown = set(requested) - set(BOOTSTRAP_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(sorted(unknown))}")
+    
+    async def build(name: str) -> bytes:
+        if name == "me":
+            return build_me(ctx).model_dump_json().encode()
+        if name == "ranks":
+            return ranks_adapter.dump_json(build_ranks(ctx))
+        if name == "courses":
+            return await build_course_list(ctx)
+        return (await build_leaderboard(ctx.group_id, ctx.id, period)).model_dump_json().encode()
+    
+    # Части, которым нужна БД, выполняются параллельно; курсы приходят уже готовыми байтами
+    results = await asyncio.gather(*(build(name) for name in requested))
+    body = b"{" + b",".join(b'"%s":%s' % (name.encode(), part) for name, part in zip(requested, results)) + b"}"
+    return Response(content=body, media_type="application/json")
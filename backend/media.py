@@ -0,0 +1,351 @@
+"""Медиа уроков: картинки, PDF, постеры видео из папок курсов.
+
+Относительные ссылки в уроке (![схема](img/schema.png), [конспект](notes.pdf),
+<video poster="poster.jpg">) переписываются на MEDIA_BASE_URL/<sha256[:16]>/<имя файла>.
+URL меняется вместе с содержимым файла, поэтому ответы кэшируются навсегда (immutable).
+Файл находится только по хэшу содержимого: ссылку знает тот, кому открыт урок.
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from email.utils import formatdate
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from delivery import file_version
+
+log = logging.getLogger(__name__)
+
+# Откуда клиент видит /media этого бэкенда. Относительный путь годится, только если фронтенд
+# на том же origin; в проде фронтенд на другом домене, и нужен абсолютный URL бэкенда
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", "/media").rstrip("/")
+# Как часто (в секундах) можно пересканировать папки курсов в поисках неизвестного хэша
+MEDIA_RESCAN_INTERVAL = float(os.getenv("MEDIA_RESCAN_INTERVAL", "30"))
+# Сколько байт отдавать за одну отправку, когда сервер не умеет zero-copy
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DIGEST_LENGTH = 16
+
+# Только эти типы файлов из папок курсов доступны по ссылке
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+    ".svg": "image/svg+xml",
+    ".pdf": "application/pdf",
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".mp3": "audio/mpeg",
+    ".zip": "application/zip",
+}
+
+FENCE = re.compile(r"^(`{3,}|~{3,}).*?(?:^\1[ \t]*$|\Z)", re.MULTILINE | re.DOTALL)
+MD_LINK = re.compile(r"(!?\[[^\]\n]*\]\(\s*)(<[^>\n]+>|[^)\s]+)")
+MD_REFERENCE = re.compile(r"^([ ]{0,3}\[[^\]\n]+\]:[ \t]*)(<[^>\n]+>|\S+)", re.MULTILINE)
+HTML_ATTR = re.compile(r"""(\b(?:src|href|poster)\s*=\s*)(["'])([^"'\n]*)\2""", re.IGNORECASE)
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@dataclass
+class Asset:
+    digest: str
+    path: str
+    name: str
+    media_type: str
+    size: int
+    version: Tuple[int, int]
+
+    @property
+    def url(self) -> str:
+        return f"{MEDIA_BASE_URL}/{self.digest}/{quote(self.name)}"
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+class MediaLibrary:
+    """Хэши медиафайлов курсов и ссылки на них из уроков.
+
+    Хэш файла пересчитывается только при смене его версии (mtime, размер).
+    Для каждого урока запоминается, на какие файлы он ссылается: version()
+    меняется вместе с ними (и с появлением файла по ссылке), и закэшированное
+    тело урока пересобирается.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._by_path: Dict[str, Asset] = {}
+        self._by_digest: Dict[str, Asset] = {}
+        # Урок → (версия его файла, медиафайлы из его ссылок)
+        self._references: Dict[str, Tuple[Optional[Tuple[int, int]], Tuple[str, ...]]] = {}
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+
+    # --- хэши ---
+
+    def asset(self, path: str) -> Optional[Asset]:
+        """Актуальная запись о файле (path — realpath внутри курса).
+
+        Хэширует файл при смене версии — вызывать не из event loop.
+        """
+        version = file_version(path)
+        if version is None:
+            return None
+        cached = self._by_path.get(path)
+        if cached is not None and cached.version == version:
+            return cached
+        try:
+            digest = hash_file(path)
+        except OSError as e:
+            log.error("Failed to hash media file", extra={"path": path, "error": str(e)})
+            return None
+        asset = Asset(
+            digest=digest,
+            path=path,
+            name=os.path.basename(path),
+            media_type=MEDIA_TYPES[os.path.splitext(path)[1].lower()],
+            size=version[1],
+            version=version,
+        )
+        with self._lock:
+            if cached is not None and self._by_digest.get(cached.digest) is cached:
+                del self._by_digest[cached.digest]
+            self._by_path[path] = asset
+            self._by_digest[digest] = asset
+        return asset
+
+    def lookup(self, digest: str) -> Optional[Asset]:
+        """Файл по хэшу из URL; None, если такого содержимого больше нет"""
+        asset = self._by_digest.get(digest)
+        if asset is None:
+            # После перезапуска ссылка из закэшированного у клиента урока может опередить прогрев
+            self.scan()
+            asset = self._by_digest.get(digest)
+        if asset is None:
+            return None
+        current = self.asset(asset.path)
+        return current if current is not None and current.digest == digest else None
+
+    def scan(self):
+        """Хэширует медиафайлы всех курсов; не чаще MEDIA_RESCAN_INTERVAL"""
+        now = time.monotonic()
+        if now - self._scanned_at < MEDIA_RESCAN_INTERVAL:
+            return
+        self._scanned_at = now
+        for course_id in os.listdir(self.root) if os.path.isdir(self.root) else ():
+            course_path = os.path.join(self.root, course_id)
+            if not os.path.isdir(course_path):
+                continue
+            for dirpath, _, filenames in os.walk(course_path, followlinks=True):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in MEDIA_TYPES:
+                        self.asset(os.path.realpath(os.path.join(dirpath, filename)))
+
+    # --- ссылки из уроков ---
+
+    def _course_root(self, lesson_path: str) -> Optional[str]:
+        relative = os.path.relpath(os.path.abspath(lesson_path), self.root)
+        if relative.startswith(os.pardir):
+            return None
+        return os.path.realpath(os.path.join(self.root, relative.split(os.sep, 1)[0]))
+
+    def _target_path(self, target: str, base_dir: str, course_root: str) -> Optional[str]:
+        """realpath медиафайла, на который ведёт относительная ссылка; файла может ещё не быть"""
+        parts = urlsplit(target)
+        if parts.scheme or parts.netloc or not parts.path or parts.path.startswith("/"):
+            return None
+        if os.path.splitext(parts.path)[1].lower() not in MEDIA_TYPES:
+            return None
+        path = os.path.realpath(os.path.join(base_dir, unquote(parts.path)))
+        # Наружу из папки курса ссылки не ведут: ../../ другого курса или системные файлы
+        if not path.startswith(course_root + os.sep):
+            return None
+        return path
+
+    def _resolve(self, target: str, base_dir: str, course_root: str) -> Optional[str]:
+        path = self._target_path(target, base_dir, course_root)
+        if path is None or not os.path.isfile(path):
+            return None
+        asset = self.asset(path)
+        if asset is None:
+            return None
+        parts = urlsplit(target)
+        return asset.url + (f"?{parts.query}" if parts.query else "") + (f"#{parts.fragment}" if parts.fragment else "")
+
+    def _substitute(self, lesson_path: str, text: str, replace: Callable[[str, str, str], Optional[str]]) -> str:
+        """Применяет replace(ссылка, папка урока, папка курса) ко всем ссылкам вне примеров кода"""
+        course_root = self._course_root(lesson_path)
+        if course_root is None:
+            return text
+        base_dir = os.path.dirname(os.path.realpath(lesson_path))
+
+        def replace_target(target: str) -> Optional[str]:
+            bracketed = target.startswith("<") and target.endswith(">")
+            url = replace(target[1:-1] if bracketed else target, base_dir, course_root)
+            if url is None:
+                return None
+            return f"<{url}>" if bracketed else url
+
+        def replace_link(match: "re.Match") -> str:
+            url = replace_target(match.group(2))
+            return match.group(0) if url is None else match.group(1) + url
+
+        def replace_attr(match: "re.Match") -> str:
+            url = replace_target(match.group(3))
+            return match.group(0) if url is None else f"{match.group(1)}{match.group(2)}{url}{match.group(2)}"
+
+        def rewrite_prose(chunk: str) -> str:
+            chunk = MD_LINK.sub(replace_link, chunk)
+            chunk = MD_REFERENCE.sub(replace_link, chunk)
+            return HTML_ATTR.sub(replace_attr, chunk)
+
+        # Примеры кода оставляем как есть
+        out = []
+        position = 0
+        for fence in FENCE.finditer(text):
+            out.append(rewrite_prose(text[position:fence.start()]))
+            out.append(fence.group(0))
+            position = fence.end()
+        out.append(rewrite_prose(text[position:]))
+        return "".join(out)
+
+    def rewrite(self, lesson_path: str, text: str) -> str:
+        """Текст урока со ссылками на медиа, переписанными на хэшированные URL"""
+        return self._substitute(lesson_path, text, self._resolve)
+
+    def references(self, lesson_path: str) -> Tuple[str, ...]:
+        """Медиафайлы, на которые ссылается урок; перечитываются при смене версии его файла"""
+        lesson_version = file_version(lesson_path)
+        cached = self._references.get(lesson_path)
+        if cached is not None and cached[0] == lesson_version:
+            return cached[1]
+        paths: List[str] = []
+
+        def collect(target: str, base_dir: str, course_root: str) -> None:
+            path = self._target_path(target, base_dir, course_root)
+            if path is not None:
+                paths.append(path)
+
+        try:
+            with open(lesson_path, 'r', encoding='utf-8') as f:
+                self._substitute(lesson_path, f.read(), collect)
+        except (OSError, UnicodeDecodeError) as e:
+            log.error("Failed to read lesson links", extra={"path": lesson_path, "error": str(e)})
+            return ()
+        referenced = tuple(dict.fromkeys(paths))
+        with self._lock:
+            self._references[lesson_path] = (lesson_version, referenced)
+        return referenced
+
+    def version(self, lesson_path: str) -> tuple:
+        """Версии медиафайлов, на которые ссылается урок (для ключа кэша его тела).
+
+        Ссылки берутся из самого файла урока, а не из последнего рендера, поэтому ключ
+        одинаков до и после первой сборки тела. Читает файлы — вызывать не из event loop.
+        """
+        return tuple(file_version(path) for path in self.references(lesson_path))
+
+
+# --- отдача ---
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон bytes=a-b → (start, end включительно); несколько диапазонов не поддерживаем"""
+    match = RANGE.match(header.replace(" ", "")) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N: последние N байт
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+class MediaResponse(Response):
+    """Файл целиком или диапазоном: через zero-copy сервера, иначе кусками без декодирования"""
+
+    def __init__(self, asset: Asset, status_code: int, headers: Dict[str, str],
+                 offset: int = 0, count: int = 0, send_body: bool = True):
+        self.path = asset.path
+        self.offset = offset
+        self.count = count
+        self.send_body = send_body and count > 0
+        self.status_code = status_code
+        self.media_type = None
+        self.background = None
+        if status_code != 304:
+            headers = {**headers, "Content-Length": str(count)}
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.offset,
+                            "count": self.count, "more_body": False})
+                return
+            fd = f.fileno()
+            offset, remaining = self.offset, self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(os.pread, fd, min(MEDIA_CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    # Файл укоротили во время отдачи: длину уже объявили, обрываем соединение
+                    raise RuntimeError(f"Media file truncated: {self.path}")
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+
+def media_response(request: Request, asset: Asset) -> Response:
+    etag = f'"{asset.digest}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(asset.version[0] / 1e9, usegmt=True),
+        "Cache-Control": MEDIA_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        "Content-Type": asset.media_type,
+        "X-Content-Type-Options": "nosniff",
+    }
+    if asset.media_type == "image/svg+xml":
+        # SVG, открытый по прямой ссылке, не должен исполнять скрипты от имени бэкенда
+        headers["Content-Security-Policy"] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+        del headers["Content-Type"]
+        return MediaResponse(asset, 304, headers, send_body=False)
+
+    send_body = request.method != "HEAD"
+    byte_range = parse_range(request.headers.get("range"), asset.size)
+    if_range = request.headers.get("if-range")
+    if byte_range is None or (if_range is not None and if_range.strip() != etag):
+        return MediaResponse(asset, 200, headers, 0, asset.size, send_body)
+
+    start, end = byte_range
+    if start >= asset.size or start > end:
+        headers["Content-Range"] = f"bytes */{asset.size}"
+        return MediaResponse(asset, 416, headers, send_body=False)
+    headers["Content-Range"] = f"bytes {start}-{end}/{asset.size}"
+    return MediaResponse(asset, 206, headers, start, end - start + 1, send_body)
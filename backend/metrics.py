@@ -0,0 +1,108 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки запроса",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Время одного обращения к БД (включая ожидание соединения)",
+    buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "Обращений к БД за запрос",
+    ["route"], buckets=(0, 1, 2, 3, 5, 8, 13, 21),
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds", "Суммарное время БД за запрос",
+    ["route"], buckets=LATENCY_BUCKETS,
+)
+DB_POOL_ACQUIRE = Histogram(
+    "db_pool_acquire_seconds", "Ожидание соединения из пула",
+    buckets=LATENCY_BUCKETS,
+)
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Запросы, не дождавшиеся соединения из пула")
+CATALOG_REBUILD = Histogram(
+    "catalog_rebuild_seconds", "Пересборка индекса курсов",
+    ["scope"], buckets=LATENCY_BUCKETS,
+)
+
+
+class _RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+_request_stats: ContextVar[Optional[_RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def observe_query(seconds: float):
+    DB_QUERY_LATENCY.observe(seconds)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += seconds
+
+
+class PoolCollector:
+    """Текущее состояние пула соединений как gauge-метрики"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def collect(self):
+        stats = self.pool.stats()
+        for name in ("size", "idle", "in_use", "waiting", "max_size"):
+            gauge = GaugeMetricFamily(f"db_pool_{name}", f"Пул соединений: {name}")
+            gauge.add_metric([], stats[name])
+            yield gauge
+
+
+def register_pool(pool):
+    REGISTRY.register(PoolCollector(pool))
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: латентность по шаблону маршрута и число/время запросов к БД"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = _RequestStats()
+        token = _request_stats.set(stats)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stats.reset(token)
+            # Шаблон пути, а не сам путь — иначе id курсов/уроков раздуют число рядов
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.labels(scope["method"], route, str(status["code"])).observe(elapsed)
+            DB_QUERIES_PER_REQUEST.labels(route).observe(stats.queries)
+            DB_TIME_PER_REQUEST.labels(route).observe(stats.db_seconds)
+
+
+def render_latest():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from starlette.concurrency import run_in_threadpool
+
+log = logging.getLogger(__name__)
+
+
+class NotificationListener:
+    """Одно LISTEN-соединение на воркер: раздаёт NOTIFY от коллектора подписчикам.
+
+    Соединение читается через loop.add_reader, без отдельного потока; при обрыве
+    переподключается с паузой.
+    """
+
+    def __init__(self, dsn: str, reconnect_delay: float = 5.0):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = {}
+        self._reconnect_callbacks: List[Callable[[], None]] = []
+        self._conn = None
+        self._task = None
+        self._stopped = False
+
+    def subscribe(self, channel: str, callback: Callable[[str], None]):
+        """callback(payload) вызывается в event loop на каждое уведомление канала"""
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def on_reconnect(self, callback: Callable[[], None]):
+        """Вызывается после переподключения: уведомления за время обрыва потеряны"""
+        self._reconnect_callbacks.append(callback)
+
+    @property
+    def connected(self) -> bool:
+        """LISTEN-соединение открыто — уведомления доходят"""
+        return self._conn is not None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            for channel in self._callbacks:
+                cur.execute(f'LISTEN "{channel}";')
+        return conn
+
+    async def start(self):
+        self._stopped = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopped = True
+        if self._task is not None:
+            self._task.cancel()
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            except Exception:
+                pass
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        first = True
+        while not self._stopped:
+            lost = loop.create_future()
+            try:
+                self._conn = await run_in_threadpool(self._connect)
+            except psycopg2.Error as e:
+                log.error("LISTEN connection failed", extra={"error": str(e)})
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            if not first:
+                for callback in self._reconnect_callbacks:
+                    callback()
+            first = False
+
+            loop.add_reader(self._conn.fileno(), self._on_readable, lost)
+            try:
+                await lost
+            except psycopg2.Error as e:
+                log.error("LISTEN connection lost", extra={"error": str(e)})
+            finally:
+                self._close()
+            if not self._stopped:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _on_readable(self, lost: asyncio.Future):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            if not lost.done():
+                lost.set_exception(e)
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            for callback in self._callbacks.get(notify.channel, []):
+                try:
+                    callback(notify.payload)
+                except Exception:
+                    log.exception("Notification handler failed", extra={"channel": notify.channel})
@@ -0,0 +1,215 @@
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from db import Database
+
+log = logging.getLogger(__name__)
+
+# Отметки о прохождении копятся в памяти и пишутся пачкой раз в PROGRESS_FLUSH_INTERVAL_MS
+PROGRESS_FLUSH_INTERVAL_MS = int(os.getenv("PROGRESS_FLUSH_INTERVAL_MS", "1000"))
+PROGRESS_BATCH_SIZE = int(os.getenv("PROGRESS_BATCH_SIZE", "500"))
+
+SCHEMA = [
+    # Стабильный порядковый номер урока внутри курса: номер бита в bitmap прогресса.
+    # Номера только добавляются, поэтому новые уроки не сдвигают уже сохранённые биты.
+    """
+    CREATE TABLE IF NOT EXISTS lesson_ordinals (
+        course_id VARCHAR(255) NOT NULL,
+        lesson_id VARCHAR(255) NOT NULL,
+        ordinal INT NOT NULL,
+        PRIMARY KEY (course_id, lesson_id),
+        UNIQUE (course_id, ordinal)
+    );
+    """,
+    # Пройденные уроки пользователя в курсе: bit i (little-endian) = урок с ordinal i
+    """
+    CREATE TABLE IF NOT EXISTS lesson_progress (
+        user_id BIGINT NOT NULL,
+        course_id VARCHAR(255) NOT NULL,
+        completed BYTEA NOT NULL DEFAULT '\\x',
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (user_id, course_id)
+    );
+    """,
+]
+
+# (user_id, course_id) -> {ordinal: completed}
+PendingOps = Dict[Tuple[int, str], Dict[int, bool]]
+
+
+def apply_ops(bitmap: int, ops: Dict[int, bool]) -> int:
+    for ordinal, completed in ops.items():
+        if completed:
+            bitmap |= 1 << ordinal
+        else:
+            bitmap &= ~(1 << ordinal)
+    return bitmap
+
+
+def bitmap_to_bytes(bitmap: int) -> bytes:
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+
+
+def bitmap_from_bytes(data) -> int:
+    return int.from_bytes(bytes(data), "little") if data else 0
+
+
+def count_completed(bitmap: int, ordinals: List[int]) -> int:
+    """Сколько из текущих уроков курса отмечено (удалённые уроки не считаются)"""
+    return sum((bitmap >> o) & 1 for o in ordinals)
+
+
+class ProgressStore:
+    """Прогресс по урокам: bitmap на (пользователь, курс) и write-behind запись отметок.
+
+    Чтения накладывают ещё не записанные отметки поверх данных из БД, так что
+    пользователь сразу видит свои изменения.
+    """
+
+    def __init__(self, db: Database, flush_interval_ms: int = PROGRESS_FLUSH_INTERVAL_MS,
+                 batch_size: int = PROGRESS_BATCH_SIZE):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self._ordinals: Dict[str, Dict[str, int]] = {}
+        self._pending: PendingOps = {}
+        self._flushing: PendingOps = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    # --- схема и жизненный цикл ---
+
+    async def setup(self):
+        def _create(cur):
+            for statement in SCHEMA:
+                cur.execute(statement)
+        await self.db.run(_create)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Не отменяем: поток с записью отмена не остановит, а отметки из _flushing потеряются.
+            # Фоновый цикл доделает текущий сброс и выйдет
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Failed to flush lesson progress")
+
+    # --- порядковые номера уроков ---
+
+    async def ordinals(self, course_id: str, lesson_ids: List[str]) -> Dict[str, int]:
+        """lesson_id -> ordinal; недостающие номера выдаются в БД под advisory-локом курса"""
+        known = self._ordinals.get(course_id, {})
+        if all(lesson_id in known for lesson_id in lesson_ids):
+            return known
+
+        def _sync(cur):
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (course_id,))
+            cur.execute("SELECT lesson_id, ordinal FROM lesson_ordinals WHERE course_id = %s;", (course_id,))
+            mapping = {row['lesson_id']: row['ordinal'] for row in cur.fetchall()}
+            missing = [lesson_id for lesson_id in lesson_ids if lesson_id not in mapping]
+            next_ordinal = max(mapping.values(), default=-1) + 1
+            new_rows = [(course_id, lesson_id, next_ordinal + i) for i, lesson_id in enumerate(missing)]
+            if new_rows:
+                execute_values(cur, "INSERT INTO lesson_ordinals (course_id, lesson_id, ordinal) VALUES %s;", new_rows)
+                mapping.update({lesson_id: ordinal for _, lesson_id, ordinal in new_rows})
+            return mapping
+
+        mapping = await self.db.run(_sync)
+        self._ordinals[course_id] = mapping
+        return mapping
+
+    # --- чтение ---
+
+    def _overlay(self, user_id: int, bitmaps: Dict[str, int]) -> Dict[str, int]:
+        for ops_by_key in (self._flushing, self._pending):
+            for (uid, course_id), ops in ops_by_key.items():
+                if uid == user_id:
+                    bitmaps[course_id] = apply_ops(bitmaps.get(course_id, 0), ops)
+        return bitmaps
+
+    async def user_bitmaps(self, user_id: int) -> Dict[str, int]:
+        """Прогресс пользователя по всем курсам одним запросом"""
+        rows = await self.db.fetchall(
+            "SELECT course_id, completed FROM lesson_progress WHERE user_id = %s;", (user_id,)
+        )
+        return self._overlay(user_id, {row['course_id']: bitmap_from_bytes(row['completed']) for row in rows})
+
+    async def course_bitmap(self, user_id: int, course_id: str) -> int:
+        row = await self.db.fetchone(
+            "SELECT completed FROM lesson_progress WHERE user_id = %s AND course_id = %s;", (user_id, course_id)
+        )
+        bitmaps = {course_id: bitmap_from_bytes(row['completed'])} if row else {}
+        return self._overlay(user_id, bitmaps).get(course_id, 0)
+
+    # --- запись ---
+
+    def mark(self, user_id: int, course_id: str, ordinal: int, completed: bool):
+        self._pending.setdefault((user_id, course_id), {})[ordinal] = completed
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                await self.db.run(self._write, self._flushing)
+            except BaseException:
+                # Возвращаем отметки в очередь (и при отмене); более новые из _pending важнее
+                for key, ops in self._pending.items():
+                    self._flushing.setdefault(key, {}).update(ops)
+                self._pending = self._flushing
+                raise
+            finally:
+                self._flushing = {}
+
+    @staticmethod
+    def _write(cur, ops_by_key: PendingOps):
+        keys = sorted(ops_by_key)
+        # FOR UPDATE не держит ещё не созданную строку: два воркера прочли бы пустой bitmap
+        # и затёрли отметки друг друга. Advisory-локи на ключи берём в порядке их хэша —
+        # одинаковом у всех воркеров, чтобы не было взаимных блокировок.
+        cur.execute("""
+            SELECT pg_advisory_xact_lock(hashtext('lesson_progress'), lock_key)
+            FROM (
+                SELECT DISTINCT hashtext(key) AS lock_key FROM unnest(%s::text[]) AS key ORDER BY lock_key
+            ) keys;
+        """, ([f"{user_id}:{course_id}" for user_id, course_id in keys],))
+        cur.execute("""
+            SELECT user_id, course_id, completed
+            FROM lesson_progress
+            WHERE (user_id, course_id) IN %s;
+        """, (tuple(keys),))
+        current = {(row['user_id'], row['course_id']): bitmap_from_bytes(row['completed']) for row in cur.fetchall()}
+        rows = [
+            (user_id, course_id, bitmap_to_bytes(apply_ops(current.get((user_id, course_id), 0), ops_by_key[(user_id, course_id)])))
+            for user_id, course_id in keys
+        ]
+        execute_values(cur, """
+            INSERT INTO lesson_progress (user_id, course_id, completed) VALUES %s
+            ON CONFLICT (user_id, course_id)
+            DO UPDATE SET completed = EXCLUDED.completed, updated_at = NOW();
+        """, rows, page_size=len(rows))
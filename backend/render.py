@@ -0,0 +1,159 @@
+import os
+import json
+import math
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Callable, List, Optional
+
+import markdown
+import nh3
+from markdown.extensions.toc import slugify_unicode
+
+log = logging.getLogger(__name__)
+
+# Куда складывать отрендеренные уроки между перезапусками
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "lesson-render-cache"))
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1024"))
+# Скорость чтения для оценки времени (слов в минуту)
+READING_WORDS_PER_MINUTE = 180
+# Меняется при изменении рендера/санитайзера — старый дисковый кэш перестаёт совпадать
+RENDERER_VERSION = "2"
+
+MARKDOWN_EXTENSIONS = ["extra", "sane_lists", "toc"]
+MARKDOWN_CONFIG = {"toc": {"slugify": slugify_unicode, "permalink": False}}
+
+# Разрешённые атрибуты поверх стандартных nh3: якоря заголовков и язык блоков кода
+SANITIZE_ATTRIBUTES = {tag: set(attrs) for tag, attrs in nh3.ALLOWED_ATTRIBUTES.items()}
+for _tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+    SANITIZE_ATTRIBUTES.setdefault(_tag, set()).add("id")
+SANITIZE_ATTRIBUTES.setdefault("code", set()).add("class")
+# Видео из папок курсов (media.py): плеер с постером
+SANITIZE_TAGS = set(nh3.ALLOWED_TAGS) | {"video", "source"}
+SANITIZE_ATTRIBUTES["video"] = {"src", "poster", "controls", "width", "height", "preload", "muted", "loop", "playsinline"}
+SANITIZE_ATTRIBUTES["source"] = {"src", "type"}
+
+
+@dataclass
+class TocEntry:
+    level: int
+    id: str
+    title: str
+
+
+@dataclass
+class RenderedLesson:
+    html: str
+    toc: List[TocEntry]
+    word_count: int
+    reading_time_minutes: int
+
+
+def _flatten_toc(tokens, out: List[TocEntry]):
+    for token in tokens:
+        out.append(TocEntry(level=token["level"], id=token["id"], title=token["name"]))
+        _flatten_toc(token.get("children", []), out)
+    return out
+
+
+def render_markdown(text: str) -> RenderedLesson:
+    """Markdown → санитизированный HTML, оглавление и время чтения"""
+    md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_CONFIG)
+    html = nh3.clean(md.convert(text), tags=SANITIZE_TAGS, attributes=SANITIZE_ATTRIBUTES)
+    words = len(text.split())
+    return RenderedLesson(
+        html=html,
+        toc=_flatten_toc(md.toc_tokens, []),
+        word_count=words,
+        reading_time_minutes=max(1, math.ceil(words / READING_WORDS_PER_MINUTE)),
+    )
+
+
+def render_key(text: str) -> str:
+    """Ключ кэша рендера: sha256 текста и версии рендерера"""
+    return hashlib.sha256(f"{RENDERER_VERSION}\0{text}".encode()).hexdigest()
+
+
+class LessonRenderer:
+    """Кэш отрендеренных уроков по sha256 файла: в памяти (LRU) и на диске"""
+
+    def __init__(self, cache_dir: str = RENDER_CACHE_DIR, max_size: int = RENDER_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._memory: "OrderedDict[str, RenderedLesson]" = OrderedDict()
+        # Снимок контента (snapshot.ContentSnapshot): готовые рендеры и тексты без чтения файлов
+        self.snapshot = None
+        # Переписывает текст урока перед рендером: (путь, текст) -> текст (media.MediaLibrary.rewrite)
+        self.rewrite: Optional[Callable[[str, str], str]] = None
+        # Прогрев идёт в threadpool параллельно с запросами
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            log.error("Render cache dir is not writable", extra={"path": cache_dir, "error": str(e)})
+            self.cache_dir = None
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.json") if self.cache_dir else None
+
+    def _load_disk(self, key: str) -> Optional[RenderedLesson]:
+        path = self._disk_path(key)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            data["toc"] = [TocEntry(**entry) for entry in data["toc"]]
+            return RenderedLesson(**data)
+        except Exception as e:
+            log.warning("Broken render cache entry", extra={"path": path, "error": str(e)})
+            return None
+
+    def _store_disk(self, key: str, rendered: RenderedLesson):
+        path = self._disk_path(key)
+        if not path:
+            return
+        try:
+            # Пишем во временный файл и переименовываем — параллельные воркеры не увидят половину
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(asdict(rendered), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.error("Failed to write render cache", extra={"path": path, "error": str(e)})
+
+    def render_text(self, text: str) -> RenderedLesson:
+        key = render_key(text)
+        with self._lock:
+            rendered = self._memory.get(key)
+            if rendered is not None:
+                self._memory.move_to_end(key)
+                return rendered
+
+        rendered = self.snapshot.rendered(key) if self.snapshot is not None else None
+        if rendered is None:
+            rendered = self._load_disk(key)
+        if rendered is None:
+            rendered = render_markdown(text)
+            self._store_disk(key, rendered)
+
+        with self._lock:
+            self._memory[key] = rendered
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+        return rendered
+
+    def source(self, path: str) -> str:
+        """Текст урока в том виде, в котором он рендерится и отдаётся клиенту"""
+        text = self.snapshot.read_text(path) if self.snapshot is not None else None
+        if text is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        return self.rewrite(path, text) if self.rewrite is not None else text
+
+    def render_file(self, path: str) -> RenderedLesson:
+        return self.render_text(self.source(path))
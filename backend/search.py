@@ -0,0 +1,322 @@
+import os
+import re
+import math
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import snowballstemmer
+except ImportError:  # без snowballstemmer ищем по словоформам целиком
+    snowballstemmer = None
+
+from catalog import Course
+from delivery import file_version
+
+log = logging.getLogger(__name__)
+
+# Заголовок урока весит как столько же вхождений в тексте
+TITLE_WEIGHT = 5
+# BM25
+K1 = 1.2
+B = 0.75
+# Последнее слово запроса ищется и как префикс (поиск по мере набора) — не больше стольких термов
+PREFIX_EXPANSIONS = 30
+SNIPPET_BEFORE = 60
+SNIPPET_LENGTH = 200
+# Сколько словоформ держит кэш стемминга: слова запросов приходят от пользователей, кэш не должен расти без предела
+STEM_CACHE_SIZE = int(os.getenv("STEM_CACHE_SIZE", "50000"))
+
+WORD = re.compile(r"\w+", re.UNICODE)
+CYRILLIC = re.compile(r"[а-я]")
+CODE_FENCE = re.compile(r"^```.*$", re.MULTILINE)
+LINK_TARGET = re.compile(r"\]\([^)]*\)")
+MARKUP = re.compile(r"[#*_`>|~\[\]]+")
+SPACES = re.compile(r"\s+")
+# Служебные слова не индексируются и выбрасываются из запроса
+STOPWORDS = frozenset("""
+    а без бы в во вот для до его ее её же за и из или им их к как ко ли на над не нет ни но о об от по
+    под при про с со так то у что это я мы вы он она оно они the a an and or of to in on for is are
+""".split())
+
+
+class Stemmer:
+    """Стемминг по языку слова: кириллица — русский Snowball, остальное — английский"""
+
+    def __init__(self, cache_size: int = STEM_CACHE_SIZE):
+        if snowballstemmer is not None:
+            self._ru = snowballstemmer.stemmer("russian")
+            self._en = snowballstemmer.stemmer("english")
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stem(self, word: str) -> str:
+        # Объекты snowballstemmer и OrderedDict не потокобезопасны
+        with self._lock:
+            stem = self._cache.get(word)
+            if stem is not None:
+                self._cache.move_to_end(word)
+                return stem
+            if snowballstemmer is None:
+                stem = word
+            else:
+                stemmer = self._ru if CYRILLIC.search(word) else self._en
+                stem = stemmer.stemWord(word)
+            self._cache[word] = stem
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return stem
+
+
+def normalize(word: str) -> str:
+    return word.lower().replace("ё", "е")
+
+
+def is_indexed(word: str) -> bool:
+    return (len(word) > 1 or word.isdigit()) and word not in STOPWORDS
+
+
+def plain_text(markdown_text: str) -> str:
+    """Текст урока без разметки — для индексации и сниппетов"""
+    text = CODE_FENCE.sub(" ", markdown_text)
+    text = LINK_TARGET.sub("]", text)
+    text = MARKUP.sub(" ", text)
+    return SPACES.sub(" ", text).strip()
+
+
+@dataclass
+class Document:
+    course_id: str
+    lesson_id: str
+    section_id: str
+    title: str
+    text: str
+    length: int
+    version: tuple
+    # терм -> (взвешенная частота, позиция первого вхождения в text или -1, если только в заголовке)
+    terms: Dict[str, Tuple[int, int]]
+
+
+@dataclass
+class Segment:
+    """Индекс одного курса; пересобирается целиком и подменяется атомарно"""
+    course_id: str
+    course_title: str
+    rank_required: int
+    signature: tuple
+    docs: Dict[str, Document]
+    postings: Dict[str, Dict[str, int]] = field(default_factory=dict)
+    total_length: int = 0
+
+    def __post_init__(self):
+        for lesson_id, doc in self.docs.items():
+            self.total_length += doc.length
+            for term, (tf, _) in doc.terms.items():
+                self.postings.setdefault(term, {})[lesson_id] = tf
+
+
+@dataclass
+class SearchHit:
+    course_id: str
+    course_title: str
+    lesson_id: str
+    lesson_title: str
+    section_id: str
+    snippet: str
+    score: float
+
+
+class SearchIndex:
+    """Инвертированный индекс по урокам всех курсов.
+
+    Сегмент на курс: при изменении каталога пересобираются только курсы с новым
+    отпечатком, а внутри них перечитываются только изменившиеся файлы. Запросы
+    читают текущий набор сегментов и не трогают файловую систему.
+    """
+
+    def __init__(self):
+        self.stemmer = Stemmer()
+        self.catalog_version = -1
+        # Снимок контента (snapshot.ContentSnapshot): тексты уроков без чтения файлов
+        self.snapshot = None
+        self._segments: Dict[str, Segment] = {}
+        self._vocabulary: List[str] = []
+        self._sync_lock = threading.Lock()
+
+    # --- индексация ---
+
+    def tokenize(self, text: str) -> Iterable[Tuple[str, int]]:
+        for match in WORD.finditer(text):
+            word = normalize(match.group())
+            if is_indexed(word):
+                yield self.stemmer.stem(word), match.start()
+
+    def _index_lesson(self, course: Course, lesson, version: tuple) -> Optional[Document]:
+        markdown_text = self.snapshot.read_text(lesson.path) if self.snapshot is not None else None
+        if markdown_text is None:
+            try:
+                with open(lesson.path, "r", encoding="utf-8") as f:
+                    markdown_text = f.read()
+            except OSError:
+                log.error("Failed to index lesson", extra={"path": lesson.path})
+                return None
+        text = plain_text(markdown_text)
+
+        terms: Dict[str, Tuple[int, int]] = {}
+        length = 0
+        for term, position in self.tokenize(text):
+            tf, first = terms.get(term, (0, position))
+            terms[term] = (tf + 1, first)
+            length += 1
+        for term, _ in self.tokenize(lesson.title):
+            tf, first = terms.get(term, (0, -1))
+            terms[term] = (tf + TITLE_WEIGHT, first)
+            length += TITLE_WEIGHT
+
+        return Document(
+            course_id=course.id,
+            lesson_id=lesson.id,
+            section_id=lesson.section_id,
+            title=lesson.title,
+            text=text,
+            length=length,
+            version=version,
+            terms=terms,
+        )
+
+    def _build_segment(self, course: Course, previous: Optional[Segment]) -> Segment:
+        docs = {}
+        for lesson in course.lessons.values():
+            version = file_version(lesson.path)
+            if version is None:
+                continue
+            old = previous.docs.get(lesson.id) if previous else None
+            if old is not None and old.version == version and old.title == lesson.title \
+                    and old.section_id == lesson.section_id:
+                docs[lesson.id] = old
+                continue
+            doc = self._index_lesson(course, lesson, version)
+            if doc is not None:
+                docs[lesson.id] = doc
+        return Segment(
+            course_id=course.id,
+            course_title=course.title,
+            rank_required=course.rank_required,
+            signature=course.signature,
+            docs=docs,
+        )
+
+    def sync(self, courses: List[Course], catalog_version: int):
+        """Приводит индекс к текущему каталогу; переиндексирует только изменившиеся курсы"""
+        with self._sync_lock:
+            if catalog_version == self.catalog_version:
+                return
+            segments = {}
+            changed = 0
+            for course in courses:
+                previous = self._segments.get(course.id)
+                if previous is not None and previous.signature == course.signature \
+                        and previous.course_title == course.title and previous.rank_required == course.rank_required:
+                    segments[course.id] = previous
+                else:
+                    segments[course.id] = self._build_segment(course, previous)
+                    changed += 1
+            vocabulary = sorted({term for segment in segments.values() for term in segment.postings})
+            self._segments, self._vocabulary = segments, vocabulary
+            self.catalog_version = catalog_version
+            if changed or len(segments) != len(courses):
+                log.info("Search index updated", extra={"courses": len(segments), "reindexed": changed})
+
+    # --- поиск ---
+
+    def _expand_prefix(self, vocabulary: List[str], prefix: str) -> List[str]:
+        start = bisect.bisect_left(vocabulary, prefix)
+        terms = []
+        for term in vocabulary[start:start + PREFIX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query: str, rank_level: int, limit: int = 20) -> Tuple[int, List[SearchHit]]:
+        """(всего найдено, лучшие limit) среди уроков курсов с rank_required <= rank_level"""
+        segments, vocabulary = self._segments, self._vocabulary
+        words = [w for w in (normalize(m.group()) for m in WORD.finditer(query)) if is_indexed(w)]
+        if not words:
+            return 0, []
+
+        # Каждое слово запроса — группа термов (для последнего ещё и продолжения по префиксу)
+        groups = []
+        for i, word in enumerate(words):
+            stem = self.stemmer.stem(word)
+            group = {stem}
+            if i == len(words) - 1 and len(stem) >= 3:
+                group.update(self._expand_prefix(vocabulary, stem))
+            groups.append(group)
+
+        visible = [s for s in segments.values() if s.rank_required <= rank_level]
+        total_docs = sum(len(s.docs) for s in visible)
+        if total_docs == 0:
+            return 0, []
+        avg_length = sum(s.total_length for s in visible) / total_docs
+        df = {term: sum(len(s.postings.get(term, ())) for s in visible) for group in groups for term in group}
+
+        hits = []
+        for segment in visible:
+            # Документ должен содержать хотя бы один терм из каждой группы
+            candidates = None
+            for group in groups:
+                matched = set()
+                for term in group:
+                    matched.update(segment.postings.get(term, ()))
+                candidates = matched if candidates is None else candidates & matched
+                if not candidates:
+                    break
+            for lesson_id in candidates or ():
+                doc = segment.docs[lesson_id]
+                score = 0.0
+                first = -1
+                norm = K1 * (1 - B + B * doc.length / avg_length)
+                for group in groups:
+                    for term in group:
+                        tf_first = doc.terms.get(term)
+                        if tf_first is None:
+                            continue
+                        tf, position = tf_first
+                        idf = math.log(1 + (total_docs - df[term] + 0.5) / (df[term] + 0.5))
+                        score += idf * tf * (K1 + 1) / (tf + norm)
+                        if position >= 0 and (first < 0 or position < first):
+                            first = position
+                hits.append((score, segment, doc, first))
+
+        hits.sort(key=lambda h: (-h[0], h[2].course_id, h[2].lesson_id))
+        return len(hits), [
+            SearchHit(
+                course_id=segment.course_id,
+                course_title=segment.course_title,
+                lesson_id=doc.lesson_id,
+                lesson_title=doc.title,
+                section_id=doc.section_id,
+                snippet=snippet(doc.text, first),
+                score=round(score, 4),
+            )
+            for score, segment, doc, first in hits[:limit]
+        ]
+
+
+def snippet(text: str, position: int) -> str:
+    """Фрагмент текста вокруг первого совпадения (или начало урока)"""
+    start = max(0, position - SNIPPET_BEFORE) if position >= 0 else 0
+    if start > 0:
+        # Не режем слово пополам
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < position else start
+    end = start + SNIPPET_LENGTH
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
@@ -0,0 +1,287 @@
+"""Снимок дерева контента в одном файле.
+
+    python snapshot.py /app/content /tmp/lesson-render-cache/content.snapshot --render
+
+Формат: MAGIC, длина заголовка (u64 LE), заголовок JSON (курсы, секции, уроки с
+размером, mtime и sha256 файлов), затем тела уроков и, с --render, готовый рендер.
+Ключ готового рендера считается по тексту после rewrite рендерера (ссылки на медиа),
+так что снимок, собранный с другим MEDIA_BASE_URL, просто не даст попаданий по рендеру.
+Backend при старте отображает файл в память (mmap), сверяет с деревом по stat и
+берёт из снимка всё, что совпало; тела читаются из снимка только по запросу.
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from catalog import Course, CourseCatalog, Lesson, Section, list_markdown, course_signature
+from render import RENDERER_VERSION, LessonRenderer, RenderedLesson, TocEntry, render_key
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"MKSNAP01"
+FORMAT_VERSION = 1
+_HEADER_LEN = struct.Struct("<Q")
+
+
+def file_meta(path: str, data: bytes) -> dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": hashlib.sha256(data).hexdigest()}
+
+
+# --- сборка ---
+
+def build_snapshot(courses: List[Course], output: str, renderer: Optional[LessonRenderer] = None) -> int:
+    """Пишет снимок курсов в output (атомарно); возвращает число уроков"""
+    blobs = bytearray()
+
+    def add_blob(data: bytes) -> List[int]:
+        offset = len(blobs)
+        blobs.extend(data)
+        return [offset, len(data)]
+
+    course_entries = []
+    lesson_count = 0
+    for course in sorted(courses, key=lambda c: c.id):
+        metadata_path = os.path.join(course.path, "course.json")
+        metadata = None
+        if os.path.exists(metadata_path):
+            with open(metadata_path, "rb") as f:
+                metadata = file_meta(metadata_path, f.read())
+
+        sections = []
+        for section in course.sections:
+            lessons = []
+            for lesson in section.lessons:
+                with open(lesson.path, "rb") as f:
+                    data = f.read()
+                entry = {
+                    "id": lesson.id,
+                    "title": lesson.title,
+                    "file": os.path.basename(lesson.path),
+                    **file_meta(lesson.path, data),
+                    "body": add_blob(data),
+                    "render_key": None,
+                    "rendered": None,
+                }
+                if renderer is not None:
+                    source = renderer.source(lesson.path)
+                    rendered = renderer.render_text(source)
+                    entry["render_key"] = render_key(source)
+                    entry["rendered"] = add_blob(json.dumps(asdict(rendered), ensure_ascii=False).encode())
+                lessons.append(entry)
+                lesson_count += 1
+            sections.append({"id": section.id, "title": section.title, "lessons": lessons})
+
+        course_entries.append({
+            "id": course.id,
+            "title": course.title,
+            "description": course.description,
+            "rank_required": course.rank_required,
+            "metadata": metadata,
+            "sections": sections,
+        })
+
+    header = json.dumps({
+        "format": FORMAT_VERSION,
+        "renderer_version": RENDERER_VERSION,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "courses": course_entries,
+    }, ensure_ascii=False).encode()
+
+    directory = os.path.dirname(os.path.abspath(output))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(header)))
+            f.write(header)
+            f.write(blobs)
+        os.replace(tmp_path, output)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return lesson_count
+
+
+# --- загрузка ---
+
+class ContentSnapshot:
+    """Снимок, отображённый в память.
+
+    course() отдаёт курс, только если его файлы совпадают с деревом: сначала по
+    размеру и mtime, при расхождении mtime — по sha256. Тела уроков отдаются, пока
+    версия файла та же, что при сверке.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Пустой файл или ФС без mmap
+                self._buf = f.read()
+        if self._buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a content snapshot")
+        (header_len,) = _HEADER_LEN.unpack_from(self._buf, len(MAGIC))
+        header_start = len(MAGIC) + _HEADER_LEN.size
+        header = json.loads(bytes(self._buf[header_start:header_start + header_len]))
+        if header.get("format") != FORMAT_VERSION:
+            raise ValueError(f"unsupported snapshot format {header.get('format')}")
+        self._base = header_start + header_len
+        self.built_at = header.get("built_at")
+        self._has_renders = header.get("renderer_version") == RENDERER_VERSION
+        self._courses: Dict[str, dict] = {c["id"]: c for c in header["courses"]}
+        # path -> (версия файла при сверке, запись урока)
+        self._verified: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+        self._rendered_by_key: Dict[str, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _blob(self, ref: List[int]) -> bytes:
+        offset, length = ref
+        return bytes(self._buf[self._base + offset:self._base + offset + length])
+
+    @staticmethod
+    def _matches(path: str, meta: dict) -> Optional[Tuple[int, int]]:
+        """Версия файла, если он совпадает с записью снимка, иначе None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != meta["size"]:
+            return None
+        if st.st_mtime_ns != meta["mtime_ns"]:
+            # mtime мог смениться при копировании — сверяем содержимое
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != meta["sha256"]:
+                    return None
+        return st.st_mtime_ns, st.st_size
+
+    def course(self, course_id: str, course_path: str) -> Optional[Course]:
+        entry = self._courses.get(course_id)
+        if entry is None or not self._verify(entry, course_path):
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        sections = []
+        lessons_by_id: Dict[str, Lesson] = {}
+        for section in entry["sections"]:
+            lessons = []
+            for item in section["lessons"]:
+                lesson = Lesson(
+                    id=item["id"],
+                    title=item["title"],
+                    path=os.path.join(course_path, section["id"], item["file"]),
+                    section_id=section["id"],
+                )
+                lessons.append(lesson)
+                lessons_by_id.setdefault(lesson.id, lesson)
+            sections.append(Section(id=section["id"], title=section["title"], lessons=lessons))
+
+        return Course(
+            id=course_id,
+            path=course_path,
+            title=entry["title"],
+            description=entry["description"],
+            rank_required=entry["rank_required"],
+            sections=sections,
+            lessons=lessons_by_id,
+            signature=course_signature(course_path, [s.id for s in sections]),
+        )
+
+    def _verify(self, entry: dict, course_path: str) -> bool:
+        metadata_path = os.path.join(course_path, "course.json")
+        if entry["metadata"] is None:
+            if os.path.exists(metadata_path):
+                return False
+        elif self._matches(metadata_path, entry["metadata"]) is None:
+            return False
+
+        verified = {}
+        for section in entry["sections"]:
+            section_path = os.path.join(course_path, section["id"])
+            # Добавленные или удалённые уроки видны по списку файлов, без чтения
+            if [e.name for e in list_markdown(section_path)] != [item["file"] for item in section["lessons"]]:
+                return False
+            for item in section["lessons"]:
+                path = os.path.join(section_path, item["file"])
+                version = self._matches(path, item)
+                if version is None:
+                    return False
+                verified[path] = (version, item)
+
+        self._verified.update(verified)
+        if self._has_renders:
+            for _, item in verified.values():
+                if item["rendered"] is not None:
+                    self._rendered_by_key[item["render_key"]] = item["rendered"]
+        return True
+
+    def read_text(self, path: str) -> Optional[str]:
+        """Текст урока из снимка, если файл не менялся после сверки"""
+        verified = self._verified.get(path)
+        if verified is None:
+            return None
+        version, item = verified
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (st.st_mtime_ns, st.st_size) != version:
+            return None
+        return self._blob(item["body"]).decode("utf-8")
+
+    def rendered(self, key: str) -> Optional[RenderedLesson]:
+        ref = self._rendered_by_key.get(key)
+        if ref is None:
+            return None
+        data = json.loads(self._blob(ref))
+        data["toc"] = [TocEntry(**entry) for entry in data["toc"]]
+        return RenderedLesson(**data)
+
+
+def load_snapshot(path: str) -> Optional[ContentSnapshot]:
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return ContentSnapshot(path)
+    except (OSError, ValueError, KeyError) as e:
+        log.error("Ignoring broken content snapshot", extra={"path": path, "error": str(e)})
+        return None
+
+
+def main():
+    from media import MediaLibrary
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("content_dir")
+    parser.add_argument("output")
+    parser.add_argument("--render", action="store_true", help="включить готовый HTML уроков")
+    args = parser.parse_args()
+
+    catalog = CourseCatalog(args.content_dir)
+    catalog.build()
+
+    renderer = None
+    if args.render:
+        renderer = LessonRenderer()
+        renderer.rewrite = MediaLibrary(args.content_dir).rewrite
+    lessons = build_snapshot(catalog.courses(), args.output, renderer)
+    print(f"Snapshot of {len(catalog.courses())} courses, {lessons} lessons written to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Optional, Set, Tuple
+
+# Сколько секунд держим строку подписчика в кэше (коллектор сбрасывает её раньше через NOTIFY)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Канал, в который коллектор шлёт изменившихся подписчиков: "group_id;telegram_id,..."
+SUBSCRIBER_CHANNEL = "subscriber_changed"
+
+PROFILE_QUERY = """
+    SELECT first_name, last_name, username, photo_url, message_count
+    FROM channel_subscribers
+    WHERE group_id = %s AND telegram_id = %s
+"""
+
+
+@dataclass
+class UserContext:
+    """Пользователь запроса в группе: данные из initData, строка из channel_subscribers, очки и уровень"""
+    id: int
+    group_id: int
+    init_data: dict
+    profile: Optional[dict]
+    points: int
+    rank_level: int
+
+    def field(self, name: str):
+        """Поле профиля из БД, а если пользователя там нет — из initData"""
+        return self.profile[name] if self.profile else self.init_data.get(name)
+
+
+class UserCache:
+    """TTL + LRU кэш строк channel_subscribers по (group_id, telegram_id)"""
+
+    # Отличает «нет в кэше» от закэшированного «нет в БД»
+    MISSING = object()
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[Optional[dict], float]]" = OrderedDict()
+        # Группы, по которым что-то кэшировалось: на случай сброса пользователя во всех группах
+        self._groups: Set[int] = set()
+
+    def get(self, group_id: int, user_id: int):
+        key = (group_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return self.MISSING
+        profile, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return self.MISSING
+        self._entries.move_to_end(key)
+        return profile
+
+    def put(self, group_id: int, user_id: int, profile: Optional[dict]):
+        if self.ttl <= 0:
+            return
+        key = (group_id, user_id)
+        self._entries[key] = (profile, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        self._groups.add(group_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids: Optional[Iterable[int]] = None, group_id: Optional[int] = None):
+        """Сбрасывает user_ids в группе group_id (без неё — во всех); без user_ids — весь кэш"""
+        if user_ids is None:
+            self._entries.clear()
+            return
+        groups = self._groups if group_id is None else (group_id,)
+        for user_id in user_ids:
+            for group in groups:
+                self._entries.pop((group, user_id), None)
+
+    def on_notify(self, payload: str):
+        """Обработчик NOTIFY subscriber_changed: "group_id;telegram_id,..."; пустая группа — все группы"""
+        group, _, user_ids = payload.rpartition(";")
+        self.invalidate((int(x) for x in user_ids.split(",") if x), int(group) if group else None)
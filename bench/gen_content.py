@@ -0,0 +1,88 @@
+"""Генератор синтетического CONTENT_DIR: N курсов × S секций × L уроков.
+
+    python bench/gen_content.py /tmp/bench-content --courses 20 --sections 5 --lessons 10
+"""
+import os
+import json
+import random
+import shutil
+import argparse
+
+WORDS = (
+    "код функция запрос сервер база данных индекс кэш страница пользователь ответ "
+    "шаблон компонент стиль событие поток очередь таблица ключ значение модуль"
+).split()
+
+
+def paragraph(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def lesson_markdown(rng: random.Random, title: str, paragraphs: int) -> str:
+    parts = [f"# {title}", ""]
+    for i in range(paragraphs):
+        if i % 3 == 0:
+            parts += [f"## Часть {i // 3 + 1}", ""]
+        parts += [paragraph(rng, rng.randint(40, 120)), ""]
+        if i % 4 == 1:
+            parts += ["```python", "def handler(request):", "    return {\"ok\": True}", "```", ""]
+        if i % 5 == 2:
+            parts += [f"- {paragraph(rng, 6)}" for _ in range(4)] + [""]
+    return "\n".join(parts)
+
+
+def generate(root: str, courses: int, sections: int, lessons: int, paragraphs: int,
+             max_rank: int, seed: int, legacy_articles: int = 0):
+    rng = random.Random(seed)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    for c in range(1, courses + 1):
+        course_id = f"course-{c:03d}"
+        course_path = os.path.join(root, course_id)
+        metadata = {
+            "title": f"Курс {c}",
+            "description": paragraph(rng, 20),
+            # Первый курс доступен всем: по нему гоняются запросы уроков
+            "rank_required": 1 if c == 1 else rng.randint(1, max_rank),
+            "sections": [],
+        }
+        for s in range(1, sections + 1):
+            section_id = f"section-{s:02d}"
+            metadata["sections"].append({"id": section_id, "title": f"Раздел {s}", "lessons": []})
+            os.makedirs(os.path.join(course_path, section_id))
+            for l in range(1, lessons + 1):
+                path = os.path.join(course_path, section_id, f"lesson-{l:02d}.md")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(lesson_markdown(rng, f"Урок {s}.{l}", paragraphs))
+        with open(os.path.join(course_path, "course.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+    for a in range(1, legacy_articles + 1):
+        rank = 1 if a == 1 else rng.randint(1, max_rank)
+        with open(os.path.join(root, f"{rank}__article-{a:03d}.md"), "w", encoding="utf-8") as f:
+            f.write(lesson_markdown(rng, f"Статья {a}", paragraphs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root")
+    parser.add_argument("--courses", type=int, default=20)
+    parser.add_argument("--sections", type=int, default=5)
+    parser.add_argument("--lessons", type=int, default=10)
+    parser.add_argument("--paragraphs", type=int, default=12, help="абзацев в уроке")
+    parser.add_argument("--articles", type=int, default=10, help="легаси-статей в корне")
+    parser.add_argument("--max-rank", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.root, args.courses, args.sections, args.lessons, args.paragraphs,
+             args.max_rank, args.seed, args.articles)
+    total = args.courses * args.sections * args.lessons
+    print(f"Generated {args.courses} courses, {total} lessons, {args.articles} articles in {args.root}")
+
+
+if __name__ == "__main__":
+    main()
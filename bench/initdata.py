@@ -0,0 +1,23 @@
+import hmac
+import json
+import time
+import hashlib
+from typing import Optional
+from urllib.parse import urlencode
+
+
+def sign_init_data(bot_token: str, user: dict, auth_date: Optional[int] = None) -> str:
+    """Строка initData, подписанная так же, как её подписывает Telegram для WebApp"""
+    fields = {
+        "auth_date": str(auth_date or int(time.time())),
+        "query_id": f"bench-{user['id']}",
+        "user": json.dumps(user, ensure_ascii=False, separators=(",", ":")),
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def bench_user(user_id: int) -> dict:
+    return {"id": user_id, "first_name": f"Bench {user_id}", "username": f"bench{user_id}", "language_code": "ru"}
@@ -0,0 +1,137 @@
+"""Нагрузка на backend: курсы, уроки и лидерборд за каждый период.
+
+    BOT_TOKEN=... python bench/load.py --base-url http://localhost:8000 --requests 2000 --concurrency 32
+
+Пользователи берутся из диапазона, заполненного seed_db.py; X-Init-Data подписывается
+тем же BOT_TOKEN, с которым запущен backend. Результаты сравниваются с
+bench/baselines/<name>.json; --save-baseline записывает текущий прогон как новый baseline.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from typing import Callable, Dict, List
+
+import aiohttp
+
+from initdata import bench_user, sign_init_data
+from seed_db import USER_ID_BASE
+from stats import report, summarize
+
+PERIODS = ("7d", "30d", "all")
+
+
+class Client:
+    def __init__(self, session: aiohttp.ClientSession, base_url: str, headers_by_user: Dict[int, dict]):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.headers_by_user = headers_by_user
+        self.user_ids = list(headers_by_user)
+
+    async def get(self, path: str, user_id: int = None):
+        user_id = user_id or random.choice(self.user_ids)
+        async with self.session.get(self.base_url + path, headers=self.headers_by_user[user_id]) as resp:
+            body = await resp.read()
+            return resp.status, body
+
+    async def get_json(self, path: str, user_id: int = None):
+        async with self.session.get(self.base_url + path,
+                                    headers=self.headers_by_user[user_id or self.user_ids[0]]) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+
+async def discover_lessons(client: Client, limit: int) -> List[str]:
+    """Пути уроков, доступных всем (курсы с rank_required = 1)"""
+    paths = []
+    for course in await client.get_json("/api/courses"):
+        if course["rank_required"] > 1:
+            continue
+        detail = await client.get_json(f"/api/courses/{course['id']}")
+        for section in detail["sections"]:
+            for lesson in section["lessons"]:
+                paths.append(f"/api/courses/{course['id']}/lessons/{lesson['id']}")
+    if not paths:
+        sys.exit("No lessons available for rank 1; generate content with bench/gen_content.py")
+    return paths[:limit]
+
+
+async def run_scenario(client: Client, next_path: Callable[[], str], requests: int, concurrency: int) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                status, _ = await client.get(next_path())
+            except aiohttp.ClientError:
+                status = 0
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+async def run(args) -> Dict[str, dict]:
+    bot_token = os.getenv("BOT_TOKEN")
+    if not bot_token:
+        sys.exit("BOT_TOKEN is not set (must match the backend under test)")
+
+    rng = random.Random(args.seed)
+    user_ids = [USER_ID_BASE + i for i in rng.sample(range(args.seed_users), min(args.users, args.seed_users))]
+    headers = {uid: {"X-Init-Data": sign_init_data(bot_token, bench_user(uid))} for uid in user_ids}
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        client = Client(session, args.base_url, headers)
+        lesson_paths = await discover_lessons(client, args.max_lessons)
+
+        scenarios = {
+            "courses": lambda: "/api/courses",
+            "lesson": lambda: rng.choice(lesson_paths),
+        }
+        for period in PERIODS:
+            scenarios[f"leaderboard_{period}"] = lambda period=period: f"/api/leaderboard?period={period}"
+            scenarios[f"around_me_{period}"] = lambda period=period: f"/api/leaderboard/around-me?period={period}"
+
+        results = {}
+        for name, next_path in scenarios.items():
+            if args.only and name not in args.only:
+                continue
+            # Прогрев: кэши каталога, рендера и лидерборда, соединения пула
+            await run_scenario(client, next_path, min(args.warmup, args.requests), args.concurrency)
+            results[name] = await run_scenario(client, next_path, args.requests, args.concurrency)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов на сценарий")
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=500, help="сколько разных пользователей шлют запросы")
+    parser.add_argument("--seed-users", type=int, default=5000, help="сколько пользователей создал seed_db.py")
+    parser.add_argument("--max-lessons", type=int, default=200)
+    parser.add_argument("--only", nargs="*", help="запустить только эти сценарии")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="backend", help="имя baseline в bench/baselines")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    params = {k: v for k, v in vars(args).items() if k not in ("base_url", "save_baseline", "baseline")}
+    sys.exit(report(args.baseline, results, params, args.save_baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Локальный «Telegram»: шлёт фейковые апдейты в webhook коллектора.
+
+    # коллектор без регистрации webhook в Telegram
+    COLLECTOR_MODE=webhook WEBHOOK_REGISTER=0 WEBHOOK_SECRET=bench GROUP_ID=-100 python collector/bot.py &
+    python bench/post_updates.py --url http://localhost:8080/telegram/webhook --secret bench --group-id -100
+
+Каждый POST — один апдейт с сообщением в группе, как их присылает Bot API.
+Ответ приходит после обработки, поэтому латентность включает обработчик.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+import aiohttp
+
+from seed_db import USER_ID_BASE
+from stats import report, summarize
+
+
+def message_update(update_id: int, group_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": group_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Bench {user_id}",
+                     "username": f"bench{user_id}", "language_code": "ru"},
+            "text": f"bench message {update_id}",
+        },
+    }
+
+
+async def post_all(args) -> dict:
+    rng = random.Random(args.seed)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies = []
+    errors = 0
+    next_id = args.first_update_id
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal next_id, errors
+        while next_id < args.first_update_id + args.updates:
+            update_id = next_id
+            next_id += 1
+            update = message_update(update_id, args.group_id, USER_ID_BASE + rng.randrange(args.users))
+            started = time.perf_counter()
+            try:
+                async with session.post(args.url, json=update, headers=headers) as resp:
+                    await resp.read()
+                    status = resp.status
+            except aiohttp.ClientError:
+                status = 0
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    # Как и Telegram, держим не больше concurrency соединений (max_connections у webhook)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return {"webhook": summarize(latencies, elapsed, errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/telegram/webhook")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET коллектора")
+    parser.add_argument("--group-id", type=int, required=True, help="GROUP_ID коллектора")
+    parser.add_argument("--updates", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--first-update-id", type=int, default=20_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="webhook", help="имя baseline в bench/baselines")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = asyncio.run(post_all(args))
+    params = {k: v for k, v in vars(args).items() if k not in ("url", "secret", "save_baseline", "baseline")}
+    sys.exit(report(args.baseline, results, params, args.save_baseline))
+
+
+if __name__ == "__main__":
+    main()
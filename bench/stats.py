@@ -0,0 +1,106 @@
+import os
+import json
+import math
+import platform
+from typing import Dict, List, Optional
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+# Насколько (в долях) p95 или пропускная способность могут ухудшиться, прежде чем это регрессия
+REGRESSION_THRESHOLD = 0.15
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Перцентиль методом ближайшего ранга; значения должны быть отсортированы"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0) -> dict:
+    """Сводка по одному сценарию: латентность в миллисекундах и запросов в секунду"""
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def print_table(results: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None):
+    header = f"{'scenario':<24}{'reqs':>8}{'err':>6}{'rps':>10}{'p50':>9}{'p95':>9}{'p99':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        line = (f"{name:<24}{r['requests']:>8}{r['errors']:>6}{r['throughput_rps']:>10}"
+                f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f"   p95 {_delta(r['p95_ms'], base['p95_ms'])}, rps {_delta(r['throughput_rps'], base['throughput_rps'])}"
+        print(line)
+
+
+def _delta(current: float, base: float) -> str:
+    if not base:
+        return "n/a"
+    return f"{(current - base) / base * 100:+.1f}%"
+
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict],
+                     threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    problems = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base["p95_ms"] and r["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            problems.append(f"{name}: p95 {base['p95_ms']} -> {r['p95_ms']} ms")
+        if base["throughput_rps"] and r["throughput_rps"] < base["throughput_rps"] * (1 - threshold):
+            problems.append(f"{name}: throughput {base['throughput_rps']} -> {r['throughput_rps']} rps")
+        if r["errors"] > base.get("errors", 0):
+            problems.append(f"{name}: errors {base.get('errors', 0)} -> {r['errors']}")
+    return problems
+
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def load_baseline(name: str) -> Optional[Dict[str, dict]]:
+    try:
+        with open(baseline_path(name), encoding="utf-8") as f:
+            return json.load(f)["results"]
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(name: str, results: Dict[str, dict], params: dict):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(name), "w", encoding="utf-8") as f:
+        json.dump({
+            "params": params,
+            "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def report(name: str, results: Dict[str, dict], params: dict, save: bool) -> int:
+    """Печатает результаты рядом с сохранённым baseline; код выхода 1 при регрессии"""
+    baseline = load_baseline(name)
+    print_table(results, baseline)
+    if save:
+        save_baseline(name, results, params)
+        print(f"\nBaseline saved to {baseline_path(name)}")
+        return 0
+    if baseline is None:
+        print(f"\nNo baseline at {baseline_path(name)}; run with --save-baseline to record one")
+        return 0
+    problems = find_regressions(results, baseline)
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    return 1 if problems else 0
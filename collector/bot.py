@@ -4,13 +4,23 @@ import asyncio
 import psycopg2
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, ChatMemberUpdated
+from groups import DEFAULT_GROUP_ID, GROUP_IDS, add_group_key
+from ingest import MessageWriter, PendingMessage, notify_subscribers_changed
+from logs import setup_logging
+from metrics import HandlerTimingMiddleware, start_metrics_server
+from partitions import maintain, run_maintenance, setup_messages
+from photos import PhotoResolver
+from webhook import COLLECTOR_MODE, ConcurrencyLimitMiddleware, run_webhook
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
-GROUP_ID = int(os.getenv("GROUP_ID"))
+if not GROUP_IDS:
+    raise RuntimeError("GROUP_IDS (or GROUP_ID) is not set")
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+dp.update.outer_middleware(HandlerTimingMiddleware())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware())
 
 def get_db_connection():
     return psycopg2.connect(DATABASE_URL)
@@ -22,7 +32,8 @@ def setup_database():
     # Создание таблицы подписчиков с новыми колонками
     cur.execute("""
         CREATE TABLE IF NOT EXISTS channel_subscribers (
-            telegram_id BIGINT PRIMARY KEY,
+            group_id BIGINT NOT NULL,
+            telegram_id BIGINT NOT NULL,
             username VARCHAR(255),
             first_name VARCHAR(255),
             last_name VARCHAR(255),
@@ -33,25 +44,46 @@ def setup_database():
             unsubscription_date TIMESTAMPTZ,
             message_count INT DEFAULT 0,
             is_active BOOLEAN DEFAULT TRUE,
-            last_seen TIMESTAMPTZ DEFAULT NOW()
+            last_seen TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (group_id, telegram_id)
         );
     """)
+    # Таблицы, созданные до мультигрупп: прежние строки относятся к первой группе из GROUP_IDS
+    add_group_key(cur, "channel_subscribers", DEFAULT_GROUP_ID, "group_id, telegram_id")
     
-    # Создание таблицы сообщений
+    # Таблица сообщений, разбитая по месяцам (старая обычная таблица переносится)
+    setup_messages(cur, DEFAULT_GROUP_ID)
+    
+    # Индекс для лидерборда за всё время: топ и место пользователя без полного сканирования
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT,
-            message_id BIGINT,
-            message_date TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-            points INT DEFAULT 2
-        );
+        CREATE INDEX IF NOT EXISTS idx_subscribers_group_score
+        ON channel_subscribers (group_id, is_active, message_count DESC, telegram_id);
     """)
+    cur.execute("DROP INDEX IF EXISTS idx_subscribers_active_score;")
     
-    # Создаем индекс для ускорения выборок по дате
+    # Суточный rollup очков для лидерборда за 7/30 дней
+    cur.execute("SELECT to_regclass('user_daily_scores') IS NULL;")
+    rollup_is_new = cur.fetchone()[0]
     cur.execute("""
-        CREATE INDEX IF NOT EXISTS idx_messages_date_user_id ON messages (message_date, user_id);
+        CREATE TABLE IF NOT EXISTS user_daily_scores (
+            group_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            points INT NOT NULL DEFAULT 0,
+            message_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, day, user_id)
+        );
     """)
+    if rollup_is_new:
+        # Первый запуск: заполняем rollup из уже накопленных сообщений
+        cur.execute("""
+            INSERT INTO user_daily_scores (group_id, day, user_id, points, message_count)
+            SELECT group_id, (message_date AT TIME ZONE 'UTC')::date, user_id, SUM(points), COUNT(*)
+            FROM messages
+            GROUP BY 1, 2, 3;
+        """)
+    else:
+        add_group_key(cur, "user_daily_scores", DEFAULT_GROUP_ID, "group_id, day, user_id")
     
     # Добавляем недостающие колонки в существующую таблицу (если они еще не добавлены)
     try:
@@ -60,116 +92,126 @@ def setup_database():
         cur.execute("ALTER TABLE channel_subscribers ADD COLUMN IF NOT EXISTS language_code VARCHAR(10);")
         cur.execute("ALTER TABLE channel_subscribers ADD COLUMN IF NOT EXISTS is_bot BOOLEAN DEFAULT FALSE;")
         cur.execute("ALTER TABLE channel_subscribers ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ DEFAULT NOW();")
+        cur.execute("ALTER TABLE channel_subscribers ADD COLUMN IF NOT EXISTS photo_updated_at TIMESTAMPTZ;")
     except Exception as e:
         logging.warning(f"Error adding columns (they might already exist): {e}")
     
     conn.commit()
+    
+    # Будущие партиции и ретеншн — сразу при старте, дальше в фоне
+    maintain(cur)
+    conn.commit()
     cur.close()
     conn.close()
 
 async def get_user_photo_url(user_id):
-    """Получает URL фото профиля пользователя"""
-    try:
-        photos = await bot.get_user_profile_photos(user_id, limit=1)
-        if photos.total_count > 0:
-            # Получаем самое большое фото
-            photo = photos.photos[0][-1]  # последнее = самое большое
-            file_info = await bot.get_file(photo.file_id)
-            return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-    except Exception as e:
-        logging.warning(f"Couldn't get photo for user {user_id}: {e}")
+    """Получает URL фото профиля пользователя (ошибки Bot API пробрасываются)"""
+    photos = await bot.get_user_profile_photos(user_id, limit=1)
+    if photos.total_count > 0:
+        # Получаем самое большое фото
+        photo = photos.photos[0][-1]  # последнее = самое большое
+        file_info = await bot.get_file(photo.file_id)
+        return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
     return None
 
-@dp.chat_member(F.chat.id == GROUP_ID)
+# Фото запрашиваются в фоне: ни обработчики, ни запись сообщений их не ждут
+photo_resolver = PhotoResolver(get_user_photo_url, get_db_connection)
+
+@dp.chat_member(F.chat.id.in_(GROUP_IDS))
 async def on_chat_member_updated(update: ChatMemberUpdated):
     user = update.new_chat_member.user
+    group_id = update.chat.id
+    refresh_photo = False
     conn = get_db_connection()
     cur = conn.cursor()
     
     if update.new_chat_member.status in ["member", "administrator", "creator"]:
-        logging.info(f"User {user.id} ({user.first_name} {user.last_name or ''}) joined.")
-        
-        # Получаем фото профиля пользователя
-        photo_url = await get_user_photo_url(user.id)
+        logging.info(f"User {user.id} ({user.first_name} {user.last_name or ''}) joined group {group_id}.")
         
         cur.execute("""
             INSERT INTO channel_subscribers 
-            (telegram_id, username, first_name, last_name, photo_url, language_code, is_bot, is_active, subscription_date, last_seen) 
+            (group_id, telegram_id, username, first_name, last_name, language_code, is_bot, is_active, subscription_date, last_seen) 
             VALUES (%s, %s, %s, %s, %s, %s, %s, TRUE, NOW(), NOW())
-            ON CONFLICT (telegram_id) 
+            ON CONFLICT (group_id, telegram_id) 
             DO UPDATE SET 
                 is_active = TRUE, 
                 unsubscription_date = NULL,
                 first_name = EXCLUDED.first_name,
                 last_name = EXCLUDED.last_name,
                 username = EXCLUDED.username,
-                photo_url = EXCLUDED.photo_url,
                 language_code = EXCLUDED.language_code,
                 is_bot = EXCLUDED.is_bot,
                 last_seen = NOW();
-        """, (user.id, user.username, user.first_name, user.last_name, photo_url, user.language_code, user.is_bot))
+        """, (group_id, user.id, user.username, user.first_name, user.last_name, user.language_code, user.is_bot))
+        # При (повторном) вступлении фото могло смениться — запрашиваем заново, уже после коммита
+        refresh_photo = True
         
     elif update.new_chat_member.status in ["left", "kicked"]:
-        logging.info(f"User {user.id} left.")
+        logging.info(f"User {user.id} left group {group_id}.")
         cur.execute("""
             UPDATE channel_subscribers 
             SET is_active = FALSE, unsubscription_date = NOW() 
-            WHERE telegram_id = %s;
-        """, (user.id,))
+            WHERE group_id = %s AND telegram_id = %s;
+        """, (group_id, user.id))
     
+    notify_subscribers_changed(cur, [user.id], group_id)
     conn.commit()
     cur.close()
     conn.close()
+    
+    if refresh_photo:
+        photo_resolver.request(user.id, force=True)
+
+async def on_new_subscribers(user_ids):
+    """Ставит в очередь фото для пользователей, впервые попавших в подписчики через сообщение"""
+    photo_resolver.request_many(user_ids)
 
-@dp.message(F.chat.id == GROUP_ID)
+# Своя очередь и своя запись пачек на каждую группу
+message_writers = {
+    group_id: MessageWriter(get_db_connection, group_id, on_new_users=on_new_subscribers)
+    for group_id in GROUP_IDS
+}
+
+@dp.message(F.chat.id.in_(GROUP_IDS))
 async def on_new_message(message: Message):
     user = message.from_user
     # Пропускаем сообщения от анонимных админов или каналов
     if user is None:
         return
-        
-    logging.info(f"Message from {user.id} ({user.first_name} {user.last_name or ''})")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Обновляем счетчик сообщений и last_seen
-    cur.execute("""
-        UPDATE channel_subscribers 
-        SET message_count = message_count + 1, last_seen = NOW() 
-        WHERE telegram_id = %s;
-    """, (user.id,))
-    
-    # Добавляем запись в таблицу messages
-    cur.execute("""
-        INSERT INTO messages (user_id, message_id, points) 
-        VALUES (%s, %s, %s);
-    """, (user.id, message.message_id, 2))
     
-    # Если пользователь написал впервые (не было в подписчиках)
-    if cur.rowcount == 0:
-        logging.info(f"Adding new user {user.id} to subscribers")
-        
-        # Получаем фото при первом сообщении
-        photo_url = await get_user_photo_url(user.id)
-            
-        cur.execute("""
-            INSERT INTO channel_subscribers 
-            (telegram_id, username, first_name, last_name, photo_url, language_code, is_bot, message_count, is_active, last_seen) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, 1, TRUE, NOW()) 
-            ON CONFLICT (telegram_id) 
-            DO UPDATE SET 
-                message_count = message_count + 1,
-                last_seen = NOW();
-        """, (user.id, user.username, user.first_name, user.last_name, photo_url, user.language_code, user.is_bot))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    # Сообщение уходит в буфер своей группы; в БД оно попадёт пачкой вместе с соседними
+    message_writers[message.chat.id].add(PendingMessage(
+        user_id=user.id,
+        message_id=message.message_id,
+        message_date=message.date,
+        points=2,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        language_code=user.language_code,
+        is_bot=user.is_bot,
+    ))
 
 async def main():
     setup_database()
-    logging.info(f"Starting collector bot for group {GROUP_ID}...")
-    await dp.start_polling(bot)
+    logging.info(f"Starting collector bot for groups {', '.join(map(str, GROUP_IDS))} in {COLLECTOR_MODE} mode...")
+    start_metrics_server()
+    for writer in message_writers.values():
+        writer.start()
+    photo_resolver.start()
+    maintenance = asyncio.create_task(run_maintenance(get_db_connection))
+    try:
+        if COLLECTOR_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # getUpdates не работает, пока зарегистрирован webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        # Дописываем буфер перед выходом, чтобы не потерять сообщения
+        maintenance.cancel()
+        await asyncio.gather(*(writer.stop() for writer in message_writers.values()))
+        await photo_resolver.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,43 @@
+import os
+import logging
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+
+
+def parse_group_ids(value: str) -> List[int]:
+    """"-100123,-100456" → [-100123, -100456] (порядок сохраняется, повторы отбрасываются)"""
+    group_ids = []
+    for item in value.split(","):
+        item = item.strip()
+        if item and int(item) not in group_ids:
+            group_ids.append(int(item))
+    return group_ids
+
+
+# Группы, которые собирает коллектор, через запятую; GROUP_ID — старая настройка на одну группу
+GROUP_IDS = parse_group_ids(os.getenv("GROUP_IDS") or os.getenv("GROUP_ID") or "")
+# Группа, к которой относятся строки, записанные до появления group_id
+DEFAULT_GROUP_ID: Optional[int] = GROUP_IDS[0] if GROUP_IDS else None
+
+
+def add_group_key(cur, table: str, group_id: Optional[int], primary_key: Optional[str] = None) -> bool:
+    """Добавляет group_id в таблицу, созданную до мультигрупп; старые строки относятся к group_id.
+
+    primary_key — новый первичный ключ с group_id. False — столбец уже есть.
+    """
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'group_id';
+    """, (table,))
+    if cur.fetchone():
+        return False
+    if group_id is None:
+        raise RuntimeError(f"{table} has no group_id column; set GROUP_IDS to migrate it")
+    log.info("Adding group key", extra={"table": table, "group_id": group_id})
+    # С константным DEFAULT столбец добавляется без перезаписи таблицы
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN group_id BIGINT NOT NULL DEFAULT {int(group_id)};")
+    cur.execute(f"ALTER TABLE {table} ALTER COLUMN group_id DROP DEFAULT;")
+    if primary_key:
+        cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey, ADD PRIMARY KEY ({primary_key});")
+    return True
@@ -0,0 +1,307 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from metrics import (
+    INGESTED_BATCH_SIZE, INGEST_BUFFERED, INGEST_DROPPED, INGEST_DUPLICATES, INGEST_FAILURES, INGEST_FLUSH_DURATION,
+    INGEST_MESSAGES,
+)
+
+log = logging.getLogger(__name__)
+
+# Буфер сбрасывается раз в INGEST_FLUSH_INTERVAL_MS или при накоплении INGEST_BATCH_SIZE сообщений
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", "500"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+# После стольких неудач подряд не из-за соединения пачка пишется по одному сообщению,
+# а сообщения, которые БД не принимает, отбрасываются — иначе они держат всю очередь
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+# Предел буфера группы: пока БД недоступна, новые сообщения сверх него отбрасываются
+INGEST_MAX_BUFFERED = int(os.getenv("INGEST_MAX_BUFFERED", "100000"))
+
+# Канал, по которому backend сбрасывает кэш пользователей
+SUBSCRIBER_CHANNEL = "subscriber_changed"
+# telegram_id на одно уведомление (payload NOTIFY ограничен 8000 байт)
+NOTIFY_CHUNK_SIZE = 300
+# Канал, по которому backend двигает лидерборд без перечитывания рейтинга
+SCORE_CHANNEL = "score_delta"
+# Строк "user_id:points:messages" на одно уведомление
+SCORE_NOTIFY_CHUNK_SIZE = 250
+
+
+def notify_subscribers_changed(cur, user_ids, group_id: Optional[int] = None):
+    """Сообщает backend'у, что строки подписчиков изменились: "group_id;telegram_id,..." — доставляется при COMMIT.
+
+    Без group_id (пустая группа в payload) — строки пользователей во всех группах, например фото.
+    """
+    user_ids = sorted(set(user_ids))
+    prefix = "" if group_id is None else str(group_id)
+    for i in range(0, len(user_ids), NOTIFY_CHUNK_SIZE):
+        payload = prefix + ";" + ",".join(str(uid) for uid in user_ids[i:i + NOTIFY_CHUNK_SIZE])
+        cur.execute("SELECT pg_notify(%s, %s);", (SUBSCRIBER_CHANNEL, payload))
+
+
+def notify_score_deltas(cur, group_id: int, per_day):
+    """Прирост очков пачки группы: "xid;group_id;день;user_id:points:messages,..." — доставляется при COMMIT.
+
+    xid транзакции нужен backend'у, чтобы не учесть прирост дважды, если он уже
+    попал в рейтинг, который backend в этот момент перечитывает из БД.
+    """
+    by_day = {}
+    for (day, user_id), (points, count) in sorted(per_day.items()):
+        by_day.setdefault(day, []).append(f"{user_id}:{points}:{count}")
+    for day, items in by_day.items():
+        for i in range(0, len(items), SCORE_NOTIFY_CHUNK_SIZE):
+            payload = f";{group_id};{day.isoformat()};" + ",".join(items[i:i + SCORE_NOTIFY_CHUNK_SIZE])
+            cur.execute("SELECT pg_notify(%s, pg_current_xact_id()::text || %s);", (SCORE_CHANNEL, payload))
+
+
+@dataclass
+class PendingMessage:
+    user_id: int
+    message_id: int
+    message_date: datetime
+    points: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    language_code: Optional[str] = None
+    is_bot: bool = False
+
+
+class MessageWriter:
+    """Write-behind буфер сообщений одной группы.
+
+    Сообщения копятся в памяти и пишутся пачкой: один multi-row INSERT в messages
+    и один upsert в channel_subscribers с суммарным приростом message_count на пользователя.
+    Счётчики растут только на реально вставленные строки: повторно доставленные
+    апдейты отсекает уникальный ключ messages, так что запись идемпотентна.
+    Если запись не удалась, пачка возвращается в буфер и пишется при следующем сбросе;
+    пачку, которую БД раз за разом отвергает, пишем по одному сообщению.
+    У каждой группы свой буфер, своё соединение и своя фоновая запись: пачки разных
+    групп не ждут друг друга и не трогают одни и те же строки.
+    """
+
+    def __init__(self, connect: Callable, group_id: int, flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS,
+                 batch_size: int = INGEST_BATCH_SIZE, max_attempts: int = INGEST_MAX_ATTEMPTS,
+                 max_buffered: int = INGEST_MAX_BUFFERED,
+                 on_new_users: Optional[Callable[[List[int]], Awaitable[None]]] = None):
+        self._connect = connect
+        self.group_id = group_id
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_buffered = max_buffered
+        self.on_new_users = on_new_users
+        self._buffer: List[PendingMessage] = []
+        self._attempts = 0
+        self._overflowing = False
+        self._conn = None
+        # Соединение — только у одного потока записи, даже если ожидавшую его корутину отменили
+        self._write_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        INGEST_BUFFERED.labels(str(group_id)).set_function(lambda: len(self._buffer))
+
+    def add(self, message: PendingMessage):
+        if len(self._buffer) >= self.max_buffered:
+            INGEST_DROPPED.labels("overflow").inc()
+            if not self._overflowing:
+                self._overflowing = True
+                log.error("Ingest buffer is full, dropping new messages",
+                          extra={"group_id": self.group_id, "pending": len(self._buffer)})
+            return
+        self._overflowing = False
+        self._buffer.append(message)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает всё, что осталось в буфере"""
+        if self._task is not None:
+            # Не отменяем: отмена не остановит поток записи, а только оторвёт от него пачку.
+            # Фоновый цикл доделает текущий сброс и выйдет
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        for attempt in range(1, 6):
+            await self.flush()
+            if not self._buffer:
+                break
+            await asyncio.sleep(attempt)
+        if self._buffer:
+            log.error("Ingestion stopped with unwritten messages",
+                      extra={"group_id": self.group_id, "pending": len(self._buffer)})
+        await asyncio.to_thread(self._close)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:len(batch)]
+                started = time.perf_counter()
+                write = self._write_each if self._attempts >= self.max_attempts else self._write_batch
+                try:
+                    new_user_ids = await asyncio.to_thread(write, batch)
+                except asyncio.CancelledError:
+                    # Поток может и дописать пачку: запись идемпотентна, повтор ничего не удвоит
+                    self._buffer[:0] = batch
+                    raise
+                except Exception as e:
+                    INGEST_FAILURES.inc()
+                    if not isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                        # Недоступная БД — не вина пачки
+                        self._attempts += 1
+                    log.error("Failed to write batch, will retry",
+                              extra={"group_id": self.group_id, "size": len(batch), "attempt": self._attempts,
+                                     "error": str(e)})
+                    self._buffer[:0] = batch
+                    return
+                self._attempts = 0
+                INGEST_FLUSH_DURATION.observe(time.perf_counter() - started)
+                INGESTED_BATCH_SIZE.observe(len(batch))
+                INGEST_MESSAGES.inc(len(batch))
+                if new_user_ids and self.on_new_users is not None:
+                    asyncio.create_task(self.on_new_users(new_user_ids))
+
+    # --- запись в БД (выполняется в отдельном потоке) ---
+
+    def _get_conn(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+        return self._conn
+
+    def _close(self):
+        with self._write_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _write_batch(self, batch: List[PendingMessage]) -> List[int]:
+        with self._write_lock:
+            conn = self._get_conn()
+            try:
+                with conn.cursor() as cur:
+                    new_user_ids = self._apply(cur, batch)
+                conn.commit()
+                return new_user_ids
+            except Exception as e:
+                # Не только psycopg2.Error: ValueError из адаптации (NUL в имени) тоже оставляет транзакцию открытой
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+                if conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                    conn.close()
+                    self._conn = None
+                raise
+
+    def _write_each(self, batch: List[PendingMessage]) -> List[int]:
+        """Пачка по одному сообщению: отбрасывает только те, что БД не принимает"""
+        new_user_ids = []
+        for message in batch:
+            try:
+                new_user_ids.extend(self._write_batch([message]))
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except Exception as e:
+                INGEST_DROPPED.labels("rejected").inc()
+                log.error("Dropping message rejected by the database", extra={
+                    "group_id": self.group_id, "user_id": message.user_id,
+                    "message_id": message.message_id, "error": str(e),
+                })
+        return new_user_ids
+
+    def _apply(self, cur, batch: List[PendingMessage]) -> List[int]:
+        # Дубли внутри пачки отбрасываем сразу, с уже записанными разберётся ON CONFLICT
+        unique = {}
+        for m in batch:
+            unique.setdefault((m.user_id, m.message_id, m.message_date), m)
+        written = execute_values(cur, """
+            INSERT INTO messages (group_id, user_id, message_id, message_date, points) VALUES %s
+            ON CONFLICT (group_id, user_id, message_id, message_date) DO NOTHING
+            RETURNING user_id, message_date, points;
+        """, [(self.group_id, m.user_id, m.message_id, m.message_date, m.points) for m in unique.values()],
+            page_size=len(unique), fetch=True)
+        duplicates = len(batch) - len(written)
+        if duplicates:
+            INGEST_DUPLICATES.inc(duplicates)
+
+        # Сводим пачку к одной строке на пользователя; профиль берём из последнего сообщения.
+        # Пользователи, у которых все сообщения оказались дублями, получают прирост 0
+        counts = {}
+        for user_id, _, _ in written:
+            counts[user_id] = counts.get(user_id, 0) + 1
+        per_user = {}
+        for m in batch:
+            agg = per_user.get(m.user_id)
+            if agg is None:
+                per_user[m.user_id] = [m, m.message_date]
+            else:
+                agg[0] = m
+                agg[1] = max(agg[1], m.message_date)
+
+        # Сортировка по id — одинаковый порядок блокировок у параллельных писателей
+        subscriber_rows = [
+            (self.group_id, uid, m.username, m.first_name, m.last_name, m.language_code, m.is_bot,
+             counts.get(uid, 0), last_seen)
+            for uid, (m, last_seen) in sorted(per_user.items())
+        ]
+        inserted = execute_values(cur, """
+            INSERT INTO channel_subscribers
+            (group_id, telegram_id, username, first_name, last_name, language_code, is_bot, message_count, last_seen)
+            VALUES %s
+            ON CONFLICT (group_id, telegram_id)
+            DO UPDATE SET
+                message_count = channel_subscribers.message_count + EXCLUDED.message_count,
+                last_seen = GREATEST(channel_subscribers.last_seen, EXCLUDED.last_seen)
+            RETURNING telegram_id, (xmax = 0) AS inserted;
+        """, subscriber_rows, page_size=len(subscriber_rows), fetch=True)
+
+        # Инкрементально обновляем суточный rollup (день — по UTC)
+        per_day = {}
+        for user_id, message_date, points in written:
+            key = (message_date.astimezone(timezone.utc).date(), user_id)
+            day_points, count = per_day.get(key, (0, 0))
+            per_day[key] = (day_points + points, count + 1)
+        if per_day:
+            execute_values(cur, """
+                INSERT INTO user_daily_scores (group_id, day, user_id, points, message_count) VALUES %s
+                ON CONFLICT (group_id, day, user_id)
+                DO UPDATE SET
+                    points = user_daily_scores.points + EXCLUDED.points,
+                    message_count = user_daily_scores.message_count + EXCLUDED.message_count;
+            """, [(self.group_id, day, uid, points, count) for (day, uid), (points, count) in sorted(per_day.items())],
+                page_size=len(per_day))
+
+        notify_subscribers_changed(cur, per_user, self.group_id)
+        notify_score_deltas(cur, self.group_id, per_day)
+
+        log.debug("Ingested batch", extra={"group_id": self.group_id, "messages": len(written), "duplicates": duplicates, "users": len(per_user)})
+        return [row[0] for row in inserted if row[1]]
@@ -0,0 +1,50 @@
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Порт, на котором коллектор отдаёт /metrics; 0 — не поднимать сервер
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_LATENCY = Histogram(
+    "collector_handler_duration_seconds", "Время обработки апдейта Telegram",
+    ["update_type"], buckets=LATENCY_BUCKETS,
+)
+INGESTED_BATCH_SIZE = Histogram(
+    "collector_ingest_batch_size", "Сообщений в одной записанной пачке",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+INGEST_FLUSH_DURATION = Histogram(
+    "collector_ingest_flush_seconds", "Запись одной пачки в БД",
+    buckets=LATENCY_BUCKETS,
+)
+INGEST_MESSAGES = Counter("collector_ingested_messages_total", "Записанные в БД сообщения")
+INGEST_DUPLICATES = Counter("collector_ingest_duplicates_total", "Повторно доставленные сообщения, отброшенные при записи")
+INGEST_FAILURES = Counter("collector_ingest_failures_total", "Неудачные попытки записать пачку")
+INGEST_DROPPED = Counter("collector_ingest_dropped_messages_total", "Сообщения, которые так и не записаны в БД", ["reason"])
+INGEST_BUFFERED = Gauge("collector_ingest_buffered_messages", "Сообщения в буфере, ещё не записанные в БД", ["group"])
+PHOTO_QUEUE = Gauge("collector_photo_queue_size", "Пользователи в очереди на получение фото")
+PHOTO_RESOLVED = Counter("collector_photo_lookups_total", "Запросы фото профиля в Bot API", ["result"])
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Outer-middleware диспетчера: латентность обработки по типу апдейта"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            update_type = getattr(event, "event_type", None) or type(event).__name__
+            HANDLER_LATENCY.labels(update_type).observe(time.perf_counter() - started)
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    if port:
+        start_http_server(port)
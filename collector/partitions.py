@@ -0,0 +1,254 @@
+import os
+import re
+import asyncio
+import logging
+from datetime import date, datetime, timezone
+from typing import Callable, List, Optional, Tuple
+
+from groups import add_group_key
+
+log = logging.getLogger(__name__)
+
+# Сколько месяцев вперёд держать готовые партиции messages
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+# Сколько прошлых месяцев хранить сообщения построчно (не меньше 2: окну в 30 дней нужен прошлый месяц)
+MESSAGES_RETENTION_MONTHS = max(2, int(os.getenv("MESSAGES_RETENTION_MONTHS", "3")))
+# drop — удалить старую партицию; detach — отсоединить и оставить таблицей для архива
+MESSAGES_RETENTION_ACTION = os.getenv("MESSAGES_RETENTION_ACTION", "drop")
+# Как часто (в секундах) проверять партиции и ретеншн
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", str(6 * 3600)))
+
+DEFAULT_PARTITION = "messages_default"
+# Уникальный ключ сообщения; в нём обязан быть ключ партиционирования message_date
+MESSAGE_KEY_INDEX = "messages_group_message_key"
+# Тот же ключ до появления group_id
+LEGACY_MESSAGE_KEY_INDEX = "messages_user_message_key"
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+# Чтобы обслуживание партиций одновременно шло только в одной реплике коллектора
+MAINTENANCE_LOCK_KEY = "messages_partition_maintenance"
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"messages_y{month.year:04d}m{month.month:02d}"
+
+
+def current_month() -> date:
+    return month_start(datetime.now(timezone.utc).date())
+
+
+# --- схема ---
+
+def create_partitioned_table(cur, name: str = "messages"):
+    cur.execute(f"""
+        CREATE TABLE {name} (
+            id BIGSERIAL,
+            group_id BIGINT NOT NULL,
+            user_id BIGINT,
+            message_id BIGINT,
+            message_date TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            points INT DEFAULT 2,
+            PRIMARY KEY (id, message_date)
+        ) PARTITION BY RANGE (message_date);
+    """)
+
+
+def create_partition(cur, month: date):
+    # Границы — полночь UTC первого числа, как и суточный rollup
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF messages
+        FOR VALUES FROM ('{month.isoformat()} 00:00:00+00') TO ('{add_months(month, 1).isoformat()} 00:00:00+00');
+    """)
+
+
+def list_partitions(cur) -> List[Tuple[str, date]]:
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass;
+    """)
+    partitions = []
+    for (name,) in cur.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def ensure_partitions(cur, since: Optional[date] = None, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Создаёт месячные партиции от since (по умолчанию текущий месяц) до months_ahead вперёд"""
+    month = month_start(since) if since else current_month()
+    last = add_months(current_month(), months_ahead)
+    while month <= last:
+        create_partition(cur, month)
+        month = add_months(month, 1)
+
+
+def setup_messages(cur, legacy_group_id: Optional[int]):
+    """messages, разбитая по месяцам; старая обычная таблица переносится один раз.
+
+    Строки, записанные до появления group_id, относятся к legacy_group_id.
+    """
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        WHERE c.oid = to_regclass('messages');
+    """)
+    row = cur.fetchone()
+    if row is None:
+        create_partitioned_table(cur)
+        ensure_partitions(cur)
+    elif row[0] != 'p':
+        migrate_to_partitioned(cur, legacy_group_id)
+    else:
+        add_group_key(cur, "messages", legacy_group_id)
+        ensure_partitions(cur)
+
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT;")
+    # Индекс на родителе создаётся и на всех партициях, в том числе будущих
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_group_date_user ON messages (group_id, message_date, user_id);
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_messages_date_user_id;")
+    ensure_message_key(cur)
+    # Помесячные итоги по пользователю для сообщений, ушедших за пределы ретеншна
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_monthly_scores (
+            group_id BIGINT NOT NULL,
+            month DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            points BIGINT NOT NULL DEFAULT 0,
+            message_count BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, month, user_id)
+        );
+    """)
+    add_group_key(cur, "user_monthly_scores", legacy_group_id, "group_id, month, user_id")
+
+
+def ensure_message_key(cur):
+    """Уникальность (group_id, user_id, message_id, message_date): повторно доставленный апдейт не пишется дважды.
+
+    Дата сообщения приходит от Telegram и при повторной доставке та же, так что
+    ключ с ней ловит те же дубли, что и (group_id, user_id, message_id).
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL, to_regclass(%s) IS NOT NULL;",
+                (MESSAGE_KEY_INDEX, LEGACY_MESSAGE_KEY_INDEX))
+    has_key, has_legacy_key = cur.fetchone()
+    if has_key:
+        return
+    if not has_legacy_key:
+        # Дубли, накопленные до появления ключа, иначе индекс не создастся; оставляем первую запись
+        cur.execute("""
+            DELETE FROM messages m
+            USING messages d
+            WHERE m.group_id = d.group_id
+              AND m.user_id = d.user_id
+              AND m.message_id = d.message_id
+              AND m.message_date = d.message_date
+              AND m.id > d.id;
+        """)
+        if cur.rowcount:
+            log.warning("Removed duplicate messages, counters need reconciliation (python reconcile.py --apply)",
+                        extra={"deleted": cur.rowcount})
+    cur.execute(f"""
+        CREATE UNIQUE INDEX {MESSAGE_KEY_INDEX} ON messages (group_id, user_id, message_id, message_date);
+    """)
+    cur.execute(f"DROP INDEX IF EXISTS {LEGACY_MESSAGE_KEY_INDEX};")
+
+
+def migrate_to_partitioned(cur, legacy_group_id: Optional[int]):
+    log.info("Migrating messages to a partitioned table")
+    cur.execute("ALTER TABLE messages RENAME TO messages_unpartitioned;")
+    create_partitioned_table(cur)
+    cur.execute("SELECT MIN(message_date) FROM messages_unpartitioned;")
+    oldest = cur.fetchone()[0]
+    ensure_partitions(cur, since=oldest.astimezone(timezone.utc).date() if oldest else None)
+    cur.execute("""
+        INSERT INTO messages (id, group_id, user_id, message_id, message_date, points)
+        SELECT id, %s, user_id, message_id, COALESCE(message_date, NOW()), points
+        FROM messages_unpartitioned;
+    """, (legacy_group_id,))
+    cur.execute("""
+        SELECT setval(pg_get_serial_sequence('messages', 'id'), COALESCE(MAX(id), 0) + 1, false)
+        FROM messages;
+    """)
+    # Вместе со старой таблицей уходят её индекс и последовательность id
+    cur.execute("DROP TABLE messages_unpartitioned;")
+
+
+# --- ретеншн ---
+
+def _aggregate_into_monthly(cur, source: str, where: str = "TRUE", params=()):
+    cur.execute(f"""
+        INSERT INTO user_monthly_scores (group_id, month, user_id, points, message_count)
+        SELECT group_id, date_trunc('month', message_date AT TIME ZONE 'UTC')::date, user_id, SUM(points), COUNT(*)
+        FROM {source}
+        WHERE {where}
+        GROUP BY 1, 2, 3
+        ON CONFLICT (group_id, month, user_id)
+        DO UPDATE SET
+            points = user_monthly_scores.points + EXCLUDED.points,
+            message_count = user_monthly_scores.message_count + EXCLUDED.message_count;
+    """, params)
+
+
+def retire_partition(cur, name: str, month: date, action: str = MESSAGES_RETENTION_ACTION):
+    """Сворачивает партицию в помесячные итоги и удаляет (или отсоединяет) её"""
+    _aggregate_into_monthly(cur, name)
+    # Суточный rollup за этот месяц лидерборду уже не нужен: окна не длиннее 30 дней
+    cur.execute("DELETE FROM user_daily_scores WHERE day >= %s AND day < %s;", (month, add_months(month, 1)))
+    if action == "detach":
+        cur.execute(f"ALTER TABLE messages DETACH PARTITION {name};")
+    else:
+        cur.execute(f"DROP TABLE {name};")
+    log.info("Retired messages partition", extra={"partition": name, "action": action})
+
+
+def sweep_default_partition(cur, cutoff: date):
+    """Строки старше ретеншна, попавшие в DEFAULT (например, по дате давно удалённого месяца)"""
+    where = "message_date < %s"
+    params = (datetime(cutoff.year, cutoff.month, cutoff.day, tzinfo=timezone.utc),)
+    _aggregate_into_monthly(cur, DEFAULT_PARTITION, where, params)
+    cur.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE {where};", params)
+
+
+def maintain(cur, retention_months: int = MESSAGES_RETENTION_MONTHS) -> bool:
+    """Создаёт будущие партиции и сворачивает старые; False, если этим уже занята другая реплика"""
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (MAINTENANCE_LOCK_KEY,))
+    if not cur.fetchone()[0]:
+        return False
+    ensure_partitions(cur)
+    cutoff = add_months(current_month(), -retention_months)
+    for name, month in list_partitions(cur):
+        if month < cutoff:
+            retire_partition(cur, name, month)
+    sweep_default_partition(cur, cutoff)
+    cur.execute("DELETE FROM user_daily_scores WHERE day < %s;", (cutoff,))
+    return True
+
+
+async def run_maintenance(connect: Callable, interval: int = PARTITION_MAINTENANCE_INTERVAL):
+    """Фоновая задача коллектора: обслуживание партиций раз в interval секунд"""
+    def _run():
+        conn = connect()
+        try:
+            with conn.cursor() as cur:
+                maintain(cur)
+            conn.commit()
+        finally:
+            conn.close()
+
+    while True:
+        try:
+            await asyncio.to_thread(_run)
+        except Exception:
+            log.exception("Partition maintenance failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from ingest import notify_subscribers_changed
+from metrics import PHOTO_QUEUE, PHOTO_RESOLVED
+
+log = logging.getLogger(__name__)
+
+# Не больше стольких пар вызовов Bot API в секунду (getUserProfilePhotos + getFile)
+PHOTO_RATE_PER_SEC = float(os.getenv("PHOTO_RATE_PER_SEC", "5"))
+# Ссылка на файл Telegram живёт не меньше часа; старше этого — перезапрашиваем
+PHOTO_MAX_AGE = int(os.getenv("PHOTO_MAX_AGE", "3000"))
+# Как часто искать устаревшие photo_url и сколько брать за раз
+PHOTO_REFRESH_INTERVAL = int(os.getenv("PHOTO_REFRESH_INTERVAL", "300"))
+PHOTO_REFRESH_BATCH = int(os.getenv("PHOTO_REFRESH_BATCH", "500"))
+# Обновляем только тех, кто писал за последние N дней — их видно в лидерборде
+PHOTO_REFRESH_ACTIVE_DAYS = int(os.getenv("PHOTO_REFRESH_ACTIVE_DAYS", "30"))
+PHOTO_QUEUE_SIZE = int(os.getenv("PHOTO_QUEUE_SIZE", "10000"))
+# Сколько найденных фото записываем в БД одним UPDATE
+PHOTO_WRITE_BATCH = 50
+
+
+class PhotoResolver:
+    """Фоновое получение фото профиля.
+
+    Пользователи ставятся в очередь без ожидания (повторы схлопываются, недавно
+    разрешённые пропускаются), воркер ходит в Bot API с ограничением частоты и
+    пишет найденные ссылки в БД пачками. Раз в PHOTO_REFRESH_INTERVAL устаревшие
+    photo_url сами ставятся в очередь.
+    """
+
+    def __init__(self, resolve: Callable[[int], Awaitable[Optional[str]]], connect: Callable,
+                 rate_per_sec: float = PHOTO_RATE_PER_SEC, max_age: int = PHOTO_MAX_AGE,
+                 refresh_interval: int = PHOTO_REFRESH_INTERVAL, queue_size: int = PHOTO_QUEUE_SIZE):
+        self._resolve = resolve
+        self._connect = connect
+        self.min_interval = 1 / rate_per_sec if rate_per_sec > 0 else 0
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._queued: Set[int] = set()
+        self._resolved_at: Dict[int, float] = {}
+        self._pending: Dict[int, Optional[str]] = {}
+        self._next_call = 0.0
+        self._tasks = []
+        PHOTO_QUEUE.set_function(self._queue.qsize)
+
+    # --- постановка в очередь ---
+
+    def request(self, user_id: int, force: bool = False):
+        """Ставит пользователя в очередь; никогда не ждёт и не ходит в сеть"""
+        if user_id in self._queued:
+            return
+        resolved_at = self._resolved_at.get(user_id)
+        if not force and resolved_at is not None and time.monotonic() - resolved_at < self.max_age:
+            return
+        try:
+            self._queue.put_nowait(user_id)
+        except asyncio.QueueFull:
+            # Не страшно: периодическая сверка устаревших фото подберёт его позже
+            log.warning("Photo queue is full, dropping request", extra={"user_id": user_id})
+            return
+        self._queued.add(user_id)
+
+    def request_many(self, user_ids: Iterable[int], force: bool = False):
+        for user_id in user_ids:
+            self.request(user_id, force)
+
+    # --- жизненный цикл ---
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()), asyncio.create_task(self._refresher())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._flush()
+
+    # --- воркер ---
+
+    async def _throttle(self):
+        now = time.monotonic()
+        if self._next_call > now:
+            await asyncio.sleep(self._next_call - now)
+        self._next_call = max(now, self._next_call) + self.min_interval
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            self._queued.discard(user_id)
+            await self._throttle()
+            try:
+                photo_url = await self._resolve(user_id)
+            except Exception as e:
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after:
+                    # Flood control: ждём, сколько просит Telegram, и пробуем снова
+                    self._next_call = time.monotonic() + retry_after
+                    self.request(user_id, force=True)
+                PHOTO_RESOLVED.labels("error").inc()
+                log.warning("Couldn't get photo", extra={"user_id": user_id, "error": str(e)})
+                continue
+
+            PHOTO_RESOLVED.labels("found" if photo_url else "none").inc()
+            self._resolved_at[user_id] = time.monotonic()
+            self._pending[user_id] = photo_url
+            if len(self._pending) >= PHOTO_WRITE_BATCH or self._queue.empty():
+                await self._flush()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except psycopg2.Error as e:
+            log.error("Failed to save photos", extra={"size": len(batch), "error": str(e)})
+            # Пишем в следующий раз; свежие результаты важнее
+            self._pending = {**batch, **self._pending}
+
+    def _write(self, batch: Dict[int, Optional[str]]):
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                # Без фото тоже отмечаем время, чтобы не спрашивать Telegram снова до max_age
+                execute_values(cur, """
+                    UPDATE channel_subscribers AS s
+                    SET photo_url = COALESCE(v.photo_url, s.photo_url), photo_updated_at = NOW()
+                    FROM (VALUES %s) AS v (telegram_id, photo_url)
+                    WHERE s.telegram_id = v.telegram_id;
+                """, sorted(batch.items()), template="(%s::bigint, %s::varchar)", page_size=len(batch))
+                notify_subscribers_changed(cur, [uid for uid, url in batch.items() if url])
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- периодическое обновление ---
+
+    async def _refresher(self):
+        while True:
+            try:
+                stale = await asyncio.to_thread(self._claim_stale)
+                self.request_many(stale, force=True)
+                if stale:
+                    log.info("Queued stale photos for refresh", extra={"count": len(stale)})
+            except psycopg2.Error as e:
+                log.error("Failed to look up stale photos", extra={"error": str(e)})
+            cutoff = time.monotonic() - self.max_age
+            self._resolved_at = {uid: t for uid, t in self._resolved_at.items() if t > cutoff}
+            await asyncio.sleep(self.refresh_interval)
+
+    def _claim_stale(self):
+        # Выбранным строкам сразу ставим photo_updated_at: другие реплики коллектора
+        # их пропустят, и один пользователь не уйдёт в Bot API несколько раз
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE channel_subscribers
+                    SET photo_updated_at = NOW()
+                    WHERE telegram_id IN (
+                        SELECT telegram_id
+                        FROM channel_subscribers
+                        WHERE is_active = TRUE
+                          AND last_seen > NOW() - make_interval(days => %s)
+                          AND (photo_updated_at IS NULL OR photo_updated_at < NOW() - make_interval(secs => %s))
+                        ORDER BY photo_updated_at NULLS FIRST
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING telegram_id;
+                """, (PHOTO_REFRESH_ACTIVE_DAYS, self.max_age, PHOTO_REFRESH_BATCH))
+                stale = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            return stale
+        finally:
+            conn.close()
@@ -0,0 +1,229 @@
+"""Сверка счётчиков с сообщениями.
+
+    DATABASE_URL=... python reconcile.py            # только отчёт
+    DATABASE_URL=... python reconcile.py --apply    # отчёт и исправление
+
+Истина — строки messages плюс помесячные итоги user_monthly_scores (сообщения,
+ушедшие за ретеншн). С ними сверяются channel_subscribers.message_count (лидерборд
+за всё время) и суточный rollup user_daily_scores (лидерборд за 7/30 дней).
+
+Расхождения считаются одним запросом на каждую таблицу — в одном снимке БД вместе
+с текущими значениями счётчиков, — поэтому исправление применяется как поправка
+(+= дрейф), а не перезаписью: приросты, которые коллектор сделал после снимка,
+не теряются. Поправки идут пачками по --batch-size строк, каждая в своей короткой
+транзакции с lock_timeout, так что запись коллектора не встаёт.
+"""
+import os
+import sys
+import time
+import argparse
+from typing import Tuple
+
+import psycopg2
+from psycopg2.errors import LockNotAvailable
+from psycopg2.extras import execute_values
+
+from ingest import notify_subscribers_changed
+
+# Сколько ждать блокировку строки, прежде чем отложить пачку и повторить
+RECONCILE_LOCK_TIMEOUT = os.getenv("RECONCILE_LOCK_TIMEOUT", "2s")
+RECONCILE_RETRIES = 5
+
+
+def find_subscriber_drift(cur) -> int:
+    """reconcile_subscribers: (group_id, user_id), текущее message_count и дрейф до фактического числа сообщений"""
+    cur.execute("""
+        CREATE TEMP TABLE reconcile_subscribers AS
+        SELECT row_number() OVER (ORDER BY cs.group_id, cs.telegram_id) AS seq,
+               cs.group_id,
+               cs.telegram_id AS user_id,
+               cs.message_count AS current,
+               COALESCE(actual.message_count, 0) - COALESCE(cs.message_count, 0) AS drift
+        FROM channel_subscribers cs
+        LEFT JOIN (
+            SELECT group_id, user_id, SUM(message_count) AS message_count
+            FROM (
+                SELECT group_id, user_id, COUNT(*) AS message_count FROM messages GROUP BY 1, 2
+                UNION ALL
+                SELECT group_id, user_id, SUM(message_count) FROM user_monthly_scores GROUP BY 1, 2
+            ) parts
+            GROUP BY 1, 2
+        ) actual ON actual.group_id = cs.group_id AND actual.user_id = cs.telegram_id
+        WHERE COALESCE(actual.message_count, 0) <> COALESCE(cs.message_count, 0);
+    """)
+    drifted = cur.rowcount
+    cur.execute("ALTER TABLE reconcile_subscribers ADD PRIMARY KEY (seq);")
+    return drifted
+
+
+def find_daily_drift(cur) -> int:
+    """reconcile_daily: (group_id, day, user_id) и дрейф очков и числа сообщений суточного rollup"""
+    cur.execute("""
+        CREATE TEMP TABLE reconcile_daily AS
+        SELECT row_number() OVER (ORDER BY group_id, day, user_id) AS seq, group_id, day, user_id,
+               COALESCE(m.points, 0) - COALESCE(d.points, 0) AS points_drift,
+               COALESCE(m.message_count, 0) - COALESCE(d.message_count, 0) AS count_drift
+        FROM (
+            SELECT group_id, (message_date AT TIME ZONE 'UTC')::date AS day, user_id,
+                   SUM(points) AS points, COUNT(*) AS message_count
+            FROM messages
+            GROUP BY 1, 2, 3
+        ) m
+        FULL JOIN user_daily_scores d USING (group_id, day, user_id)
+        WHERE COALESCE(m.points, 0) <> COALESCE(d.points, 0)
+           OR COALESCE(m.message_count, 0) <> COALESCE(d.message_count, 0);
+    """)
+    drifted = cur.rowcount
+    cur.execute("ALTER TABLE reconcile_daily ADD PRIMARY KEY (seq);")
+    return drifted
+
+
+def analyze(conn) -> Tuple[int, int]:
+    """Оба расхождения в одном снимке: REPEATABLE READ на время подсчёта"""
+    conn.set_session(isolation_level="REPEATABLE READ")
+    with conn.cursor() as cur:
+        subscribers = find_subscriber_drift(cur)
+        daily = find_daily_drift(cur)
+    conn.commit()
+    conn.set_session(isolation_level="READ COMMITTED")
+    return subscribers, daily
+
+
+def report(conn, top: int):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*), COALESCE(SUM(drift), 0), COALESCE(SUM(ABS(drift)), 0)
+            FROM reconcile_subscribers;
+        """)
+        users, net, total = cur.fetchone()
+        print(f"channel_subscribers.message_count: {users} users drifted, net {net:+d}, total {total}")
+        cur.execute("""
+            SELECT group_id, user_id, current, drift FROM reconcile_subscribers
+            ORDER BY ABS(drift) DESC, group_id, user_id
+            LIMIT %s;
+        """, (top,))
+        for group_id, user_id, current, drift in cur.fetchall():
+            print(f"  {group_id}/{user_id}: {current} -> {(current or 0) + drift} ({drift:+d})")
+
+        cur.execute("""
+            SELECT COUNT(*), COUNT(DISTINCT (group_id, user_id)), COALESCE(SUM(points_drift), 0),
+                   COALESCE(MIN(day)::text, '-'), COALESCE(MAX(day)::text, '-')
+            FROM reconcile_daily;
+        """)
+        rows, users, points, first, last = cur.fetchone()
+        print(f"user_daily_scores: {rows} rows of {users} users drifted, net {points:+d} points, days {first}..{last}")
+    conn.commit()
+
+
+def _batches(conn, select: str, batch_size: int, pause: float, apply_batch):
+    """Идёт по временной таблице по seq; каждая пачка — отдельная транзакция"""
+    after = 0
+    applied = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(select, {"after": after, "limit": batch_size})
+            numbered = cur.fetchall()
+        conn.commit()
+        if not numbered:
+            return applied
+        after = numbered[-1][0]
+        rows = [row[1:] for row in numbered]
+        for attempt in range(1, RECONCILE_RETRIES + 1):
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s;", (RECONCILE_LOCK_TIMEOUT,))
+                    apply_batch(cur, rows)
+                conn.commit()
+                break
+            except LockNotAvailable:
+                conn.rollback()
+                if attempt == RECONCILE_RETRIES:
+                    raise
+                time.sleep(attempt)
+        applied += len(rows)
+        if pause:
+            time.sleep(pause)
+
+
+def fix_subscribers(conn, batch_size: int, pause: float) -> int:
+    def apply_batch(cur, rows):
+        execute_values(cur, """
+            UPDATE channel_subscribers cs
+            SET message_count = COALESCE(cs.message_count, 0) + fix.drift
+            FROM (VALUES %s) AS fix (group_id, user_id, drift)
+            WHERE cs.group_id = fix.group_id AND cs.telegram_id = fix.user_id;
+        """, rows, page_size=len(rows))
+        # Backend сбросит закэшированные профили с message_count
+        by_group = {}
+        for group_id, user_id, _ in rows:
+            by_group.setdefault(group_id, []).append(user_id)
+        for group_id, user_ids in by_group.items():
+            notify_subscribers_changed(cur, user_ids, group_id)
+
+    return _batches(conn, """
+        SELECT seq, group_id, user_id, drift FROM reconcile_subscribers
+        WHERE seq > %(after)s
+        ORDER BY seq
+        LIMIT %(limit)s;
+    """, batch_size, pause, apply_batch)
+
+
+def fix_daily(conn, batch_size: int, pause: float) -> int:
+    def apply_batch(cur, rows):
+        execute_values(cur, """
+            INSERT INTO user_daily_scores AS d (group_id, day, user_id, points, message_count) VALUES %s
+            ON CONFLICT (group_id, day, user_id)
+            DO UPDATE SET
+                points = d.points + EXCLUDED.points,
+                message_count = d.message_count + EXCLUDED.message_count;
+        """, rows, page_size=len(rows))
+        # Строки, в которых не осталось сообщений, лидерборду не нужны
+        execute_values(cur, """
+            DELETE FROM user_daily_scores d
+            USING (VALUES %s) AS fix (group_id, day, user_id)
+            WHERE d.group_id = fix.group_id AND d.day = fix.day AND d.user_id = fix.user_id
+              AND d.message_count = 0 AND d.points = 0;
+        """, [row[:3] for row in rows], template="(%s, %s::date, %s)", page_size=len(rows))
+
+    return _batches(conn, """
+        SELECT seq, group_id, day, user_id, points_drift, count_drift FROM reconcile_daily
+        WHERE seq > %(after)s
+        ORDER BY seq
+        LIMIT %(limit)s;
+    """, batch_size, pause, apply_batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apply", action="store_true", help="исправить счётчики (без него — только отчёт)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="строк на одну транзакцию")
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза между пачками, секунд")
+    parser.add_argument("--top", type=int, default=20, help="сколько самых больших расхождений показать")
+    args = parser.parse_args()
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        sys.exit("DATABASE_URL is not set")
+
+    conn = psycopg2.connect(database_url)
+    try:
+        started = time.perf_counter()
+        subscribers, daily = analyze(conn)
+        print(f"Analyzed in {time.perf_counter() - started:.1f}s")
+        report(conn, args.top)
+        if not (subscribers or daily):
+            print("Counters match messages, nothing to fix")
+            return
+        if not args.apply:
+            print("Dry run; pass --apply to fix the counters")
+            return
+        started = time.perf_counter()
+        users = fix_subscribers(conn, args.batch_size, args.pause)
+        days = fix_daily(conn, args.batch_size, args.pause)
+        print(f"Fixed {users} subscribers and {days} daily rows in {time.perf_counter() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+import signal
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import TelegramObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# polling — как раньше; webhook — встроенный HTTP-сервер, Telegram сам присылает апдейты
+COLLECTOR_MODE = os.getenv("COLLECTOR_MODE", "polling")
+# Публичный адрес, который регистрируется в Telegram (https://host), и путь на нём
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; без совпадения — 401
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько параллельных соединений Telegram открывает к webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Регистрировать webhook при старте. За одним адресом несколько реплик — включать у одной
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+# Сколько апдейтов одна реплика обрабатывает одновременно
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "64"))
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов.
+
+    В режиме webhook ответ уходит только после обработки, так что лишние запросы
+    ждут здесь, а Telegram притормаживает отправку — очередь не растёт в памяти.
+    """
+
+    def __init__(self, limit: int = HANDLER_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    # handle_in_background=False: 200 отдаём после обработки, иначе лимит выше бесполезен
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Поднимает HTTP-сервер и работает до SIGINT/SIGTERM"""
+    if not WEBHOOK_SECRET:
+        log.warning("WEBHOOK_SECRET is not set: webhook requests are not authenticated")
+
+    if WEBHOOK_REGISTER:
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL is required to register the webhook")
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        log.info("Webhook registered", extra={"url": WEBHOOK_URL, "path": WEBHOOK_PATH})
+
+    runner = web.AppRunner(build_app(dp, bot))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    log.info("Webhook server started", extra={"host": WEBHOOK_HOST, "port": WEBHOOK_PORT})
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        # Сначала перестаём принимать апдейты, потом вызывающий дописывает буфер
+        await runner.cleanup()
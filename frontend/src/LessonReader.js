@@ -1,7 +1,5 @@
 import React, { useState, useEffect } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
-import ReactMarkdown from 'react-markdown';
-import remarkGfm from 'remark-gfm';
 import './LessonReader.css';
 
 const tg = window.Telegram?.WebApp;
@@ -32,7 +30,7 @@ function LessonReader() {
       try {
         // Загружаем урок и информацию о курсе параллельно
         const [lessonResponse, courseResponse] = await Promise.all([
-          fetch(`${BACKEND_URL}/api/courses/${courseId}/lessons/${lessonId}`, {
+          fetch(`${BACKEND_URL}/api/courses/${courseId}/lessons/${lessonId}/html`, {
             headers: { 'X-Init-Data': tg.initData }
           }),
           fetch(`${BACKEND_URL}/api/courses/${courseId}`, {
@@ -54,8 +52,10 @@ function LessonReader() {
         setLessonData(lesson);
         setCourseData(course);
         
-        // TODO: Загрузить реальный статус завершения
-        setIsCompleted(false);
+        const currentLesson = course.sections
+          .flatMap(section => section.lessons)
+          .find(item => item.id === lessonId);
+        setIsCompleted(Boolean(currentLesson?.completed));
         
       } catch (error) {
         console.error('Ошибка при загрузке урока:', error);
@@ -68,10 +68,22 @@ function LessonReader() {
     fetchData();
   }, [courseId, lessonId]);
 
-  const handleMarkComplete = () => {
-    setIsCompleted(!isCompleted);
-    // TODO: API вызов для сохранения прогресса
-    console.log(`Урок ${lessonId} отмечен как ${!isCompleted ? 'завершенный' : 'незавершенный'}`);
+  const handleMarkComplete = async () => {
+    const completed = !isCompleted;
+    setIsCompleted(completed);
+    try {
+      const response = await fetch(`${BACKEND_URL}/api/courses/${courseId}/lessons/${lessonId}/complete`, {
+        method: 'POST',
+        headers: { 'X-Init-Data': tg.initData, 'Content-Type': 'application/json' },
+        body: JSON.stringify({ completed })
+      });
+      if (!response.ok) {
+        throw new Error('Не удалось сохранить прогресс');
+      }
+    } catch (error) {
+      console.error('Ошибка при сохранении прогресса:', error);
+      setIsCompleted(!completed);
+    }
   };
 
   const goBackToCourse = () => {
@@ -180,12 +192,14 @@ function LessonReader() {
         </button>
       </div>
 
-      {/* Контент урока */}
-      <div className="lesson-content">
-        <ReactMarkdown remarkPlugins={[remarkGfm]}>
-          {lessonData.content || "Контент урока загружается..."}
-        </ReactMarkdown>
+      {/* Контент урока: HTML уже отрендерен и санитизирован на сервере */}
+      <div className="lesson-meta">
+        ⏱ {lessonData.reading_time_minutes} мин чтения
       </div>
+      <div
+        className="lesson-content"
+        dangerouslySetInnerHTML={{ __html: lessonData.html || "Контент урока загружается..." }}
+      />
 
       {/* Навигация между уроками */}
       <div className="lesson-navigation">